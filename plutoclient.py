@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+# -*-coding:utf-8-*-
+# Description: Client library of the PlutoSDR service: control commands and vectorized reception of I/Q blocks
+
+import asyncio
+import collections
+import socket
+
+import numpy as np
+
+from plutosdr import DATA_HEADER, DATA_HEADER_V2, FULL_SCALE
+from plutosdr_codec import ENCODING_HEADER, decode
+
+MAX_DATAGRAM = 64 * 1024
+
+# I/Q of consecutive datagrams captured with the same parameters, samples are complex64 scaled to full scale 1.0
+# sequence: sequence number of the first datagram (v2, else 0), sample_counter: counter of the first sample (v2, else 0),
+# flags: flags of all datagrams or'ed (v2), lost: datagrams missing before this block (v2)
+SampleBlock = collections.namedtuple('SampleBlock', 'samples sequence sample_counter timestamp frequency bandwidth '
+                                                    'sampling_rate gain flags lost')
+
+
+class PlutoClient():
+    '''
+    Connection to a PlutoSDR service: a TCP control connection and a UDP socket receiving the data.
+    Datagrams are received in batches into preallocated buffers and decoded with numpy,
+    iterate over the client (or "async for") to get SampleBlock
+    Parameters:
+        host, port: control address of the server
+        data_port: local UDP port (0 for any)
+        header: data header version requested, 'v2' carries sequence numbers and sample counters
+        batch: datagrams received per batch at most
+        receive_buffer: SO_RCVBUF of the UDP socket
+    '''
+
+    def __init__(self, host='127.0.0.1', port=5025, data_port=0, header='v2', batch=64, receive_buffer=8 * 1024 * 1024):
+        self.host = host
+        self.port = port
+        self.header = header
+        self.batch = batch
+        self.ack = False
+        self.__control = socket.create_connection((host, port))
+        self.__reader = self.__control.makefile('rb')
+        self.__data = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.__data.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, receive_buffer)
+        self.__data.bind((self.__control.getsockname()[0], data_port))
+        self.__buffer = bytearray(batch * MAX_DATAGRAM)
+        self.__views = [memoryview(self.__buffer)[index * MAX_DATAGRAM: (index + 1) * MAX_DATAGRAM] for index in range(batch)]
+        self.__sizes = [0] * batch
+        self.__pending = collections.deque()
+        self.__sequence = None
+        address, data_port = self.__data.getsockname()
+        self.command(udp='{0}:{1}'.format(address, data_port), header=header)
+        self.expect('header')
+
+    @property
+    def data_port(self):
+        return self.__data.getsockname()[1]
+
+    def close(self):
+        try:
+            self.__reader.close()
+            self.__control.close()
+        finally:
+            self.__data.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    # Control
+
+    def command(self, **commands):
+        '''
+        Send task commands, eg. command(task='on', queue='drop-oldest:64') sends "*task=on;queue=drop-oldest:64\n"
+        '''
+        line = ';'.join('{0}={1}'.format(name, value) for name, value in commands.items())
+        self.__control.sendall('*{0}\n'.format(line).encode('ascii'))
+
+    def expect(self, name):
+        '''
+        Read control replies until the one of name, return its fields as a dict
+        eg. expect('queue') for "queue=drop-oldest:32;queued=0;dropped=0;sent=10;failed=0"
+        '''
+        while True:
+            line = self.__reader.readline()
+            if not line:
+                raise ConnectionError('control connection closed')
+            fields = dict(field.partition('=')[::2] for field in line.decode('ascii').strip().split(';'))
+            if name in fields:
+                return fields
+
+    def query(self, name):
+        '''
+        Query a state which answers to "?", eg. query('queue'), query('sweep'), query('record')
+        '''
+        self.command(**{name: '?'})
+        return self.expect(name)
+
+    def start(self):
+        self.command(task='on')
+
+    def stop(self):
+        self.command(task='off')
+
+    def set_ack(self, enabled):
+        self.ack = enabled
+        self.command(ack='on' if enabled else 'off')
+
+    def set_parameters(self, **parameters):
+        '''
+        Apply parameters as one transaction, eg. set_parameters(frequency=433920000, rf_bandwidth=2000000)
+        Return: the acknowledgement as a dict of integers when ack is on, else None
+        '''
+        fields = []
+        for name, value in parameters.items():
+            kind = 'str' if isinstance(value, str) else 'long'
+            fields.append('{0}:{1}:{2}'.format(kind, name, value))
+        self.__control.sendall('#{0}\n'.format(';'.join(fields)).encode('ascii'))
+        if self.ack:
+            return {name: int(value) for name, value in self.expect('ack').items()}
+        return None
+
+    # Data
+
+    def receive(self, timeout=None):
+        '''
+        Receive one batch of datagrams (waiting for the first one at most timeout seconds)
+        Return: list of SampleBlock, empty when timed out
+        '''
+        self.__data.settimeout(timeout)
+        try:
+            self.__sizes[0] = self.__data.recv_into(self.__views[0])
+        except socket.timeout:
+            return []
+        return self.__drain()
+
+    def __drain(self):
+        '''
+        Read the datagrams already queued by the kernel behind the first one, then decode the batch
+        '''
+        count = 1
+        self.__data.setblocking(False)
+        try:
+            while count < self.batch:
+                self.__sizes[count] = self.__data.recv_into(self.__views[count])
+                count += 1
+        except (BlockingIOError, InterruptedError):
+            pass
+        return self.__decode(count)
+
+    def __decode(self, count):
+        '''
+        Group consecutive datagrams captured with the same parameters into blocks and convert them to complex64
+        '''
+        blocks = []
+        runs = []  # int16 views of the current block
+        current = None
+        for index in range(count):
+            view = self.__views[index][:self.__sizes[index]]
+            parsed = self.__parse(view)
+            if parsed is None:
+                continue
+            metadata, iq = parsed
+            parameters = metadata[3:7]
+            follows = current is not None and parameters == current[3:7] and metadata[9] == 0 and \
+                (self.header != 'v2' or metadata[1] == current[1] + current_samples)
+            if not follows:
+                if current is not None:
+                    blocks.append(self.__block(current, runs, flags))
+                current, runs, flags, current_samples = metadata, [], 0, 0
+            runs.append(iq)
+            flags |= metadata[8]
+            current_samples += len(iq) // 2
+        if current is not None:
+            blocks.append(self.__block(current, runs, flags))
+        return blocks
+
+    def __parse(self, view):
+        '''
+        Return (metadata, int16 I/Q view) of a data datagram, None for anything else (eg. spectra)
+        metadata: (sequence, sample counter, timestamp, frequency, bandwidth, rate, gain, count, flags, lost)
+        '''
+        if view[0] == 0x23 and len(view) >= DATA_HEADER.size:  # '#'
+            _, frequency, bandwidth, rate, gain, count = DATA_HEADER.unpack_from(view)
+            iq = np.frombuffer(view, dtype=np.int16, count=count * 2, offset=DATA_HEADER.size)
+            return (0, 0, 0, frequency, bandwidth, rate, gain, count, 0, 0), iq
+        if view[0] == 0x24 and len(view) >= DATA_HEADER_V2.size:  # '$'
+            (_, _, size, flags, _, _, sequence, _, sample_counter, timestamp, frequency, bandwidth, rate, gain,
+             count) = DATA_HEADER_V2.unpack_from(view)
+            lost = 0
+            if self.__sequence is not None:
+                lost = (sequence - self.__sequence - 1) & 0xffffffff
+            self.__sequence = sequence
+            if size >= DATA_HEADER_V2.size + ENCODING_HEADER.size:
+                encoding, exponent, _, length = ENCODING_HEADER.unpack_from(view, DATA_HEADER_V2.size)
+                iq = decode(encoding, exponent, view[size: size + length])
+            else:
+                iq = np.frombuffer(view, dtype=np.int16, count=count * 2, offset=size)
+            return (sequence, sample_counter, timestamp, frequency, bandwidth, rate, gain, count, flags, lost), iq
+        return None
+
+    @staticmethod
+    def __block(metadata, runs, flags):
+        total = sum(len(iq) for iq in runs) // 2
+        samples = np.empty(total, dtype=np.complex64)
+        values = samples.view(np.float32)
+        offset = 0
+        for iq in runs:
+            np.multiply(iq, np.float32(1.0 / FULL_SCALE), out=values[offset: offset + len(iq)], casting='unsafe')
+            offset += len(iq)
+        sequence, sample_counter, timestamp, frequency, bandwidth, rate, gain, _, _, lost = metadata
+        return SampleBlock(samples, sequence, sample_counter, timestamp, frequency, bandwidth, rate, gain, flags, lost)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        while not self.__pending:
+            self.__pending.extend(self.receive())
+        return self.__pending.popleft()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        loop = asyncio.get_running_loop()
+        while not self.__pending:
+            self.__data.setblocking(False)
+            self.__sizes[0] = await loop.sock_recv_into(self.__data, self.__views[0])
+            self.__pending.extend(self.__drain())
+        return self.__pending.popleft()
@@ -2,8 +2,10 @@
 # -*-coding:utf-8-*-
 # Description: This is PlutoSDR service which supplies I/Q through socket
 
+import collections
+import ctypes
+import json
 import os
-import platform
 import socket
 import struct
 import sys
@@ -11,50 +13,504 @@ import threading
 import time
 import traceback
 from ctypes import CDLL as _cdll
-from ctypes import WinDLL as _windll
 from ctypes import c_int, c_ulong
 
-import iio
+from plutosdr_stats import Histogram, MetricsServer, SamplingProfiler
+
+# libiio binding and libad9361, loaded by load_iio when the first hardware backend is created
+iio = None
+_lib = None
+_ad9361_set_bb_rate = None
 
 
 def load_libad9361():
     '''
     Load libad9361 library
     '''
+    import platform
 
     arch, name = platform.architecture()
     if name.lower().startswith('win'):
         path = os.path.join(os.path.dirname(__file__), r'win\x86\libad9361.dll' if arch.lower() == '32bit' else r'win\x64\libad9361.dll')
-        return _windll(path)
+        return ctypes.WinDLL(path)
     path = '/usr/lib/libad9361.so.0'
     if os.path.exists(path):
         return _cdll(path)
     return _cdll('/usr/local/lib/libad9361.so.0')
 
 
-# Initialize libad9361 module
-_lib = load_libad9361()
-
-# Prerequisites for 'ad9316_set_bb_rate' which is used for sampling_frequency setting
-_ad9361_set_bb_rate = _lib.ad9361_set_bb_rate
-_ad9361_set_bb_rate.argtypes = (iio._DevicePtr, c_ulong)
-_ad9361_set_bb_rate.restype = c_int
+def load_iio():
+    '''
+    Import libiio and load libad9361 on first use, so that importing this module (tools, tests, the simulated
+    backend) loads neither
+    Return: True when both are available
+    '''
+    global iio, _lib, _ad9361_set_bb_rate
+    if _lib is None:
+        try:
+            import iio as binding
+            lib = load_libad9361()
+        except (ImportError, OSError):  # only the simulated backend is available without libiio
+            return False
+        # Prerequisites for 'ad9316_set_bb_rate' which is used for sampling_frequency setting
+        set_bb_rate = lib.ad9361_set_bb_rate
+        set_bb_rate.argtypes = (binding._DevicePtr, c_ulong)
+        set_bb_rate.restype = c_int
+        iio, _ad9361_set_bb_rate, _lib = binding, set_bb_rate, lib
+    return True
 
 MAX_IQ_SIZE = 32768
 
+# Data header: '#', frequency, bandwidth, sampling rate, gain, I/Q count
+DATA_HEADER = struct.Struct('=sqqqii')
+
+# Data header v2 (opt-in with "*header=v2"): '$', version, header size, flags, fragment index, fragment count,
+# sequence number, parameter version, sample counter, timestamp (ns), frequency, bandwidth, sampling rate, gain, I/Q count
+DATA_HEADER_V2 = struct.Struct('=sBBBHHIIQqqqqii')
+
+# AD9361 samples are 12bit (-2048~2047) delivered in 16bit words, so 2048 is full scale
+FULL_SCALE = 2048
+
+# Flags of data header v2
+FLAG_OVERFLOW = 0x01            # the device lost samples, polled: at most poll_interval before this refill
+FLAG_PARAMETERS_CHANGED = 0x02  # first refill captured with new parameters
+FLAG_SWEEP = 0x04               # refill captured by a sweep step (after its settling buffers)
+
+# TCP data channel ("*tcp="): every datagram is sent as a record prefixed by its length,
+# a gap record ('!', first missing sample, missing samples) replaces data which was dropped or never captured
+RECORD_LENGTH = struct.Struct('=I')
+GAP_RECORD = struct.Struct('=sxxxQQ')
+TCP_BATCH_SIZE = 1024 * 1024     # bytes of frames aggregated into one write
+TCP_SEND_BUFFER = 4 * 1024 * 1024
+
+# Runtime buffer settings ("*buffer="): sampling count range, kernel buffer count range and, in auto mode,
+# the host stall (seconds) the kernel buffers should absorb
+SAMPLING_COUNT_RANGE = (128, 1024 * 1024)
+KERNEL_BUFFERS_RANGE = (1, 64)
+AUTO_BUFFER_HEADROOM = 0.1
+
+# Device connection: seconds between attempts grow from the first to the second value, consecutive capture errors
+# after which the device is taken as lost and reconnected, and the directory of the persisted parameters
+RECONNECT_DELAY = (0.5, 30.0)
+RECONNECT_ERRORS = 3
+STATE_DIRECTORY = 'state'
+
+# Status register of 'cf-ad9361-lpc', bit 2 is latched on overflow and cleared by writing it back
+RX_STATUS_REGISTER = 0x80000088
+RX_STATUS_OVERFLOW = 0x04
+
+if hasattr(socket.socket, 'sendmsg'):
+    def send_datagram(sock, buffers):
+        '''
+        Send header and payload as one datagram (scatter-gather, no concatenation)
+        '''
+        return sock.sendmsg(buffers)
+else:  # Windows has no sendmsg
+    def send_datagram(sock, buffers):
+        '''
+        Send header and payload as one datagram
+        '''
+        return sock.send(b''.join(buffers))
+
+
+# Parameters are written in this order within a transaction: gain mode before manual gain,
+# bandwidth before the baseband rate (which is set once)
+PARAMETER_ORDER = ('gain_control_mode', 'hardwaregain', 'frequency', 'rf_bandwidth', 'sampling_frequency',
+                   'tx_enabled', 'tx_frequency', 'tx_hardwaregain')
+RX_PARAMETERS = ('gain_control_mode', 'hardwaregain', 'frequency', 'rf_bandwidth', 'sampling_frequency')
+
+# Immutable view of the parameters stamped into data headers, swapped as a whole on change
+ParameterSnapshot = collections.namedtuple('ParameterSnapshot', 'version frequency rf_bandwidth sampling_frequency gain')
+
+
+class IIOBackend():
+    '''
+    Device backend talking to real hardware through libiio and libad9361
+    '''
+
+    def __init__(self):
+        if not load_iio():
+            raise RuntimeError('libiio/libad9361 is not available, only simulated contexts ("sim:") can be used')
+
+    def create_context(self, uri):
+        '''
+        Create an IIO context from uri, eg. "ip:192.168.2.1", "usb:1.2.5"
+        '''
+        return iio.Context(uri)
+
+    def create_buffer(self, device, sampling_count, cyclic=False):
+        '''
+        Create a RX buffer holding sampling_count I/Q samples
+        '''
+        return iio.Buffer(device, sampling_count, cyclic)
+
+    def set_kernel_buffers(self, device, count):
+        '''
+        Set the number of kernel buffers of the RX device, taken into account by the next buffer created
+        '''
+        device.set_kernel_buffers_count(count)
+
+    def stale_refills(self, kernel_buffers):
+        '''
+        Refills still holding samples captured before a parameter change: the buffers the kernel queued
+        '''
+        return kernel_buffers
+
+    def set_bb_rate(self, device, rate):
+        '''
+        Set baseband sampling rate (FIR filters and clock chain) through libad9361
+        '''
+        return _ad9361_set_bb_rate(device._device, c_ulong(rate))
+
+    def read_into(self, buffer, target):
+        '''
+        Copy the refilled buffer into a preallocated bytearray, return the byte count
+        '''
+        start = iio._buffer_start(buffer._buffer)
+        size = min(iio._buffer_end(buffer._buffer) - start, len(target))
+        ctypes.memmove((ctypes.c_char * size).from_buffer(target), start, size)
+        return size
+
+    def read_overflow(self, device):
+        '''
+        Read and clear the overflow bit of the RX core
+        '''
+        status = device.reg_read(RX_STATUS_REGISTER)
+        if status & RX_STATUS_OVERFLOW:
+            device.reg_write(RX_STATUS_REGISTER, status)
+        return bool(status & RX_STATUS_OVERFLOW)
+
+
+def state_file(context, directory=STATE_DIRECTORY):
+    '''
+    Path of the persisted parameters of a device, eg. "state/ip_192.168.2.1.json"
+    '''
+    name = ''.join(char if char.isalnum() or char in '.-' else '_' for char in context)
+    return os.path.join(directory, name + '.json')
+
+
+def create_backend(context):
+    '''
+    Pick a device backend by the scheme of the context uri
+    Parameters:
+        context: "sim:..." for the simulated device, "replay:..." to replay a recording, any other libiio uri for hardware
+    '''
+    if context.startswith('sim:'):
+        from plutosdr_sim import SimulatedBackend
+        return SimulatedBackend.from_uri(context)
+    if context.startswith('replay:'):
+        from plutosdr_sim import ReplayBackend
+        return ReplayBackend.from_uri(context)
+    return IIOBackend()
+
+
+class Frame():
+    '''
+    One refilled buffer of the packetizer pool and its datagrams
+    Every datagram is a pair of memoryviews (header, payload) over preallocated memory, one list per header version,
+    the frame goes back to the pool when its last reference is released
+    Parameters:
+        buffer: writable memory of size bytes the frame is refilled into (eg. shared memory), None for its own
+    '''
+
+    def __init__(self, packetizer, size, buffer=None):
+        self.packetizer = packetizer
+        self.buffer = bytearray(size) if buffer is None else buffer
+        self.size = size
+        self.refs = 0
+        self.__full = packetizer.split(self.buffer, size)
+        self.payloads, self.headers, self.datagrams, self.headers_v2, self.datagrams_v2 = self.__full
+        self.sequence = 0        # sequence number of the first datagram
+        self.sample_counter = 0  # sample counter of the first sample
+        self.timestamp = 0       # capture time in ns since epoch
+        self.flags = 0
+        self.frequency = self.rf_bandwidth = self.sampling_rate = self.gain = 0
+        self.parameter_version = 0
+        self.encoded = {}        # datagrams by payload encoding, shared by the clients asking for it
+        self.levels = {}         # power measures (dBFS) of squelches, see plutosdr_dsp.frame_level
+
+    def resize(self, size):
+        '''
+        Rebuild views when a read is short, full sized views are kept for the next use
+        '''
+        if size != self.size:
+            self.size = size
+            layout = self.__full if size == len(self.buffer) else self.packetizer.split(self.buffer, size)
+            self.payloads, self.headers, self.datagrams, self.headers_v2, self.datagrams_v2 = layout
+
+    def datagrams_for(self, version):
+        return self.datagrams_v2 if version == 2 else self.datagrams
+
+    def retain(self):
+        self.packetizer.retain(self)
+
+    def release(self):
+        self.packetizer.release(self)
+
+
+class Packetizer():
+    '''
+    Split refilled buffers into datagrams without copying I/Q
+    Frames of a pool receive the buffers, datagrams are memoryviews over the frame and headers
+    are packed in place into reused bytearrays. A frame is reused only after every consumer released it,
+    the pool grows when all frames are still referenced (bounded by the queues holding them)
+    Parameters:
+        sampling_count: I/Q sampling count per refill
+        frames: number of frames preallocated
+        max_payload: maximum I/Q bytes per datagram
+    '''
+
+    def __init__(self, sampling_count, frames=8, max_payload=MAX_IQ_SIZE):
+        self.__size = sampling_count * 4
+        self.__max_payload = max_payload
+        self.__lock = threading.Lock()
+        self.__free = [Frame(self, self.__size) for _ in range(frames)]
+        self.__sequence = 0
+        self.allocated = frames
+
+    def resize(self, sampling_count):
+        '''
+        Change the frame size, free frames are reallocated and frames still referenced are dropped when released,
+        sequence numbers go on
+        '''
+        self.__lock.acquire()
+        try:
+            self.__size = sampling_count * 4
+            self.__free = [Frame(self, self.__size) for _ in self.__free]
+        finally:
+            self.__lock.release()
+
+    def split(self, buffer, size):
+        '''
+        Build payload views, header buffers and datagrams (v1 and v2) for the first size bytes of buffer
+        '''
+        view = memoryview(buffer)
+        payloads, headers, datagrams, headers_v2, datagrams_v2 = [], [], [], [], []
+        for offset in range(0, max(size, 1), self.__max_payload):
+            payload = view[offset: min(offset + self.__max_payload, size)]
+            header, header_v2 = bytearray(DATA_HEADER.size), bytearray(DATA_HEADER_V2.size)
+            payloads.append(payload)
+            headers.append(header)
+            headers_v2.append(header_v2)
+            datagrams.append((memoryview(header), payload))
+            datagrams_v2.append((memoryview(header_v2), payload))
+        return payloads, headers, datagrams, headers_v2, datagrams_v2
+
+    def acquire(self):
+        '''
+        Take a free frame holding one reference
+        '''
+        self.__lock.acquire()
+        try:
+            if self.__free:
+                frame = self.__free.pop()
+            else:
+                frame = Frame(self, self.__size)
+                self.allocated += 1
+            frame.refs = 1
+            return frame
+        finally:
+            self.__lock.release()
+
+    def retain(self, frame):
+        self.__lock.acquire()
+        frame.refs += 1
+        self.__lock.release()
+
+    def release(self, frame):
+        self.__lock.acquire()
+        frame.refs -= 1
+        if frame.refs == 0:
+            if len(frame.buffer) == self.__size:
+                self.__free.append(frame)
+            else:  # allocated before a resize
+                self.allocated -= 1
+        self.__lock.release()
+
+    def packetize(self, frame, size, frequency, bandwidth, sampling_rate, gain,
+                  sample_counter=0, timestamp=0, flags=0, parameter_version=0, sequence=None):
+        '''
+        Pack headers (v1 and v2) for a frame holding size bytes, return its v1 datagrams
+        Parameters:
+            sample_counter: count of samples captured before this frame
+            timestamp: capture time in ns since epoch
+            flags: FLAG_OVERFLOW, FLAG_PARAMETERS_CHANGED
+            parameter_version: version of the parameters the frame was captured with
+            sequence: sequence number of the first datagram when it was given by another packetizer (eg. the capture
+                      process of plutosdr_shm), the following frames go on from it
+        '''
+        frame.resize(size)
+        count = len(frame.payloads)
+        if sequence is not None:
+            self.__sequence = sequence
+        frame.sequence, frame.sample_counter, frame.timestamp, frame.flags = self.__sequence, sample_counter, timestamp, flags
+        frame.frequency, frame.rf_bandwidth, frame.sampling_rate, frame.gain = frequency, bandwidth, sampling_rate, gain
+        frame.parameter_version = parameter_version
+        frame.encoded = {}
+        frame.levels = {}
+        self.__sequence = (self.__sequence + count) & 0xffffffff
+        for index in range(count):
+            samples = len(frame.payloads[index]) // 4
+            DATA_HEADER.pack_into(frame.headers[index], 0, b'#', frequency, bandwidth, sampling_rate, gain, samples)
+            DATA_HEADER_V2.pack_into(frame.headers_v2[index], 0, b'$', 2, DATA_HEADER_V2.size, flags, index, count,
+                                     (frame.sequence + index) & 0xffffffff, parameter_version & 0xffffffff,
+                                     sample_counter, timestamp, frequency, bandwidth, sampling_rate, gain, samples)
+            sample_counter += samples
+        return frame.datagrams
+
+
+class FrameQueue():
+    '''
+    Bounded queue of frames, it holds a reference to every queued frame
+    Parameters:
+        capacity: maximum queued frames
+        policy: what to do when full, "drop-oldest", "drop-newest" or "block" (put waits for room)
+    '''
+
+    POLICIES = ('drop-oldest', 'drop-newest', 'block')
+
+    def __init__(self, capacity=32, policy='drop-oldest'):
+        self.__frames = collections.deque()
+        self.__condition = threading.Condition()
+        self.__closed = False
+        self.capacity = 1
+        self.policy = 'drop-oldest'
+        self.dropped = 0
+        self.configure(capacity, policy)
+
+    def configure(self, capacity, policy):
+        '''
+        Change capacity and policy, frames beyond a smaller capacity are dropped (oldest first)
+        '''
+        if policy not in self.POLICIES or capacity < 1:
+            raise ValueError('invalid queue setting: {0}:{1}'.format(policy, capacity))
+        self.__condition.acquire()
+        try:
+            self.capacity, self.policy = capacity, policy
+            while len(self.__frames) > capacity:
+                self.__frames.popleft().release()
+                self.dropped += 1
+            self.__condition.notify_all()
+        finally:
+            self.__condition.release()
+
+    def put(self, frame):
+        '''
+        Queue a frame, return False when it was dropped
+        '''
+        frame.retain()
+        self.__condition.acquire()
+        try:
+            while len(self.__frames) >= self.capacity and not self.__closed:
+                if self.policy == 'drop-oldest':
+                    self.__frames.popleft().release()
+                    self.dropped += 1
+                elif self.policy == 'drop-newest':
+                    self.dropped += 1
+                    frame.release()
+                    return False
+                else:
+                    self.__condition.wait()
+            if self.__closed:
+                frame.release()
+                return False
+            self.__frames.append(frame)
+            if len(self.__frames) == 1:  # consumer may be waiting on an empty queue
+                self.__condition.notify_all()
+            return True
+        finally:
+            self.__condition.release()
+
+    def get(self, timeout=None):
+        '''
+        Take the oldest frame (the caller owns its reference), None when timed out or closed
+        '''
+        self.__condition.acquire()
+        try:
+            if not self.__frames and not self.__closed:
+                self.__condition.wait(timeout)
+            if not self.__frames:
+                return None
+            frame = self.__frames.popleft()
+            if self.policy == 'block':  # producer may be waiting for room
+                self.__condition.notify_all()
+            return frame
+        finally:
+            self.__condition.release()
+
+    def close(self, drain=False):
+        '''
+        Refuse further frames and wake up waiting producers/consumers, queued frames are released
+        or, with drain, left for get which returns None at once when they are gone
+        '''
+        self.__condition.acquire()
+        try:
+            self.__closed = True
+            while self.__frames and not drain:
+                self.__frames.popleft().release()
+            self.__condition.notify_all()
+        finally:
+            self.__condition.release()
+
+    def __len__(self):
+        return len(self.__frames)
+
+
+class Sweep():
+    '''
+    Frequency sweep plan run by the capture thread
+    Parameters:
+        start, stop, step: RX frequencies in Hz, stop is included
+        dwell: samples captured per step, rounded up to whole buffers
+        settle: buffers discarded after every retune
+        fastlock: recall AD9361 fast-lock profiles (stored during the first pass) instead of a full synthesizer tune
+    '''
+
+    # The AD9361 keeps 8 fast-lock profiles, longer sweeps load the saved profile into the slot before recalling it
+    FASTLOCK_SLOTS = 8
+
+    def __init__(self, start, stop, step, dwell, settle=2, fastlock=False):
+        if step <= 0 or stop < start or dwell <= 0 or settle < 0:
+            raise ValueError('invalid sweep: {0}:{1}:{2}:{3}:{4}'.format(start, stop, step, dwell, settle))
+        self.start, self.stop, self.step, self.dwell, self.settle, self.fastlock = start, stop, step, dwell, settle, fastlock
+        self.count = (stop - start) // step + 1
+        self.index = -1
+        self.remaining = 0  # samples still to capture at the current step
+        self.version = 0    # parameter version the current step was tuned with
+        self.steps = 0
+        self.began = time.perf_counter()
+        self.profiles = {}  # frequency -> saved fast-lock profile
+
+    def next_frequency(self):
+        self.index = (self.index + 1) % self.count
+        self.steps += 1
+        return self.start + self.index * self.step
+
+    def statistics(self):
+        elapsed = time.perf_counter() - self.began
+        return {'start': self.start, 'stop': self.stop, 'step': self.step, 'dwell': self.dwell, 'settle': self.settle,
+                'fastlock': self.fastlock, 'steps': self.steps, 'steps_per_second': self.steps / elapsed if elapsed else 0.0}
+
 
 class DeviceService():
     '''
     Adalm-Pluto based on AD9361 manufactured by ADI
     '''
 
-    def __init__(self, sampling_count=2048, context='ip:192.168.2.1'):
+    def __init__(self, sampling_count=2048, context='ip:192.168.2.1', backend=None, ring_size=16, poll_interval=0.5,
+                 kernel_buffers=4, state_path=None, connect_timeout=10.0):
         '''
         Initialization
         Paramters:
             handler: when I/Q data get ready, there requires a callback to send data
-            sampling_count: I/Q sampling count, default value: 2048,
-            context: device context, there requires ip address,
+            sampling_count: I/Q sampling count, default value: 2048, see set_buffer to change it at runtime
+            context: device context, there requires ip address, or "sim:" for a simulated device
+            backend: device backend, picked by the scheme of context when it is None
+            ring_size: frames buffered between capture and dispatch, the oldest is dropped when full
+            poll_interval: seconds between readbacks of gain (AGC) and overflow status
+            kernel_buffers: number of buffers queued by the kernel driver before samples are lost
+            state_path: JSON file the parameters set are persisted to and restored from (None for none)
+            connect_timeout: seconds spent connecting here, the capture thread keeps trying afterwards
         '''
 
         sys.stdout.write('Initialize Adalm-Pluto (based on AD936x) ...\n')
@@ -63,240 +519,1177 @@ class DeviceService():
             'frequency': (0, [101700000, (70000000, 1, 6000000000)]),  # RX frequency
             'rf_bandwidth': (4, [2000000, (200000, 1, 56000000)]),   # RX bandwidth
             # 'sampling_frequency': (4, [2500000, (2083333, 1, 61440000)]),
-            'sampling_frequency': (4, [2500000, (521000, 1, 61440000)]),  # Sampling Rate
-            'gain_control_mode': (4, ['manual', ('manual,fast_attack,slow_attack,hybrid')]),  # Gain control
+            'sampling_frequency': (4, [2560000, (521000, 1, 61440000)]),  # Sampling Rate
+            'gain_control_mode': (4, ['slow_attack', ('manual,fast_attack,slow_attack,hybrid')]),  # Gain control
             'hardwaregain': (4, [-3, (-3, 1, 71)]),  # MGC
             'tx_enabled': (1, ['false', ('true,false')]),  # TX RF out
             'tx_frequency': (1, [101700000, (70000000, 1, 6000000000)]),  # TX frequency
             'tx_hardwaregain': (5, [0, (-89, 1, 0)])  # TX MGC
         }
         self.__callback = None
+        self.__sinks = ()  # further sinks (eg. Recorder), replaced as a whole on change
         self.__capture = None
+        self.__dispatch = None
+        self.__packetizer = Packetizer(sampling_count, frames=ring_size + 4)
+        self.__ring = FrameQueue(ring_size, 'drop-oldest')
+        self.__sample_counter = 0        # samples captured since the service was created
+        self.__snapshot = ParameterSnapshot(0, 101700000, 2000000, 2560000, -3)
+        self.__overflow_check = True     # disabled when the backend cannot read the RX status register
+        self.__overflows = 0             # overflows seen by the poller
+        self.__overflow_sample = -1      # sample counter when the poller last saw one (the loss is before it)
+        self.__errors = collections.Counter()  # exceptions by thread, also printed
+        self.__histograms = {name: Histogram() for name in (
+            'refill', 'read', 'packetize', 'dispatch', 'parameter_lock_wait', 'parameter_apply')}
+        self.__applied = (-1, -1, -1)    # version, sequence and sample counter of the last retuned frame
+        self.__applied_condition = threading.Condition()
+        self.__sweep = None
+        self.__sampling_count = sampling_count
+        self.__kernel_buffers = kernel_buffers
+        self.__auto_latency = None      # target latency (seconds) of the automatic buffer size, None when fixed
+        self.__buffer_request = None    # (sampling_count, kernel_buffers, event) applied by the capture thread
+        self.__buffer_rebuilds = 0
+        self.__poll = None
+        self.__poll_interval = poll_interval
         self.__start_sampling = False
         self.__lock = threading.Lock()
+        self.__sampling_event = threading.Event()
         self.__abort_sampling_event = threading.Event()
         self.__abort_sampling_event.clear()
+        self.__backend = backend
+        self.__context = context
+        self.__ctx = None
+        self.__ctrl = None
+        self.__rx = None
+        self.__buffer = None
+        self.__connected = False
+        self.__reconnects = 0
+        self.__state_path = state_path
+        self.__state_lock = threading.Lock()
+        self.__persisted = self.__load_state()  # {name: value} set since the first start, restored on connect
+
+        if self.__backend is None:  # a missing libiio/libad9361 is raised to the caller, retrying cannot help
+            self.__backend = create_backend(context)
+        self.__connect(connect_timeout)
+
+    def __connect(self, timeout=None):
+        '''
+        Open the device, retrying with exponential backoff until it succeeds, timeout seconds passed (None for ever)
+        or the service is released
+        Return: True when connected
+        '''
+        delay = RECONNECT_DELAY[0]
+        deadline = None if timeout is None else time.perf_counter() + timeout
+        while True:
+            try:
+                self.__open()
+                return True
+            except (KeyboardInterrupt, SystemExit):
+                raise
+            except Exception as error:
+                if deadline is not None and time.perf_counter() + delay > deadline:
+                    sys.stdout.write('Device context \"{0}\" is not available ({1}).\n'.format(self.__context, error))
+                    return False
+                sys.stdout.write('Device context \"{0}\" is not available ({1}), retry in {2:g}s.\n'.format(
+                    self.__context, error, delay))
+            if self.__abort_sampling_event.wait(delay):
+                return False
+            delay = min(delay * 2, RECONNECT_DELAY[1])
+
+    def __open(self):
+        '''
+        Create the device context, initialize it, write the parameters set so far and create the RX buffer
+        '''
+        # Create device context
+        ctx = self.__backend.create_context(self.__context)
+        sys.stdout.write(('Initialize device context.\n'))
+
+        # Initialize device control
+        # channel 0, 4 are manipulated by rx
+        # channel 1, 5 are manipulated by tx
+        ctrl = ctx.find_device('ad9361-phy')
+
+        # Initialize RX/TX ctrl parameters
+        ctrl.channels[0].attrs['powerdown'].value = '1'
+        ctrl.channels[0].attrs['frequency'].value = '101700000'
+        ctrl.channels[4].attrs['rf_bandwidth'].value = '2000000'
+        ctrl.channels[4].attrs['gain_control_mode'].value = 'slow_attack'
+        ctrl.channels[4].attrs['rf_port_select'].value = 'A_BALANCED'
+        ctrl.channels[1].attrs['powerdown'].value = '1'
+        ctrl.channels[1].attrs['frequency'].value = '101700000'
+        ctrl.channels[5].attrs['rf_bandwidth'].value = '2000000'
+        ctrl.channels[5].attrs['hardwaregain'].value = '0'
+        self.__backend.set_bb_rate(ctrl, 2560000)
+        sys.stdout.write('Initialize CTRL: \"ad9361-phy\".\n')
+
+        # Initialize device receiving channels and enable I/Q data output channels
+        rx = ctx.find_device('cf-ad9361-lpc')
+        sys.stdout.write('Initialize RX: \"cf-ad9361-lpc\".\n')
+        rx.channels[0].enabled = True   # I data channel
+        rx.channels[1].enabled = True   # Q data channel
+        sys.stdout.write('Enable RX I/Q channels.\n')
+
+        self.__lock.acquire()
+        try:
+            self.__ctx, self.__ctrl, self.__rx = ctx, ctrl, rx
+            # Parameters set before (or persisted by a previous run) override the defaults above
+            for name in PARAMETER_ORDER:
+                if name in self.__persisted:
+                    self.__write_parameter(name, self.__persisted[name])
+                    self.__parameters[name][1][0] = self.__persisted[name]
+            if self.__persisted:
+                sys.stdout.write('Restore device parameters: {0}\n'.format(
+                    ', '.join('{0}={1}'.format(name, value) for name, value in sorted(self.__persisted.items()))))
+
+            # Initialize buffer
+            self.__buffer = None
+            self.__create_buffer(self.__sampling_count, self.__kernel_buffers)
+            sys.stdout.write('Initialize I/Q data buffers (sampling count={0}).\n'.format(self.__sampling_count))
+
+            self.__publish(gain=self.__read_gain())
+            self.__connected = True
+        except:
+            self.__ctx, self.__ctrl, self.__rx, self.__buffer = None, None, None, None
+            raise
+        finally:
+            self.__lock.release()
+
+    def __disconnect(self):
+        '''
+        Drop the context of a lost device, the capture thread reconnects it
+        '''
+        self.__lock.acquire()
+        try:
+            self.__connected = False
+            self.__buffer = None
+            self.__ctx, self.__ctrl, self.__rx = None, None, None
+        finally:
+            self.__lock.release()
+        sweep = self.__sweep
+        if sweep:
+            sweep.profiles.clear()  # fast-lock profiles are lost with the device
+        sys.stdout.write('Device context \"{0}\" lost, reconnecting.\n'.format(self.__context))
+
+    def __load_state(self):
+        '''
+        Read the persisted parameters, invalid values are left out
+        '''
+        if not self.__state_path or not os.path.exists(self.__state_path):
+            return {}
+        try:
+            with open(self.__state_path) as fd:
+                state = json.load(fd)
+            parameters = {}
+            for name, value in state.get('parameters', {}).items():
+                if name not in RX_PARAMETERS:  # TX is never turned on by a restart
+                    continue
+                result = self.__validate(name, value)
+                if result is not None:
+                    parameters[name] = result
+            sys.stdout.write('Load device parameters from \"{0}\"\n'.format(self.__state_path))
+            return parameters
+        except:
+            traceback.print_exc()
+            return {}
+
+    def __save_state(self, parameters):
+        '''
+        Persist the RX parameters set (TX ones are only restored on reconnection), written to a temporary file first
+        so a crash never leaves a partial file
+        '''
+        if not self.__state_path:
+            return
+        self.__state_lock.acquire()
+        try:
+            directory = os.path.dirname(self.__state_path)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            temporary = self.__state_path + '.tmp'
+            with open(temporary, 'w') as fd:
+                json.dump({'context': self.__context, 'parameters': parameters}, fd, indent=2, sort_keys=True)
+            os.replace(temporary, self.__state_path)
+        except:
+            traceback.print_exc()
+        finally:
+            self.__state_lock.release()
+
+    def start(self):
+        '''
+        Start data sampling
+        '''
+        sys.stdout.write('Starting device service...\n')
+        if self.__capture is None:
+            self.__dispatch = threading.Thread(target=self.__dispatch_data, name='dispatch')
+            self.__dispatch.daemon = True
+            self.__dispatch.start()
+            self.__poll = threading.Thread(target=self.__poll_status, name='poll')
+            self.__poll.daemon = True
+            self.__poll.start()
+            self.__capture = threading.Thread(target=self.__capture_data, name='capture')
+            self.__capture.daemon = True
+            self.__capture.start()
+            sys.stdout.write('Set new sampling thread.\n')
+        self.__lock.acquire()
+        self.__start_sampling = True
+        self.__sampling_event.set()
+        self.__lock.release()
+        sys.stdout.write('Device service started.\n')
+
+    def stop(self):
+        '''
+        Stop data sampling
+        '''
+        sys.stdout.write('Stopping device service...\n')
+        self.__lock.acquire()
+        self.__start_sampling = False
+        self.__sampling_event.clear()
+        self.__lock.release()
+        sys.stdout.write('Device service stopped.\n')
+
+    def release(self):
+        '''
+        Release resources(threads) attached to this object
+        '''
+        try:
+            self.__abort_sampling_event.set()
+            if self.__capture:
+                self.__capture.join()
+                self.__capture = None
+                sys.stdout.write('Sampling thread terminated.\n')
+            self.__ring.close()
+            if self.__dispatch:
+                self.__dispatch.join()
+                self.__dispatch = None
+            if self.__poll:
+                self.__poll.join()
+                self.__poll = None
+            self.__buffer = None
+            self.__ctx = None  # Delete the device context
+            sys.stdout.write('Device context deleted.\n')
+        except:
+            traceback.print_exc()
+
+    def set_parameter(self, name, value):
+        '''
+        Modify paramter whether the task is running or not
+        Parameters:
+            name: name of parameter
+            value: value of paramter
+        '''
+        self.set_parameters([(name, value)])
+
+    def set_parameters(self, parameters):
+        '''
+        Apply a batch of parameters as one transaction: values are validated first, unchanged values are skipped,
+        writes are ordered so that the baseband rate is set once, and one new snapshot is published
+        Parameters:
+            parameters: (name, value) pairs in request order, a later value of the same name wins,
+                        and a sampling_frequency after rf_bandwidth overrides the rate derived from the bandwidth
+        Return: (parameter version, seconds spent applying, names written)
+        '''
+        begin = time.perf_counter()
+        written = []
+        persisted = None
+        try:
+            self.__lock.acquire()
+            self.__histograms['parameter_lock_wait'].observe(time.perf_counter() - begin)
+            pending = {}
+            rate = None
+            for name, value in parameters:
+                result = self.__validate(name, value)
+                if result is None:
+                    continue
+                if name == 'sampling_frequency':
+                    rate = result
+                    continue
+                if name == 'rf_bandwidth' and result != self.__parameters[name][1][0]:
+                    rate = int(result * 1.28) if result >= 500000 else 521000
+                    # # when rf_bandwidth is set to 1MHz or 5MHz, sampling_frequency will be set to 13.5MHz
+                    # if result in (1000000L, 5000000L):
+                    #     sampling_frequency = 13500000L
+                pending[name] = result
+            if rate is not None:
+                pending['sampling_frequency'] = self.__validate('sampling_frequency', rate)
+
+            for name in PARAMETER_ORDER:
+                if name not in pending or pending[name] == self.__parameters[name][1][0]:
+                    continue
+                result = pending[name]
+                if self.__connected:  # else written when the device is back
+                    self.__write_parameter(name, result)
+                self.__parameters[name][1][0] = result
+                self.__persisted[name] = result
+                written.append(name)
+                sys.stdout.write('Set device parameter: \"{0}\" to {1} on channel: {2}\n'.format(name, result, self.__parameters[name][0]))
+        except:
+            traceback.print_exc()
+        finally:
+            try:
+                if any(name in RX_PARAMETERS for name in written):
+                    persisted = dict((name, value) for name, value in self.__persisted.items() if name in RX_PARAMETERS)
+                if 'gain_control_mode' in written and self.__connected:
+                    self.__publish(gain=self.__read_gain(), retune=True)
+                elif written:
+                    self.__publish(gain=self.__parameters['hardwaregain'][1][0] if 'hardwaregain' in written else None,
+                                   retune=any(name in RX_PARAMETERS for name in written))
+            except:
+                traceback.print_exc()
+            self.__lock.release()
+        if persisted:
+            self.__save_state(persisted)
+        if 'sampling_frequency' in written and self.__auto_latency:
+            self.__request_buffer(*self.auto_buffer(self.__parameters['sampling_frequency'][1][0], self.__auto_latency))
+        elapsed = time.perf_counter() - begin
+        self.__histograms['parameter_apply'].observe(elapsed)
+        return self.__snapshot.version, elapsed, written
+
+    def set_buffer(self, sampling_count=None, kernel_buffers=None, timeout=2.0):
+        '''
+        Rebuild the RX buffer with another sampling count and/or kernel buffer count (None keeps the current one),
+        it also leaves auto mode. The capture thread swaps buffers between two refills, the first frame
+        captured after it is flagged FLAG_OVERFLOW as samples are lost meanwhile
+        Return: (sampling count, kernel buffers) in effect, the request is still pending when the capture thread
+                did not get to it within timeout
+        '''
+        self.__auto_latency = None
+        return self.__request_buffer(sampling_count or self.__sampling_count, kernel_buffers or self.__kernel_buffers,
+                                     timeout)
+
+    def set_buffer_auto(self, latency=0.02, timeout=2.0):
+        '''
+        Size the RX buffer from the sampling rate: a refill holds about latency seconds of samples and the kernel
+        buffers absorb AUTO_BUFFER_HEADROOM seconds of host stalls. Sizes follow later sampling rate changes
+        '''
+        self.__auto_latency = latency
+        return self.__request_buffer(*self.auto_buffer(self.__parameters['sampling_frequency'][1][0], latency),
+                                     timeout=timeout)
+
+    @staticmethod
+    def auto_buffer(rate, latency):
+        '''
+        (sampling count, kernel buffers) for a sampling rate and a target latency, the count is a power of 2
+        '''
+        count = SAMPLING_COUNT_RANGE[0]
+        while count < rate * latency and count < SAMPLING_COUNT_RANGE[1]:
+            count *= 2
+        kernel_buffers = int(AUTO_BUFFER_HEADROOM * rate / count) + 1
+        return count, min(max(kernel_buffers, 4), KERNEL_BUFFERS_RANGE[1])
+
+    def buffer_settings(self):
+        '''
+        Sampling count, kernel buffers, auto latency (None when fixed) and rebuild count
+        '''
+        return {'sampling_count': self.__sampling_count, 'kernel_buffers': self.__kernel_buffers,
+                'auto_latency': self.__auto_latency, 'rebuilds': self.__buffer_rebuilds}
+
+    def __request_buffer(self, sampling_count, kernel_buffers, timeout=0):
+        '''
+        Queue a buffer rebuild for the capture thread (or apply it at once when it is not running),
+        a request still pending is replaced and its caller returns at once
+        '''
+        sampling_count = min(max(int(sampling_count), SAMPLING_COUNT_RANGE[0]), SAMPLING_COUNT_RANGE[1])
+        kernel_buffers = min(max(int(kernel_buffers), KERNEL_BUFFERS_RANGE[0]), KERNEL_BUFFERS_RANGE[1])
+        if (sampling_count, kernel_buffers) == (self.__sampling_count, self.__kernel_buffers):
+            previous = self.__replace_buffer_request(None)
+            if previous:
+                previous[2].set()
+            return sampling_count, kernel_buffers
+        if self.__capture is None:
+            self.__rebuild_buffer(sampling_count, kernel_buffers)
+            return sampling_count, kernel_buffers
+        event = threading.Event()
+        previous = self.__replace_buffer_request((sampling_count, kernel_buffers, event))
+        if previous:
+            previous[2].set()
+        self.__sampling_event.set()  # wake the capture thread up when sampling is off
+        if timeout:
+            event.wait(timeout)
+        return self.__sampling_count, self.__kernel_buffers
+
+    def __replace_buffer_request(self, request):
+        '''
+        Swap the pending buffer request for request (None to take it), the capture thread and callers swap it
+        under the lock so that no request is lost in between
+        Return: the previous request, whose event is set by the one who took it
+        '''
+        self.__lock.acquire()
+        previous, self.__buffer_request = self.__buffer_request, request
+        self.__lock.release()
+        return previous
+
+    def __create_buffer(self, sampling_count, kernel_buffers):
+        try:
+            self.__backend.set_kernel_buffers(self.__rx, kernel_buffers)
+        except:
+            sys.stdout.write('Kernel buffer count is not settable, keeping the default.\n')
+        self.__buffer = self.__backend.create_buffer(self.__rx, sampling_count, False)
+
+    def __rebuild_buffer(self, sampling_count, kernel_buffers):
+        '''
+        Destroy the RX buffer (a device has one at a time) and create it again, back to the previous
+        settings when the new ones fail
+        '''
+        previous = (self.__sampling_count, self.__kernel_buffers)
+        self.__buffer = None  # destroyed here, the capture thread holds no other reference
+        if self.__connected:  # else created with these settings on reconnection
+            try:
+                self.__create_buffer(sampling_count, kernel_buffers)
+            except:
+                traceback.print_exc()
+                sampling_count, kernel_buffers = previous
+                self.__create_buffer(sampling_count, kernel_buffers)
+        self.__packetizer.resize(sampling_count)
+        self.__sampling_count, self.__kernel_buffers = sampling_count, kernel_buffers
+        self.__buffer_rebuilds += 1
+        sys.stdout.write('Rebuild I/Q data buffer (sampling count={0}, kernel buffers={1}).\n'.format(
+            sampling_count, kernel_buffers))
+
+    def start_sweep(self, start, stop, step, dwell, settle=2, fastlock=False):
+        '''
+        Sweep RX frequency from start to stop (repeatedly) while sampling is on, every step retunes,
+        discards settle buffers and streams dwell samples tagged with FLAG_SWEEP and the step frequency
+        '''
+        start = self.__validate('frequency', start)
+        stop = self.__validate('frequency', stop)
+        self.__sweep = Sweep(start, stop, step, dwell, settle, fastlock)
+        sys.stdout.write('Start sweep {0}~{1}Hz step {2}Hz, {3} samples per step.\n'.format(start, stop, step, dwell))
+
+    def stop_sweep(self):
+        if self.__sweep:
+            sys.stdout.write('Stop sweep after {0} steps.\n'.format(self.__sweep.steps))
+        self.__sweep = None
+
+    def sweep_statistics(self):
+        '''
+        Plan and achieved steps/second of the running sweep, None when not sweeping
+        '''
+        sweep = self.__sweep
+        return sweep.statistics() if sweep else None
+
+    def __tune(self, sweep, frequency):
+        '''
+        Retune RX LO for a sweep step, steps are neither logged nor persisted
+        '''
+        channel = self.__ctrl.channels[0]
+        slot = sweep.index % Sweep.FASTLOCK_SLOTS
+        self.__lock.acquire()
+        try:
+            if not sweep.fastlock:
+                self.__write_parameter('frequency', frequency)
+                self.__parameters['frequency'][1][0] = frequency
+                self.__publish(retune=True)
+                return
+            profile = sweep.profiles.get(frequency)
+            if profile is None:  # first pass, full tune and keep the calibration
+                channel.attrs['frequency'].value = str(frequency)
+                channel.attrs['fastlock_store'].value = str(slot)
+                channel.attrs['fastlock_save'].value = str(slot)
+                sweep.profiles[frequency] = channel.attrs['fastlock_save'].value
+            else:
+                if sweep.count > Sweep.FASTLOCK_SLOTS:
+                    channel.attrs['fastlock_load'].value = profile
+                channel.attrs['fastlock_recall'].value = str(slot)
+            self.__parameters['frequency'][1][0] = frequency
+            self.__publish(retune=True)
+        finally:
+            self.__lock.release()
+
+    def wait_applied(self, version, timeout=2.0):
+        '''
+        Wait for the first frame captured with parameter version (or a later one)
+        Return: (sequence number, sample counter) of its first datagram, (-1, -1) when not sampling or timed out
+        '''
+        deadline = time.perf_counter() + timeout
+        self.__applied_condition.acquire()
+        try:
+            while self.__applied[0] < version:
+                remaining = deadline - time.perf_counter()
+                if not self.__start_sampling or remaining <= 0:
+                    return -1, -1
+                self.__applied_condition.wait(remaining)
+            return self.__applied[1], self.__applied[2]
+        finally:
+            self.__applied_condition.release()
+
+    def __validate(self, name, value):
+        '''
+        Clamp an integer into its range or check a string against its enumerates, None when invalid
+        '''
+        if name not in self.__parameters:
+            return None
+        if isinstance(value, (int, )):
+            start, _, stop = self.__parameters[name][1][1]
+            if value < start:
+                return start
+            elif value > stop:
+                return stop
+            return value
+        elif isinstance(value, str):
+            if value in self.__parameters[name][1][1].split(','):
+                return value
+        return None
+
+    def __write_parameter(self, name, result):
+        '''
+        Write one validated parameter to the device
+        '''
+        chn_idx = self.__parameters[name][0]
+        if chn_idx == 1 or chn_idx == 5:  # TX channel parameters:
+            if name == 'tx_enabled':
+                self.__ctrl.channels[0].attrs['powerdown'].value = '1' if str(result) == 'true' else '0'
+                self.__ctrl.channels[chn_idx].attrs['powerdown'].value = '0' if str(result) == 'true' else '1'
+            elif name == 'tx_frequency':
+                self.__ctrl.channels[chn_idx].attrs['frequency'].value = str(result)
+            elif name == 'tx_hardwaregain':
+                self.__ctrl.channels[chn_idx].attrs['hardwaregain'].value = str(result)
+        else:  # RX channel parameters
+            if name == 'sampling_frequency':
+                self.__backend.set_bb_rate(self.__ctrl, result)
+            else:
+                self.__ctrl.channels[chn_idx].attrs[name].value = str(result)
+                if name == 'rf_bandwidth':
+                    self.__ctrl.channels[chn_idx+1].attrs[name].value = str(result)
+
+    def set_data_sinker(self, callback):
+        '''
+        Set data sinker, it is called from the dispatch thread with a Frame per refill,
+        the sinker retains the frame (FrameQueue.put does) to keep it beyond the call
+        '''
+        self.__callback = callback
+        sys.stdout.write('Set data callback handler <{0}>\n'.format(id(callback)))
+
+    def set_packetizer(self, packetizer):
+        '''
+        Capture into the frames of packetizer (eg. slots of a shared memory ring, see plutosdr_shm), None for
+        frames of the service's own. It is resized with the RX buffer
+        '''
+        if packetizer is None:
+            packetizer = Packetizer(self.__sampling_count, frames=self.__ring.capacity + 4)
+        else:
+            packetizer.resize(self.__sampling_count)
+        self.__packetizer = packetizer
+
+    def add_data_sink(self, callback):
+        '''
+        Add a sink called after the data sinker, same contract as set_data_sinker
+        '''
+        self.__sinks = self.__sinks + (callback,)
+
+    def remove_data_sink(self, callback):
+        self.__sinks = tuple(sink for sink in self.__sinks if sink != callback)
+
+    def statistics(self):
+        '''
+        Counters of the capture/dispatch ring, buffer settings and device connection
+        '''
+        return {'ring_depth': len(self.__ring), 'ring_size': self.__ring.capacity, 'ring_dropped': self.__ring.dropped,
+                'frames_allocated': self.__packetizer.allocated, 'sampling_count': self.__sampling_count,
+                'kernel_buffers': self.__kernel_buffers, 'buffer_rebuilds': self.__buffer_rebuilds,
+                'connected': int(self.__connected), 'reconnects': self.__reconnects}
+
+    def metrics(self):
+        '''
+        Counters and latency histograms of the capture path, see plutosdr_stats.prometheus_text
+        '''
+        metrics = {'captured_samples': self.__sample_counter, 'overflows': self.__overflows,
+                   'overflow_sample': self.__overflow_sample,
+                   'parameter_version': self.__snapshot.version}
+        for name, value in self.statistics().items():
+            metrics[name] = value
+        for name in ('capture', 'dispatch', 'poll'):
+            metrics[name + '_errors'] = self.__errors[name]
+        for name, histogram in self.__histograms.items():
+            metrics[name + '_seconds'] = histogram
+        return metrics
+
+    @property
+    def sampling_count(self):
+        return self.__sampling_count
+
+    @property
+    def snapshot(self):
+        '''
+        Current ParameterSnapshot
+        '''
+        return self.__snapshot
+
+    def set_poll_interval(self, interval):
+        '''
+        Set seconds between readbacks of gain and overflow status
+        '''
+        self.__poll_interval = max(0.01, interval)
+        sys.stdout.write('Set poll interval to {0}s\n'.format(self.__poll_interval))
+
+    def __publish(self, gain=None, retune=False):
+        '''
+        Swap in a new snapshot, the version is bumped on retune (AGC gain readback is not one)
+        '''
+        snapshot = self.__snapshot
+        self.__snapshot = ParameterSnapshot(snapshot.version + 1 if retune else snapshot.version,
+                                            self.__parameters['frequency'][1][0], self.__parameters['rf_bandwidth'][1][0],
+                                            self.__parameters['sampling_frequency'][1][0],
+                                            snapshot.gain if gain is None else gain)
+
+    def __read_gain(self):
+        return int(float(self.__ctrl.channels[4].attrs['hardwaregain'].value.split()[0]))
+
+    def __read_overflow(self):
+        '''
+        Read and clear the overflow status of the RX core
+        '''
+        if not self.__overflow_check:
+            return False
+        try:
+            return self.__backend.read_overflow(self.__rx)
+        except:
+            self.__overflow_check = False
+            sys.stdout.write('RX status register is not readable, overflow detection disabled.\n')
+            return False
+
+    def __poll_status(self):
+        '''
+        Poll thread, reads back AGC gain and overflow status so that the capture loop does no IIO I/O besides refill.
+        A register read per refill would cost a round trip on network contexts, so overflows are placed approximately:
+        the loss happened since the previous poll, the next refill is flagged
+        '''
+        while not self.__abort_sampling_event.wait(self.__poll_interval):
+            if not self.__start_sampling or not self.__connected:
+                continue
+            try:
+                if self.__read_overflow():
+                    self.__overflow_sample = self.__sample_counter
+                    self.__overflows += 1
+                gain = self.__read_gain()
+                if gain != self.__snapshot.gain:
+                    self.__lock.acquire()
+                    try:
+                        self.__publish(gain=gain)
+                    finally:
+                        self.__lock.release()
+            except:
+                self.__errors['poll'] += 1
+                traceback.print_exc()
+
+    def __dispatch_data(self):
+        '''
+        Dispatch thread, hands captured frames to the data sinker so that capture never waits on consumers
+        '''
+        while not self.__abort_sampling_event.is_set():
+            frame = self.__ring.get(0.5)
+            if frame is None:
+                continue
+            begin = time.perf_counter()
+            try:
+                if self.__callback:
+                    self.__callback(frame)
+                for sink in self.__sinks:
+                    sink(frame)
+            except:
+                self.__errors['dispatch'] += 1
+                traceback.print_exc()
+            finally:
+                frame.release()
+                self.__histograms['dispatch'].observe(time.perf_counter() - begin)
+
+    def __capture_data(self):
+        '''
+        Sample data thread
+        '''
+        sys.stdout.write('Sampling thread has get ready.\n')
+        snapshot = self.__snapshot       # parameters stamped into the next frame
+        captured_version = snapshot.version
+        published_version = snapshot.version
+        stale = 0                        # refills queued by the device before the last change, stamped as before it
+        overflows = self.__overflows
+        failures = 0  # consecutive capture errors
+        refill_time, read_time, packetize_time = (self.__histograms[name] for name in ('refill', 'read', 'packetize'))
+        while not self.__abort_sampling_event.is_set():
+            if not self.__connected or failures >= RECONNECT_ERRORS:
+                # Lost device: rebuild context and buffer in place, clients stay connected meanwhile
+                if self.__connected:
+                    self.__disconnect()
+                failures = 0
+                if self.__connect():
+                    self.__reconnects += 1
+                    stale = 0
+                    overflows = -1  # flag the next frame, samples were lost while disconnected
+                    sys.stdout.write('Device context \"{0}\" reconnected.\n'.format(self.__context))
+                continue
+            request = self.__buffer_request and self.__replace_buffer_request(None)
+            if request:
+                try:
+                    self.__rebuild_buffer(request[0], request[1])
+                    stale = 0  # a new buffer holds nothing captured before
+                    overflows = -1  # flag the next frame, samples were lost while rebuilding
+                except:
+                    self.__errors['capture'] += 1
+                    traceback.print_exc()
+                self.__lock.acquire()
+                if not self.__start_sampling:
+                    self.__sampling_event.clear()
+                self.__lock.release()
+                request[2].set()
+            # Fill the buffer and read data from it, header fields come from the snapshot (no lock, no IIO I/O),
+            # so parameter updates never wait behind a refill
+            if not self.__start_sampling:
+                self.__sampling_event.wait(0.5)
+                continue
+            sweep = self.__sweep
+            if sweep and sweep.remaining <= 0:
+                try:
+                    self.__tune(sweep, sweep.next_frequency())
+                    published_version = sweep.version = self.__snapshot.version
+                    # Settling also discards the refills the kernel queued at the previous step
+                    for _ in range(max(sweep.settle, self.__backend.stale_refills(self.__kernel_buffers))):
+                        self.__buffer.refill()
+                        self.__sample_counter += self.__sampling_count
+                    stale = 0
+                    sweep.remaining = sweep.dwell
+                except (KeyboardInterrupt, SystemExit):
+                    raise
+                except:
+                    self.__errors['capture'] += 1
+                    failures += 1
+                    traceback.print_exc()
+                    continue
+            # Buffers the kernel queued before a retune hold samples of the previous settings, the change
+            # (FLAG_PARAMETERS_CHANGED, acknowledged sample) is stamped on the first refill captured after it
+            latest = self.__snapshot
+            if latest.version != published_version:
+                published_version = latest.version
+                stale = self.__backend.stale_refills(self.__kernel_buffers)
+            if stale <= 0 or latest.version == snapshot.version:
+                snapshot = latest
+            frame = None
+            try:
+                begin = time.perf_counter()
+                self.__buffer.refill()
+                stale = max(stale - 1, 0)
+                refilled = time.perf_counter()
+                timestamp = time.time_ns()
+                frame = self.__packetizer.acquire()
+                size = self.__backend.read_into(self.__buffer, frame.buffer)
+                read = time.perf_counter()
+                refill_time.observe(refilled - begin)
+                read_time.observe(read - refilled)
+            except (KeyboardInterrupt, SystemExit):
+                raise
+            except:
+                if frame:
+                    frame.release()
+                self.__errors['capture'] += 1
+                failures += 1
+                traceback.print_exc()
+                continue
+            failures = 0
+            if not size:  # nothing received (eg. end of a replayed recording)
+                frame.release()
+                continue
+            flags = 0
+            if overflows != self.__overflows:
+                overflows = self.__overflows
+                flags |= FLAG_OVERFLOW
+            if captured_version != snapshot.version:
+                captured_version = snapshot.version
+                flags |= FLAG_PARAMETERS_CHANGED
+            if sweep and snapshot.version >= sweep.version:  # frames of a previous step count toward no dwell
+                flags |= FLAG_SWEEP
+                sweep.remaining -= size // 4
+            self.__packetizer.packetize(frame, size, snapshot.frequency, snapshot.rf_bandwidth, snapshot.sampling_frequency,
+                                        snapshot.gain, self.__sample_counter, timestamp, flags, snapshot.version)
+            packetize_time.observe(time.perf_counter() - read)
+            if flags & FLAG_PARAMETERS_CHANGED:
+                self.__applied_condition.acquire()
+                self.__applied = (snapshot.version, frame.sequence, frame.sample_counter)
+                self.__applied_condition.notify_all()
+                self.__applied_condition.release()
+            self.__sample_counter += size // 4
+            self.__ring.put(frame)  # never waits, the oldest frame is dropped when dispatch falls behind
+            frame.release()
+
+
+class ChannelPipeline():
+    '''
+    Digital down-conversion stage run on the dispatch thread, shared by every client asking for the same channel
+    Output frames carry int16 I/Q at the decimated rate, their headers give the channel center and output rate,
+    and the sample counter counts output samples: it restarts from the input counter divided by the decimation
+    whenever the input does not follow the previous frame, so input gaps are output gaps
+    Parameters:
+        sampling_count: I/Q sampling count of input frames (output frames are never larger)
+        offset: channel center relative to the RX LO (Hz)
+        rate: requested output sampling rate
+    '''
+
+    def __init__(self, sampling_count, offset, rate):
+        from plutosdr_dsp import DigitalDownConverter  # numpy is only required by processing modes
+        self.key = (offset, rate)
+        self.subscribers = 0
+        self.__ddc = DigitalDownConverter(offset, rate)
+        self.__packetizer = Packetizer(sampling_count)
+        self.__size = sampling_count * 4
+        self.__sample_counter = 0
+        self.__next_input = None  # input sample counter following the previous frame
+
+    def process(self, frame):
+        '''
+        Down-convert a frame, return the output frame (one reference owned by the caller) or None
+        '''
+        if frame.size > self.__size:  # device buffer rebuilt larger
+            self.__size = frame.size
+            self.__packetizer.resize(frame.size // 4)
+        contiguous = frame.sample_counter == self.__next_input
+        self.__next_input = frame.sample_counter + frame.size // 4
+        output = self.__packetizer.acquire()
+        try:
+            size = self.__ddc.process(frame, output.buffer)  # filter state is reset on a gap
+        except:
+            output.release()
+            raise
+        if not contiguous:
+            self.__sample_counter = frame.sample_counter // self.__ddc.decimation
+        if not size:
+            output.release()
+            return None
+        rate = self.__ddc.output_rate()
+        self.__packetizer.packetize(output, size, frame.frequency + self.__ddc.offset, int(rate * 0.8), rate, frame.gain,
+                                    self.__sample_counter, frame.timestamp, frame.flags, frame.parameter_version)
+        self.__sample_counter += size // 4
+        return output
+
+
+class RecordFramer():
+    '''
+    Turn frames into the length prefixed records of a stream (TCP) data channel,
+    a gap record goes before any frame which does not follow the previous one
+    '''
+
+    def __init__(self):
+        self.next_sample = None
+        self.gaps = 0
+
+    def append(self, buffers, frame, datagrams):
+        '''
+        Append the records of a frame (its datagrams) to buffers
+        '''
+        if self.next_sample is not None and frame.sample_counter > self.next_sample:
+            buffers.append(RECORD_LENGTH.pack(GAP_RECORD.size))
+            buffers.append(GAP_RECORD.pack(b'!', self.next_sample, frame.sample_counter - self.next_sample))
+            self.gaps += 1
+        self.next_sample = frame.sample_counter + frame.size // 4
+        for header, payload in datagrams:
+            buffers.append(RECORD_LENGTH.pack(len(header) + len(payload)))
+            buffers.append(header)
+            buffers.append(payload)
+
+
+def forward_frame(client, frame):
+    '''
+    Queue a frame to a data client, through its squelch when it has one
+    Return: squelch notifications (bytes lines) for the client's control connection
+    '''
+    squelch = client.squelch
+    if squelch is None:
+        client.put(frame)
+        return ()
+    for output in squelch.process(frame):
+        client.put(output)
+        output.release()
+    notifications = []
+    while squelch.events:
+        event, sample, timestamp, value = squelch.events.popleft()
+        if event == 'open':
+            line = 'burst=open;sample={0};timestamp={1};level={2:.1f}\n'.format(sample, timestamp, value)
+        else:
+            line = 'burst=close;sample={0};timestamp={1};samples={2}\n'.format(sample, timestamp, value)
+        notifications.append(line.encode('ascii'))
+    return notifications
+
+
+class Notifier():
+    '''
+    Lines for the control connection of a client (eg. squelch notifications) queued by the data plane and sent
+    by a thread of this client, started with the first line, so a client which does not read its control
+    connection only blocks itself. The oldest lines are dropped beyond depth
+    Parameters:
+        key: identifier of the client
+        depth: lines queued at most
+    '''
+
+    def __init__(self, key, depth=64):
+        self.key = key
+        self.depth = depth
+        self.dropped = 0
+        self.__lines = collections.deque()
+        self.__condition = threading.Condition()
+        self.__thread = None
+        self.__closed = False
+
+    def put(self, control, line):
+        self.__condition.acquire()
+        try:
+            if self.__closed:
+                return
+            if len(self.__lines) >= self.depth:
+                self.__lines.popleft()
+                self.dropped += 1
+            self.__lines.append((control, line))
+            if self.__thread is None:
+                self.__thread = threading.Thread(target=self.__send, name='notify-{0}'.format(self.key))
+                self.__thread.daemon = True
+                self.__thread.start()
+            self.__condition.notify()
+        finally:
+            self.__condition.release()
+
+    def close(self):
+        '''
+        Drop the queued lines and end the thread (once a send blocked on the connection fails)
+        '''
+        self.__condition.acquire()
+        self.__closed = True
+        self.__lines.clear()
+        self.__condition.notify()
+        self.__condition.release()
+
+    def __send(self):
+        while True:
+            self.__condition.acquire()
+            try:
+                while not self.__lines and not self.__closed:
+                    self.__condition.wait()
+                if self.__closed:
+                    return
+                control, line = self.__lines.popleft()
+            finally:
+                self.__condition.release()
+            try:
+                control.sendall(line)
+            except:
+                traceback.print_exc()
+
 
-        try:
-            # Create device context
-            retry = 10
-            while retry:
-                try:
-                    self.__ctx = iio.Context(context)
-                    break
-                except:
-                    time.sleep(2)
-                    retry -= 1
-                    continue
+def configure_multicast(data_socket, ttl, interface):
+    '''
+    Set TTL and outgoing interface of a socket sending to a multicast group, nothing when ttl is None
+    '''
+    if ttl is None:
+        return
+    data_socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, ttl)
+    data_socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+    if interface:
+        data_socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(interface))
 
-            sys.stdout.write(('Initialize device context.\n'))
-
-            # Initialize device control
-            # channel 0, 4 are manipulated by rx
-            # channel 1, 5 are manipulated by tx
-            self.__ctrl = self.__ctx.find_device('ad9361-phy')
-
-            # Initialize RX/TX ctrl parameters
-            self.__ctrl.channels[0].attrs['powerdown'].value = '1'
-            self.__ctrl.channels[0].attrs['frequency'].value = '101700000'
-            self.__ctrl.channels[4].attrs['rf_bandwidth'].value = '2000000'
-            self.__ctrl.channels[4].attrs['gain_control_mode'].value = 'slow_attack'
-            self.__ctrl.channels[4].attrs['rf_port_select'].value = 'A_BALANCED'
-            self.__ctrl.channels[1].attrs['powerdown'].value = '1'
-            self.__ctrl.channels[1].attrs['frequency'].value = '101700000'
-            self.__ctrl.channels[5].attrs['rf_bandwidth'].value = '2000000'
-            self.__ctrl.channels[5].attrs['hardwaregain'].value = '0'
-            _ad9361_set_bb_rate(self.__ctrl._device, 2560000)
-            sys.stdout.write('Initialize CTRL: \"ad9361-phy\".\n')
-
-            # Initialize device receiving channels and enable I/Q data output channels
-            self.__rx = self.__ctx.find_device('cf-ad9361-lpc')
-            sys.stdout.write('Initialize RX: \"cf-ad9361-lpc\".\n')
-            self.__rx.channels[0].enabled = True   # I data channel
-            self.__rx.channels[1].enabled = True   # Q data channel
-            sys.stdout.write('Enable RX I/Q channels.\n')
 
-            # Initialize buffer
-            self.__buffer = iio.Buffer(self.__rx, sampling_count, False)
-            sys.stdout.write('Initialize I/Q data buffers (sampling count={0}).\n'.format(sampling_count))
-        except:
-            traceback.print_exc()
+class DataClient():
+    '''
+    Data channel of one client: a UDP socket fed by its own bounded frame queue and sender thread,
+    so a slow or blocked consumer only loses its own data
+    Parameters:
+        key: identifier of the client (id of its control socket)
+        depth: queue capacity in frames
+        policy: queue policy when full, see FrameQueue.POLICIES
+    '''
 
-    def start(self):
+    def __init__(self, key, depth=32, policy='drop-oldest'):
+        self.key = key
+        self.__lock = threading.Lock()
+        self.__socket = None
+        self.__framer = None  # RecordFramer of a TCP data channel, None for UDP
+        self.__queue = FrameQueue(depth, policy)
+        self.__sender = None
+        self.__closed = False
+        self.version = 1  # data header version
+        self.ack = False  # reply "ack=..." to parameter requests
+        self.processor = None  # per-client stage turning frames into datagrams (eg. PsdEstimator), None for raw I/Q
+        self.pipeline = None   # shared ChannelPipeline feeding this client, None for the full band
+        self.encoder = None    # SampleEncoder of I/Q payloads, None for 16bit I/Q
+        self.group = None      # (group, port) of the multicast stream this client joined instead of its own UDP
+        self.control = None    # control connection, receives squelch notifications
+        self.sent = 0
+        self.failed = 0
+        self.send_time = Histogram()  # per frame (per batch on TCP)
+        self.__squelch = None
+        self.__notifier = Notifier(key)
+
+    @property
+    def squelch(self):
         '''
-        Start data sampling
+        plutosdr_dsp.Squelch gating this client's frames, None for none. A replaced squelch is closed
         '''
-        sys.stdout.write('Starting device service...\n')
-        if self.__capture is None:
-            self.__capture = threading.Thread(target=self.__capture_data)
-            self.__capture.setDaemon(True)
-            self.__capture.start()
-            sys.stdout.write('Set new sampling thread.\n')
-        self.__lock.acquire()
-        self.__start_sampling = True
-        self.__lock.release()
-        sys.stdout.write('Device service started.\n')
+        return self.__squelch
 
-    def stop(self):
+    @squelch.setter
+    def squelch(self, squelch):
+        previous, self.__squelch = self.__squelch, squelch
+        if previous:
+            previous.close()
+
+    def notify(self, line):
         '''
-        Stop data sampling
+        Queue a line for the control connection, never blocks
         '''
-        sys.stdout.write('Stopping device service...\n')
-        self.__lock.acquire()
-        self.__start_sampling = False
-        self.__lock.release()
-        sys.stdout.write('Device service stopped.\n')
+        if self.control:
+            self.__notifier.put(self.control, line)
 
-    def release(self):
+    def connect(self, host, port, ttl=None, interface=None):
         '''
-        Release resources(threads) attached to this object
+        (Re)open the UDP socket and start the sender thread
+        Paramters:
+            ttl: multicast TTL when host is a multicast group
+            interface: address of the interface multicast is sent from, None for the default route
         '''
-        try:
-            self.__abort_sampling_event.set()
-            if self.__capture:
-                self.__capture.join()
-                self.__capture = None
-                sys.stdout.write('Sampling thread terminated.\n')
-            del self.__ctx  # Delete the device context
-            sys.stdout.write('Device context deleted.\n')
-        except:
-            traceback.print_exc()
+        data_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        data_socket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, True)
+        configure_multicast(data_socket, ttl, interface)
+        data_socket.connect((host, port))
+        self.__attach(data_socket, None)
 
-    def set_parameter(self, name, value):
+    def connect_tcp(self, host, port):
         '''
-        Modify paramter whether the task is running or not
-        Parameters:
-            name: name of parameter
-            value: value of paramter
+        (Re)open the data channel as a TCP connection to the client, records are sent in batches
         '''
-        if name not in self.__parameters:
-            return
-        try:
-            self.__lock.acquire()
-            if value == self.__parameters[name][1][0]:
-                return
+        data_socket = socket.create_connection((host, port), 5)
+        data_socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, TCP_SEND_BUFFER)
+        data_socket.settimeout(None)
+        self.__attach(data_socket, RecordFramer())
 
-            if isinstance(value, (int, )):
-                chn_idx, result, (start, _, stop) = self.__parameters[name][0], self.__parameters[name][1][0], self.__parameters[name][1][1]
-                if value < start:
-                    result = start
-                elif value > stop:
-                    result = stop
-                else:
-                    result = value
-            elif isinstance(value, str):
-                chn_idx, result, enumerates = self.__parameters[name][0], self.__parameters[name][1][0], self.__parameters[name][1][1]
-                if value in enumerates.split(','):
-                    result = value
-                else:
-                    return
-            else:
-                return
-            self.__parameters[name][1][0] = result
-
-            if chn_idx == 1 or chn_idx == 5:  # TX channel parameters:
-                if name == 'tx_enabled':
-                    self.__ctrl.channels[0].attrs['powerdown'].value = '1' if str(result) == 'true' else '0'
-                    self.__ctrl.channels[chn_idx].attrs['powerdown'].value = '0' if str(result) == 'true' else '1'
-                elif name == 'tx_frequency':
-                    self.__ctrl.channels[chn_idx].attrs['frequency'].value = str(result)
-                elif name == 'tx_hardwaregain':
-                    self.__ctrl.channels[chn_idx].attrs['hardwaregain'].value = str(result)
-            else:  # RX channel parameters
-                if name == 'sampling_frequency':
-                    _ad9361_set_bb_rate(self.__ctrl._device, c_ulong(result))
-                else:
-                    self.__ctrl.channels[chn_idx].attrs[name].value = str(result)
-                    if name == 'rf_bandwidth':
-                        self.__ctrl.channels[chn_idx+1].attrs[name].value = str(result)
-                        sampling_frequency = int(result * 1.28) if result >= 500000 else 521000
-                        # # when rf_bandwidth is set to 1MHz or 5MHz, sampling_frequency will be set to 13.5MHz
-                        # if result in (1000000L, 5000000L):
-                        #     sampling_frequency = 13500000L
-                        _ad9361_set_bb_rate(self.__ctrl._device, c_ulong(sampling_frequency))
-                        self.__parameters['sampling_frequency'][1][0] = sampling_frequency
-            sys.stdout.write('Set device parameter: \"{0}\" to {1} on channel: {2}\n'.format(name, result, chn_idx))
-        except:
-            traceback.print_exc()
+    def __attach(self, data_socket, framer):
+        self.__lock.acquire()
+        try:
+            if self.__socket:
+                self.__socket.close()
+            self.__socket, self.__framer = data_socket, framer
+            if self.__sender is None:
+                self.__sender = threading.Thread(target=self.__send_data, name='sender-{0}'.format(self.key))
+                self.__sender.daemon = True
+                self.__sender.start()
         finally:
             self.__lock.release()
 
-    def set_data_sinker(self, callback):
+    def configure(self, depth, policy):
+        self.__queue.configure(depth, policy)
+
+    def put(self, frame):
         '''
-        Set data sinker
+        Queue a frame for sending, frames are ignored until the UDP socket is set
         '''
-        self.__callback = callback
-        sys.stdout.write('Set data callback handler <{0}>\n'.format(id(callback)))
+        if self.__socket:
+            self.__queue.put(frame)
 
-    def __capture_data(self):
+    def statistics(self):
+        statistics = {'policy': self.__queue.policy, 'depth': self.__queue.capacity, 'queued': len(self.__queue),
+                      'dropped': self.__queue.dropped, 'sent': self.sent, 'failed': self.failed}
+        if self.__framer:
+            statistics['gaps'] = self.__framer.gaps
+        return statistics
+
+    def close(self):
+        self.__lock.acquire()
+        self.__closed = True
+        if self.__socket:
+            self.__socket.close()
+            self.__socket = None
+        self.__lock.release()
+        self.__queue.close()
+        self.__notifier.close()
+        self.squelch = None
+        if self.__sender and self.__sender is not threading.current_thread():
+            self.__sender.join(1)
+
+    def __send_data(self):
         '''
-        Sample data thread
+        Sender thread, one datagram per packetized chunk
         '''
-        sys.stdout.write('Sampling thread has get ready.\n')
-        while not self.__abort_sampling_event.is_set():
-            # Fill the buffer and read data from it.
-            # Remark: a while/for loop can be used to gain data continuously
+        while not self.__closed:
+            frame = self.__queue.get(0.5)
+            if frame is None:
+                continue
+            if self.__framer:
+                self.__send_records(frame)
+                continue
             try:
-                self.__lock.acquire()
-                if self.__start_sampling:
-                    self.__buffer.refill()
-                    iq = self.__buffer.read()
-                    frequency, bandwidth, sampling_rate, attenuation = self.__parameters['frequency'][1][0], \
-                        self.__parameters['rf_bandwidth'][1][0], \
-                        self.__parameters['sampling_frequency'][1][0], \
-                        self.__ctrl.channels[4].attrs['hardwaregain'].value.split()[0]
-                else:
-                    # if this sentence is uncomment, a new task setting will be delayed which constraints parameter setting. why?
-                    self.__buffer.read()
-                    # time.sleep(2)
-                    continue
-            except (KeyboardInterrupt, SystemExit):
-                raise
+                data_socket = self.__socket
+                if data_socket:
+                    begin = time.perf_counter()
+                    processor = self.processor or self.encoder
+                    for datagram in processor.process(frame) if processor else frame.datagrams_for(self.version):
+                        send_datagram(data_socket, datagram)
+                    self.sent += 1
+                    self.send_time.observe(time.perf_counter() - begin)
             except:
+                self.failed += 1
+                self.__lock.acquire()
+                if self.__socket is data_socket:
+                    self.__socket.close()
+                    self.__socket = None
+                self.__lock.release()
                 traceback.print_exc()
-                continue
             finally:
-                self.__lock.release()
-            total = len(iq)
-            index = 0
-            current = 0
-            next_ = 0
-            while total > MAX_IQ_SIZE:
-                current = index * MAX_IQ_SIZE
-                next_ = (index+1) * MAX_IQ_SIZE
-                partial_iq = iq[current: next_]
-                data = struct.pack('=sqqqii', b'#', frequency, bandwidth, sampling_rate, int(float(attenuation)), len(partial_iq)//4)
-                data += partial_iq
-                if self.__callback:
-                    self.__callback(data)
-                else:
-                    time.sleep(2)
-                total -= MAX_IQ_SIZE
-                index += 1
-            partial_iq = iq[next_:]
-            data = struct.pack('=sqqqii', b'#', frequency, bandwidth, sampling_rate, int(float(attenuation)), len(partial_iq)//4)
-            data += partial_iq
-            if self.__callback:
-                self.__callback(data)
-            else:
-                time.sleep(2)
+                frame.release()
+
+    def __send_records(self, frame):
+        '''
+        Send the frames queued up to TCP_BATCH_SIZE as one write, blocking here only backs up this client's queue
+        '''
+        frames = [frame]
+        size = frame.size
+        while size < TCP_BATCH_SIZE:
+            frame = self.__queue.get(0)
+            if frame is None:
+                break
+            frames.append(frame)
+            size += frame.size
+        data_socket, framer = self.__socket, self.__framer
+        try:
+            if data_socket and framer:
+                begin = time.perf_counter()
+                buffers = []
+                processor = self.processor or self.encoder
+                for frame in frames:
+                    framer.append(buffers, frame, processor.process(frame) if processor else frame.datagrams_for(self.version))
+                data_socket.sendall(b''.join(buffers))
+                self.sent += len(frames)
+                self.send_time.observe(time.perf_counter() - begin)
+        except:
+            self.failed += 1
+            self.__lock.acquire()
+            if self.__socket is data_socket:
+                self.__socket.close()
+                self.__socket = None
+            self.__lock.release()
+            traceback.print_exc()
+        finally:
+            for frame in frames:
+                frame.release()
 
 
 class NetworkService():
     '''
     Use this network service to dispatch data from device context
+    One thread serves every control connection, see plutosdr_aio.AsyncNetworkService for the event loop server
     '''
 
-    def __init__(self, device):
+    def __init__(self, device, max_clients=3, record_directory='recordings'):
         '''
         Construct a network service attached a device
+        Paramters:
+            max_clients: connections accepted at the same time, later ones are closed
+            record_directory: directory of the recordings started by "*record="
         '''
         sys.stdout.write('Initialize network dispatch service...\n')
+        self.max_clients = max_clients
+        self.record_directory = record_directory
+        self.__recorder = None
         self.__lock = threading.Lock()
-        self.__data_sockets = {}
+        self.__data_clients = {}
+        self.__pipelines = {}
+        self.__groups = {}  # (group, port): [multicast data client, subscribers]
+        self.__broadcast_time = Histogram()
+        self.__metrics_server = None  # MetricsServer started by "*stats=http:port"
+        self.__profiler = SamplingProfiler()
         self.__device = device
         self.__device.set_data_sinker(self.__broadcast_data)
         self.__server_socket = None
+        self.__serving = False
 
     def start(self, host='', port=5025):
         '''
@@ -306,30 +1699,26 @@ class NetworkService():
         self.__server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.__server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, True)
         self.__server_socket.bind((host, port))
-        self.__server_socket.listen(1)
+        self.__server_socket.listen(max(self.max_clients, 5))
         sys.stdout.write('Listening on 0.0.0.0:{0}\n'.format(port))
-        while True:
+        self.__serving = True
+        while self.__serving:
             try:
                 client_socket, client_addr = self.__server_socket.accept()
                 sys.stdout.write('Accept connection from \"{0}:{1}\"\n'.format(client_addr[0], client_addr[1]))
-                try:
-                    self.__lock.acquire()
-                    if len(self.__data_sockets) == 3:
-                        sys.stdout.write('Too many connections, this connection <{0}> will be closed forcedly\n'.format(id(client_socket)))
-                        client_socket.sendall('Your request has been closed since too many connections.\n')
-                        client_socket.shutdown(2)
-                        client_socket.close()
-                    else:
-                        processor = threading.Thread(target=self.__process_client, args=[client_socket])
-                        processor.setDaemon(True)
-                        processor.start()
-                except:
-                    raise
-                finally:
-                    self.__lock.release()
+                if not self.open_client(client_socket):
+                    self.reject_client(client_socket)
+                    client_socket.shutdown(2)
+                    client_socket.close()
+                else:
+                    processor = threading.Thread(target=self.__process_client, args=[client_socket])
+                    processor.daemon = True
+                    processor.start()
             except KeyboardInterrupt:
                 raise
             except:
+                if not self.__serving:  # server socket closed by stop()
+                    break
                 traceback.print_exc()
         self.__server_socket.close()
 
@@ -337,42 +1726,111 @@ class NetworkService():
         '''
         Stop network service
         '''
+        self.__serving = False
+        if self.__server_socket:
+            try:
+                self.__server_socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self.__server_socket.close()
         self.__lock.acquire()
-        for key in self.__data_sockets:
+        for key in self.__data_clients:
             try:
-                self.__data_sockets[key].shutdown(2)
-                self.__data_sockets[key].close()
-                self.__data_sockets[key] = None
+                self.__data_clients[key].close()
                 sys.stdout.write('client socket<{0}> closed.\n'.format(key))
             except:
                 traceback.print_exc()
-        self.__data_sockets.clear()
+        self.__data_clients.clear()
+        for group, _ in self.__groups.values():
+            group.close()
+        self.__groups.clear()
         self.__lock.release()
+        if self.__recorder:
+            self.__recorder.stop()
+            self.__recorder = None
+        if self.__metrics_server:
+            self.__metrics_server.stop()
+            self.__metrics_server = None
+        self.__profiler.stop()
         self.__device.release()
 
-    def __process_client(self, client_socket):
+    def statistics(self):
         '''
-        Process command and other input from client socket
+        Per-client data channel counters
+        '''
+        self.__lock.acquire()
+        clients = list(self.__data_clients.values()) + [group for group, _ in self.__groups.values()]
+        self.__lock.release()
+        return {client.key: client.statistics() for client in clients}
+
+    def metrics(self):
+        '''
+        Device counters and histograms, the broadcast histogram and per-client counters with their send histogram
         '''
         self.__lock.acquire()
-        self.__data_sockets[id(client_socket)] = None
+        clients = list(self.__data_clients.values()) + [group for group, _ in self.__groups.values()]
         self.__lock.release()
+        metrics = self.__device.metrics()
+        metrics['broadcast_seconds'] = self.__broadcast_time
+        metrics['clients'] = {}
+        for client in clients:
+            statistics = client.statistics()
+            statistics['send_seconds'] = client.send_time
+            metrics['clients'][client.key] = statistics
+        return metrics
+
+    def create_data_client(self, key):
+        return DataClient(key)
+
+    def open_client(self, control):
+        '''
+        Register a control connection (anything with sendall, eg. a socket), return False when max_clients is reached
+        '''
+        self.__lock.acquire()
+        try:
+            if len(self.__data_clients) >= self.max_clients:
+                return False
+            client = self.create_data_client(id(control))
+            client.control = control
+            self.__data_clients[id(control)] = client
+            return True
+        finally:
+            self.__lock.release()
+
+    def reject_client(self, control):
+        sys.stdout.write('Too many connections, this connection <{0}> will be closed forcedly\n'.format(id(control)))
+        control.sendall(b'Your request has been closed since too many connections.\n')
+
+    def process_request(self, control, request):
+        '''
+        Process one line received from a control connection
+        '''
+        request = request.lower().strip()
+        sys.stdout.write('Receive request: \"{0}\"\n'.format(request))
+        # a star ahead means a command used to initialize networking or task
+        if request.startswith('*'):
+            self.__process_task_request(control, request)
+        # a sharp ahead means a cluster of parameters used to configure device
+        elif request.startswith('#'):
+            self.__process_parameter_request(control, request)
+
+    def close_client(self, control):
+        self.__remove_data_transmission(control)
+
+    def __process_client(self, client_socket):
+        '''
+        Process command and other input from client socket
+        '''
         fd = client_socket.makefile('rwb', 0)  # convert
         while True:
             try:
-                request = fd.readline().lower().decode('ascii').strip()
-                sys.stdout.write('Receive request: \"{0}\"\n'.format(request))
-                # a star ahead means a command used to initialize networking or task
-                if request.startswith('*'):
-                    self.__process_task_request(client_socket, request)
-                # a sharp ahead means a cluster of parameters used to configure device
-                elif request.startswith('#'):
-                    self.__process_parameter_request(request)
+                request = fd.readline().decode('ascii')
                 # when the fd is unavailable (the current connection has been closed by remote host),
                 # the fd.readline method will return empty string in Linux,
                 # while in Windows, fd.readline will raise an i/o exception
-                elif not request:
+                if not request:
                     break
+                self.process_request(client_socket, request)
             except:
                 traceback.print_exc()
                 break
@@ -383,7 +1841,22 @@ class NetworkService():
     def __process_task_request(self, client_socket, request):
         '''
         Process request concerning networking
-        eg. "*udp=192.168.120.1:9527\n", "*task=on\n", "*task=off\n'
+        eg. "*udp=192.168.120.1:9527\n", "*task=on\n", "*task=off\n',
+            "*queue=drop-oldest:32\n" (policy[:depth] of this client's data queue), "*queue=?\n" (query its counters),
+            "*header=v2\n" (data header version of this client, replied with "header=v2\n"),
+            "*poll=500\n" (milliseconds between gain/overflow readbacks of the device),
+            "*ack=on\n" (acknowledge every parameter request of this client, see __process_parameter_request),
+            "*sweep=start:stop:step:dwell[:settle[:fastlock]]\n", "*sweep=off\n", "*sweep=?\n" (server-side frequency sweep),
+            "*mode=psd[:fft[:overlap[:window[:averages[:f32|u8]]]]]\n", "*mode=iq\n" (what this client receives),
+            "*ddc=offset:rate\n", "*ddc=off\n" (narrow channel of this client, shared with clients asking for the same),
+            "*encoding=i12\n" (I/Q payload encoding of this client: i16, i12, i8 or zlib, replied with "encoding=i12\n"),
+            "*multicast=239.0.0.1:9527[:ttl]\n", "*multicast=off\n" (send to a multicast group instead, once for all its clients),
+            "*tcp=192.168.120.1:9527\n" (lossless data channel: records over a TCP connection to the client, with gap records),
+            "*record=name[:max_mb[:max_seconds]]\n", "*record=off\n", "*record=?\n" (SigMF recording on the server),
+            "*stats=?\n" (counters and latency histograms), "*stats=http:9100\n", "*stats=http:off\n" (Prometheus endpoint),
+            "*profile=on[:interval_ms]\n", "*profile=off\n", "*profile=?\n" (sampling profiler of the service threads),
+            "*buffer=count[:kernel_buffers]\n", "*buffer=auto[:latency_ms]\n", "*buffer=?\n" (RX buffer rebuilt at runtime),
+            "*squelch=threshold_db[:pre_ms[:post_ms[:fft]]]\n", "*squelch=off\n", "*squelch=?\n" (send only active buffers)
         '''
         if not request.startswith('*'):
             return
@@ -394,35 +1867,364 @@ class NetworkService():
             if len(parameter) != 2:
                 continue
             name, value = parameter
+            self.__lock.acquire()
+            client = self.__data_clients.get(id(client_socket))
+            self.__lock.release()
             if name == 'udp':
                 try:
-                    self.__lock.acquire()
-                    key = id(client_socket)
-                    if key in self.__data_sockets and self.__data_sockets[key]:
-                        self.__data_sockets[key].close()
                     host, port = value.split(':')
-                    data_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-                    data_socket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, True)
-                    data_socket.connect((host, int(port)))
-                    self.__data_sockets[key] = data_socket
+                    client.connect(host, int(port))
                 except:
                     traceback.print_exc()
-                finally:
-                    self.__lock.release()
+            elif name == 'tcp':
+                try:
+                    host, port = value.split(':')
+                    client.connect_tcp(host, int(port))
+                except:
+                    traceback.print_exc()
+            elif name == 'queue':
+                try:
+                    if value == '?':
+                        statistics = client.statistics()
+                        client_socket.sendall('queue={0}:{1};queued={2};dropped={3};sent={4};failed={5}\n'.format(
+                            statistics['policy'], statistics['depth'], statistics['queued'], statistics['dropped'],
+                            statistics['sent'], statistics['failed']).encode('ascii'))
+                    else:
+                        policy, _, depth = value.partition(':')
+                        client.configure(int(depth) if depth else client.statistics()['depth'], policy)
+                except:
+                    traceback.print_exc()
+            elif name == 'header':
+                if value in ('v1', 'v2'):
+                    client.version = int(value[1])
+                client_socket.sendall('header=v{0}\n'.format(client.version).encode('ascii'))
+            elif name == 'multicast':
+                try:
+                    if value == 'off':
+                        self.__set_group(client, None)
+                    else:
+                        fields = value.split(':')
+                        ttl = int(fields[2]) if len(fields) > 2 else 1
+                        self.__set_group(client, (fields[0], int(fields[1])), ttl, client_socket)
+                except:
+                    traceback.print_exc()
+            elif name == 'record':
+                try:
+                    self.__process_record_request(client_socket, value)
+                except:
+                    traceback.print_exc()
+            elif name == 'stats':
+                try:
+                    self.__process_stats_request(client_socket, client, value)
+                except:
+                    traceback.print_exc()
+            elif name == 'squelch':
+                try:
+                    self.__process_squelch_request(client_socket, client, value)
+                except:
+                    traceback.print_exc()
+            elif name == 'buffer':
+                try:
+                    self.__process_buffer_request(client_socket, value)
+                except:
+                    traceback.print_exc()
+            elif name == 'profile':
+                try:
+                    self.__process_profile_request(client_socket, value)
+                except:
+                    traceback.print_exc()
+            elif name == 'sweep':
+                try:
+                    self.__process_sweep_request(client_socket, value)
+                except:
+                    traceback.print_exc()
+            elif name == 'ddc':
+                try:
+                    if value == 'off':
+                        self.__set_pipeline(client, None)
+                    else:
+                        offset, rate = value.split(':')
+                        self.__set_pipeline(client, (int(offset), int(rate)))
+                except:
+                    traceback.print_exc()
+            elif name == 'encoding':
+                try:
+                    self.__process_encoding_request(client, value)
+                except:
+                    traceback.print_exc()
+                client_socket.sendall('encoding={0}\n'.format(client.encoder.name if client.encoder else 'i16').encode('ascii'))
+            elif name == 'mode':
+                try:
+                    self.__process_mode_request(client, value)
+                except:
+                    traceback.print_exc()
+            elif name == 'ack':
+                client.ack = value == 'on'
+            elif name == 'poll':
+                try:
+                    self.__device.set_poll_interval(int(value) / 1000.0)
+                except ValueError:
+                    traceback.print_exc()
             elif name == 'task':
                 if value == 'on':
                     self.__device.start()
                 elif value == 'off':
                     self.__device.stop()
 
-    def __process_parameter_request(self, request):
+    def __set_pipeline(self, client, key):
+        '''
+        Subscribe a client to the pipeline of channel key (offset, rate), or to the full band when key is None
+        '''
+        self.__lock.acquire()
+        try:
+            previous = client.pipeline
+            if previous and previous.key == key:
+                return
+            pipeline = None
+            if key:
+                pipeline = self.__pipelines.get(key)
+                if pipeline is None:
+                    pipeline = ChannelPipeline(self.__device.sampling_count, key[0], key[1])
+                    self.__pipelines[key] = pipeline
+                pipeline.subscribers += 1
+            client.pipeline = pipeline
+            if previous:
+                previous.subscribers -= 1
+                if not previous.subscribers:
+                    del self.__pipelines[previous.key]
+        finally:
+            self.__lock.release()
+        sys.stdout.write('Set channel of client <{0}> to {1}\n'.format(client.key, key or 'full band'))
+
+    def __process_mode_request(self, client, value):
+        '''
+        Select what a client receives, eg. "iq" (raw I/Q, default), "psd:1024:50:hann:8:u8" (spectra computed on the server)
+        '''
+        fields = value.split(':')
+        if fields[0] == 'iq':
+            client.processor = None
+        elif fields[0] == 'psd':
+            from plutosdr_dsp import PsdEstimator  # numpy is only required by processing modes
+            defaults = ['1024', '50', 'hann', '8', 'f32']
+            fields = fields[1:] + defaults[len(fields) - 1:]
+            client.processor = PsdEstimator(int(fields[0]), int(fields[1]), fields[2], int(fields[3]), fields[4])
+        else:
+            return
+        sys.stdout.write('Set data mode of client <{0}> to \"{1}\"\n'.format(client.key, value))
+
+    def __set_group(self, client, key, ttl=1, control=None):
+        '''
+        Move a client to the multicast stream of key (group, port), or back to its own UDP when key is None.
+        A stream is opened by its first client (with that client's header version, from the interface its
+        control connection arrived on) and closed when its last client leaves. The stream is connected outside
+        the lock (an asyncio data client waits for the event loop, which takes the lock to open clients)
+        '''
+        stream = None
+        try:
+            while True:
+                self.__lock.acquire()
+                try:
+                    previous = client.group
+                    if previous == key:
+                        return
+                    if not key or key in self.__groups or stream:
+                        if key:
+                            if key not in self.__groups:
+                                self.__groups[key], stream = [stream, 0], None
+                            self.__groups[key][1] += 1
+                        client.group = key
+                        if previous:
+                            self.__groups[previous][1] -= 1
+                            if not self.__groups[previous][1]:
+                                self.__groups.pop(previous)[0].close()
+                        break
+                finally:
+                    self.__lock.release()
+                stream = self.create_data_client('{0}:{1}'.format(key[0], key[1]))
+                stream.version = client.version
+                interface = control.getsockname()[0] if control else None
+                stream.connect(key[0], key[1], ttl, interface)
+        finally:
+            if stream:  # failed to connect, or another client opened the group meanwhile
+                stream.close()
+        sys.stdout.write('Set multicast of client <{0}> to {1}\n'.format(client.key, key or 'off'))
+
+    def __process_encoding_request(self, client, value):
+        '''
+        Select the I/Q payload encoding of a client, "i16" is the plain format, others are sent with the v2 header
+        '''
+        if value == 'i16':
+            client.encoder = None
+        else:
+            from plutosdr_codec import SampleEncoder  # numpy is only required by processing modes
+            client.encoder = SampleEncoder(value)
+        sys.stdout.write('Set encoding of client <{0}> to "{1}"\n'.format(client.key, value))
+
+    def __process_record_request(self, client_socket, value):
+        '''
+        Start ("name[:max_mb[:max_seconds]]"), stop ("off") or query ("?") the recording of the server,
+        recordings are written under record_directory whatever path the name holds
+        '''
+        if value == '?':
+            recorder = self.__recorder
+            if recorder:
+                statistics = recorder.statistics()
+                client_socket.sendall('record={0};files={1};bytes={2};dropped={3}\n'.format(
+                    os.path.basename(statistics['path']), statistics['files'], statistics['bytes'],
+                    statistics['dropped']).encode('ascii'))
+            else:
+                client_socket.sendall(b'record=off\n')
+            return
+        recorder = None
+        self.__lock.acquire()
+        try:
+            recorder, self.__recorder = self.__recorder, None
+            if value != 'off':
+                from plutosdr_record import Recorder
+                fields = value.split(':')
+                name = os.path.basename(fields[0])
+                if not name:
+                    raise ValueError('invalid recording name: {0}'.format(fields[0]))
+                max_bytes = int(fields[1]) * 1024 * 1024 if len(fields) > 1 else 1024 * 1024 * 1024
+                max_seconds = int(fields[2]) if len(fields) > 2 else 0
+                started = Recorder(os.path.join(self.record_directory, name), max_bytes, max_seconds)
+                started.start(self.__device)
+                self.__recorder = started
+        finally:
+            self.__lock.release()
+            if recorder:  # stopped outside the lock, its writer finishes what is queued while dispatch goes on
+                recorder.stop()
+
+    def __process_stats_request(self, client_socket, client, value):
+        '''
+        Reply counters ("?") or start/stop the Prometheus endpoint ("http:port", "http:off"), a query is replied with
+        "stats=1;captured_samples=n;overflows=n;...;refill_us=count:mean:p50:p99:max;...;sent=n;failed=n;dropped=n\n",
+        the last counters and send_us being those of this client
+        '''
+        if value == '?':
+            fields = ['stats=1']
+            for name, metric in self.metrics().items():
+                if name == 'clients':
+                    continue
+                if isinstance(metric, Histogram):
+                    fields.append('{0}_us={1}'.format(name[:-len('_seconds')], metric.summary()))
+                else:
+                    fields.append('{0}={1}'.format(name, metric))
+            if client:
+                statistics = client.statistics()
+                fields.extend('{0}={1}'.format(name, statistics[name]) for name in ('sent', 'failed', 'dropped'))
+                fields.append('send_us={0}'.format(client.send_time.summary()))
+            client_socket.sendall('{0}\n'.format(';'.join(fields)).encode('ascii'))
+            return
+        kind, _, port = value.partition(':')
+        if kind != 'http':
+            return
+        self.__lock.acquire()
+        try:
+            if self.__metrics_server:
+                self.__metrics_server.stop()
+                self.__metrics_server = None
+            if port != 'off':
+                self.__metrics_server = MetricsServer(self.metrics, int(port))
+        finally:
+            self.__lock.release()
+
+    def __process_squelch_request(self, client_socket, client, value):
+        '''
+        Gate this client's frames (after its channel, see "*ddc=") on their power: "threshold_db[:pre_ms[:post_ms[:fft]]]",
+        fft 0 (default) measures the whole band, else the strongest bin of an fft point spectrum. Openings and closings
+        are notified with "burst=open;sample=n;timestamp=ns;level=dBFS\n" and "burst=close;sample=n;timestamp=ns;samples=n\n".
+        A query is replied with "squelch=threshold:pre_ms:post_ms:fft;state=open|closed;bursts=n;forwarded=n;total=n\n"
+        (forwarded/total samples) or "squelch=off\n"
+        '''
+        if value == '?':
+            squelch = client.squelch
+            if squelch:
+                client_socket.sendall('squelch={0:g}:{1:g}:{2:g}:{3};state={4};bursts={5};forwarded={6};total={7}\n'.format(
+                    squelch.threshold, squelch.pre * 1000, squelch.post * 1000, squelch.fft_size,
+                    'open' if squelch.open else 'closed', squelch.bursts, squelch.forwarded, squelch.total).encode('ascii'))
+            else:
+                client_socket.sendall(b'squelch=off\n')
+            return
+        if value == 'off':
+            client.squelch = None
+        else:
+            from plutosdr_dsp import Squelch  # numpy is only required by processing modes
+            fields = [float(field) for field in value.split(':')] + [0, 0, 0]
+            client.squelch = Squelch(fields[0], fields[1] / 1000.0, fields[2] / 1000.0, int(fields[3]))
+        sys.stdout.write('Set squelch of client <{0}> to "{1}"\n'.format(client.key, value))
+
+    def __process_buffer_request(self, client_socket, value):
+        '''
+        Rebuild the RX buffer ("count[:kernel_buffers]", an empty count keeps it), size it from the sampling rate
+        ("auto[:latency_ms]", default 20ms) or query ("?"), always replied with
+        "buffer=count;kernel_buffers=n;auto=latency_ms|off;rebuilds=n\n"
+        '''
+        fields = value.split(':')
+        if fields[0] == 'auto':
+            self.__device.set_buffer_auto(int(fields[1]) / 1000.0 if len(fields) > 1 else 0.02)
+        elif value != '?':
+            self.__device.set_buffer(int(fields[0]) if fields[0] else None, int(fields[1]) if len(fields) > 1 else None)
+        settings = self.__device.buffer_settings()
+        latency = settings['auto_latency']
+        client_socket.sendall('buffer={0};kernel_buffers={1};auto={2};rebuilds={3}\n'.format(
+            settings['sampling_count'], settings['kernel_buffers'], int(latency * 1000) if latency else 'off',
+            settings['rebuilds']).encode('ascii'))
+
+    def __process_profile_request(self, client_socket, value):
+        '''
+        Start ("on[:interval_ms]", clearing previous samples), stop ("off") or query ("?") the sampling profiler,
+        a query is replied with "profile=on|off;samples=n;<thread> <function> <file>:<line>=samples;..." (10 most sampled)
+        '''
+        profiler = self.__profiler
+        if value == '?':
+            fields = ['profile={0}'.format('on' if profiler.running else 'off'), 'samples={0}'.format(profiler.samples)]
+            fields.extend('{0}={1}'.format(location, count) for location, count in profiler.top(10))
+            client_socket.sendall('{0}\n'.format(';'.join(fields)).encode('ascii'))
+        elif value == 'off':
+            profiler.stop()
+        else:
+            fields = value.split(':')
+            if fields[0] != 'on':
+                return
+            profiler.stop()
+            profiler.reset()
+            if len(fields) > 1:
+                profiler.interval = int(fields[1]) / 1000.0
+            profiler.start()
+
+    def __process_sweep_request(self, client_socket, value):
+        '''
+        Start, stop or query the sweep, eg. "101700000:201700000:1000000:4096:2:fastlock", "off", "?"
+        A query is replied with "sweep=start:stop:step:dwell;steps=n;steps_per_second=x\n" or "sweep=off\n"
+        '''
+        if value == 'off':
+            self.__device.stop_sweep()
+        elif value == '?':
+            statistics = self.__device.sweep_statistics()
+            if statistics:
+                reply = 'sweep={start}:{stop}:{step}:{dwell};steps={steps};steps_per_second={steps_per_second:.1f}\n'.format(**statistics)
+            else:
+                reply = 'sweep=off\n'
+            client_socket.sendall(reply.encode('ascii'))
+        else:
+            fields = value.split(':')
+            start, stop, step, dwell = [int(field) for field in fields[:4]]
+            settle = int(fields[4]) if len(fields) > 4 else 2
+            self.__device.start_sweep(start, stop, step, dwell, settle, len(fields) > 5 and fields[5] == 'fastlock')
+
+    def __process_parameter_request(self, client_socket, request):
         '''
-        Process parameter setting request
+        Process parameter setting request, the whole line is applied as one transaction
         eg. "#long:frequency:101700000;long:rf_bandwidth:2000000;long:samping_frequency:2500000\n"
+        With "*ack=on" it is acknowledged by "ack=<version>;apply_us=<n>;sequence=<n>;sample=<n>\n",
+        apply_us is the time spent writing the device, sequence/sample locate the first datagram/sample
+        captured with the new settings (-1 when nothing was retuned or sampling is off)
         '''
         if not request.startswith('#'):
             return
 
+        parameters = []
         requests = request[1:].split(';')
         for req in requests:
             parameter = req.split(':')
@@ -431,24 +2233,53 @@ class NetworkService():
             param_type, name, value = parameter
             if param_type == 'int' or param_type == 'long':
                 value = int(value)
-            self.__device.set_parameter(name, value)
+            parameters.append((name, value))
+        previous = self.__device.snapshot.version
+        version, elapsed, _ = self.__device.set_parameters(parameters)
+
+        self.__lock.acquire()
+        client = self.__data_clients.get(id(client_socket))
+        self.__lock.release()
+        if client and client.ack:
+            sequence, sample = self.__device.wait_applied(version) if version != previous else (-1, -1)
+            client_socket.sendall('ack={0};apply_us={1};sequence={2};sample={3}\n'.format(
+                version, int(elapsed * 1e6), sequence, sample).encode('ascii'))
 
-    def __broadcast_data(self, data):
+    def __broadcast_data(self, frame):
         '''
-        Broadcast data to all its clients
+        Queue a captured frame to all its clients, sending happens on every client's own thread.
+        Channel pipelines run here, once per frame however many clients share them
         '''
+        begin = time.perf_counter()
+        self.__lock.acquire()
+        clients = [client for client in self.__data_clients.values() if client.group is None]
+        groups = [group for group, _ in self.__groups.values()]
+        self.__lock.release()
+        for group in groups:
+            group.put(frame)
+        outputs = {}
         try:
-            self.__lock.acquire()
-            for key in self.__data_sockets:
+            for client in clients:
+                pipeline = client.pipeline
+                if pipeline is not None and pipeline not in outputs:
+                    try:
+                        outputs[pipeline] = pipeline.process(frame)
+                    except:
+                        outputs[pipeline] = None
+                        traceback.print_exc()
+                output = outputs[pipeline] if pipeline is not None else frame
+                if not output:
+                    continue
                 try:
-                    if self.__data_sockets[key]:
-                        self.__data_sockets[key].sendall(data)
+                    for notification in forward_frame(client, output):
+                        client.notify(notification)
                 except:
-                    self.__data_sockets[key].close()
-                    self.__data_sockets[key] = None
                     traceback.print_exc()
         finally:
-            self.__lock.release()
+            for output in outputs.values():
+                if output:
+                    output.release()
+            self.__broadcast_time.observe(time.perf_counter() - begin)
 
     def __remove_data_transmission(self, client_sock):
         '''
@@ -456,13 +2287,22 @@ class NetworkService():
         '''
         sys.stdout.write('Close data transmission socket: <{0}>\n'.format(id(client_sock)))
         self.__lock.acquire()
-        key = id(client_sock)
-        if key in self.__data_sockets:
-            del self.__data_sockets[key]
+        client = self.__data_clients.pop(id(client_sock), None)
         self.__lock.release()
+        if client:
+            self.__set_pipeline(client, None)
+            self.__set_group(client, None)
+            client.close()
 
 
 def main():
+    '''
+    Usage: plutosdr.py [sampling_count] [context] [max_clients] [thread|asyncio|shm[:workers]],
+        eg. "plutosdr.py 2048 ip:192.168.2.1", "plutosdr.py 2048 sim:tone=250000", "plutosdr.py 2048 ip:192.168.2.1 32 asyncio",
+        "plutosdr.py 2048 ip:192.168.2.1 8 shm:4" (data plane in 4 worker processes),
+        contexts joined by "+" serve several devices on consecutive ports, eg. "plutosdr.py 2048 ip:192.168.2.1+usb:1.2.5"
+        (see plutosdr_multi.py for configuration files and process isolation)
+    '''
     try:
         value = int(sys.argv[1])
         if value < 128:
@@ -471,11 +2311,27 @@ def main():
             value = 8192
     except:
         value = 2048
+    context = sys.argv[2] if len(sys.argv) > 2 else 'ip:192.168.2.1'
+    max_clients = int(sys.argv[3]) if len(sys.argv) > 3 else 3
+    server = sys.argv[4] if len(sys.argv) > 4 else 'thread'
+
+    if '+' in context:
+        from plutosdr_multi import MultiDeviceServer, device_specs
+        MultiDeviceServer(device_specs(context.split('+'), 5025, value, max_clients, server)).serve()
+        return
 
     network_service = None
     try:
-        device_service = DeviceService(sampling_count=value)
-        network_service = NetworkService(device_service)
+        device_service = DeviceService(sampling_count=value, context=context, state_path=state_file(context))
+        if server == 'asyncio':
+            from plutosdr_aio import AsyncNetworkService
+            network_service = AsyncNetworkService(device_service, max_clients)
+        elif server.startswith('shm'):
+            from plutosdr_shm import ShmNetworkService
+            workers = server.partition(':')[2]
+            network_service = ShmNetworkService(device_service, max_clients, int(workers) if workers else 2)
+        else:
+            network_service = NetworkService(device_service, max_clients)
         network_service.start()
     except:
         traceback.print_exc()
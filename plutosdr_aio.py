@@ -0,0 +1,328 @@
+#!/usr/bin/env python3
+# -*-coding:utf-8-*-
+# Description: asyncio control/data server speaking the same "*"/"#" protocol as NetworkService
+
+import asyncio
+import concurrent.futures
+import socket
+import sys
+import threading
+import time
+import traceback
+
+from plutosdr import TCP_SEND_BUFFER, FrameQueue, NetworkService, RecordFramer, configure_multicast, send_datagram
+from plutosdr_stats import Histogram
+
+
+class StreamControl():
+    '''
+    Control connection of one client, replies are written by the event loop whatever thread produces them
+    '''
+
+    def __init__(self, loop, writer):
+        self.__loop = loop
+        self.__writer = writer
+
+    def sendall(self, data):
+        self.__loop.call_soon_threadsafe(self.__writer.write, data)
+
+    def write_buffer_size(self):
+        '''
+        Bytes written but not sent yet (event loop only)
+        '''
+        return self.__writer.transport.get_write_buffer_size()
+
+    def getsockname(self):
+        return self.__writer.get_extra_info('sockname')
+
+
+class AsyncDataClient():
+    '''
+    Data channel of one client sent by the event loop from a non-blocking UDP socket.
+    Frames wait in a bounded FrameQueue which the loop drains, datagrams are sent with send_datagram (no copy)
+    and the rest of a frame is dropped instead of blocking when the socket buffer is full (TCP: when the
+    transport buffers more than max_buffered bytes)
+    Parameters:
+        key: identifier of the client (id of its control connection)
+        loop: event loop of the server
+        depth: queue capacity in frames
+        policy: queue policy when full, see FrameQueue.POLICIES
+        max_buffered: transport buffer size beyond which frames are dropped
+    '''
+
+    def __init__(self, key, loop, depth=32, policy='drop-oldest', max_buffered=4 * 1024 * 1024):
+        self.key = key
+        self.__loop = loop
+        self.__lock = threading.Lock()
+        self.__queue = FrameQueue(depth, policy)
+        self.__transport = None
+        self.__socket = None  # non-blocking UDP socket of the transport, datagrams are sent on it directly
+        self.__framer = None  # RecordFramer of a TCP data channel, None for UDP
+        self.__scheduled = False
+        self.__max_buffered = max_buffered
+        self.version = 1
+        self.ack = False
+        self.processor = None
+        self.pipeline = None
+        self.encoder = None
+        self.group = None
+        self.control = None
+        self.sent = 0
+        self.failed = 0
+        self.overruns = 0  # frames dropped because the transport was backed up
+        self.send_time = Histogram()
+        self.__squelch = None
+
+    @property
+    def squelch(self):
+        return self.__squelch
+
+    @squelch.setter
+    def squelch(self, squelch):
+        previous, self.__squelch = self.__squelch, squelch
+        if previous:
+            previous.close()
+
+    def notify(self, line):
+        '''
+        Queue a line for the control connection, written by the loop and dropped while the client
+        leaves more than max_buffered bytes of it unread
+        '''
+        if self.control:
+            try:
+                self.__loop.call_soon_threadsafe(self.__write_notification, line)
+            except RuntimeError:  # loop closed
+                pass
+
+    def __write_notification(self, line):
+        try:
+            if self.control.write_buffer_size() <= self.__max_buffered:
+                self.control.sendall(line)
+        except:
+            traceback.print_exc()
+
+    def connect(self, host, port, ttl=None, interface=None):
+        '''
+        (Re)open the UDP transport, called from a worker thread, see DataClient.connect
+        '''
+        asyncio.run_coroutine_threadsafe(self.__open(host, port, ttl, interface), self.__loop).result(5)
+
+    async def __open(self, host, port, ttl, interface):
+        data_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        data_socket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, True)
+        configure_multicast(data_socket, ttl, interface)
+        data_socket.setblocking(False)
+        data_socket.connect((host, port))
+        transport, _ = await self.__loop.create_datagram_endpoint(asyncio.DatagramProtocol, sock=data_socket)
+        self.__attach(transport, None)
+        self.__socket = data_socket
+
+    def connect_tcp(self, host, port):
+        '''
+        (Re)open the data channel as a TCP connection to the client, see DataClient.connect_tcp
+        '''
+        asyncio.run_coroutine_threadsafe(self.__open_tcp(host, port), self.__loop).result(5)
+
+    async def __open_tcp(self, host, port):
+        transport, _ = await self.__loop.create_connection(asyncio.Protocol, host, port)
+        transport.get_extra_info('socket').setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, TCP_SEND_BUFFER)
+        self.__attach(transport, RecordFramer())
+
+    def __attach(self, transport, framer):
+        if self.__transport:
+            self.__transport.close()
+        self.__transport, self.__framer, self.__socket = transport, framer, None
+
+    def configure(self, depth, policy):
+        self.__queue.configure(depth, policy)
+
+    def put(self, frame):
+        '''
+        Queue a frame from the dispatch thread and wake the loop up once per batch
+        '''
+        if self.__transport is None:
+            return
+        self.__queue.put(frame)
+        self.__lock.acquire()
+        schedule, self.__scheduled = not self.__scheduled, True
+        self.__lock.release()
+        if schedule:
+            try:
+                self.__loop.call_soon_threadsafe(self.__drain)
+            except RuntimeError:  # loop closed
+                pass
+
+    def statistics(self):
+        statistics = {'policy': self.__queue.policy, 'depth': self.__queue.capacity, 'queued': len(self.__queue),
+                      'dropped': self.__queue.dropped + self.overruns, 'sent': self.sent, 'failed': self.failed}
+        if self.__framer:
+            statistics['gaps'] = self.__framer.gaps
+        return statistics
+
+    def close(self):
+        self.__queue.close()
+        self.squelch = None
+        try:
+            self.__loop.call_soon_threadsafe(self.__close_transport)
+        except RuntimeError:  # loop closed
+            pass
+
+    def __close_transport(self):
+        if self.__transport:
+            self.__transport.close()
+            self.__transport, self.__socket = None, None
+
+    def __drain(self):
+        self.__lock.acquire()
+        self.__scheduled = False
+        self.__lock.release()
+        if self.__framer:
+            self.__drain_records()
+            return
+        while True:
+            frame = self.__queue.get(0)
+            if frame is None:
+                break
+            try:
+                transport, data_socket = self.__transport, self.__socket
+                if transport is None or transport.is_closing() or data_socket is None:
+                    continue
+                begin = time.perf_counter()
+                processor = self.processor or self.encoder
+                for datagram in processor.process(frame) if processor else frame.datagrams_for(self.version):
+                    send_datagram(data_socket, datagram)
+                self.sent += 1
+                self.send_time.observe(time.perf_counter() - begin)
+            except (BlockingIOError, InterruptedError):  # socket buffer full, the rest of the frame is dropped
+                self.overruns += 1
+            except:
+                self.failed += 1
+                traceback.print_exc()
+            finally:
+                frame.release()
+
+    def __drain_records(self):
+        '''
+        Write every queued frame as one batch of records, frames are dropped (and later replaced by a gap record)
+        while the transport buffers more than max_buffered bytes
+        '''
+        begin = time.perf_counter()
+        buffers = []
+        transport, framer = self.__transport, self.__framer
+        while True:
+            frame = self.__queue.get(0)
+            if frame is None:
+                break
+            try:
+                if transport is None or transport.is_closing():
+                    continue
+                if transport.get_write_buffer_size() > self.__max_buffered:
+                    self.overruns += 1
+                    continue
+                processor = self.processor or self.encoder
+                framer.append(buffers, frame, processor.process(frame) if processor else frame.datagrams_for(self.version))
+                self.sent += 1
+            except:
+                self.failed += 1
+                traceback.print_exc()
+            finally:
+                frame.release()
+        if buffers and transport and not transport.is_closing():
+            transport.write(b''.join(buffers))
+            self.send_time.observe(time.perf_counter() - begin)
+
+
+class AsyncNetworkService(NetworkService):
+    '''
+    NetworkService running control connections and UDP sends on one asyncio event loop, so many clients
+    cost no thread each. Requests are handled in order per connection by a pool of max_clients worker threads,
+    as some of them wait for seconds (parameter writes and "*ack=on", data channel connects), so a connection
+    never waits for the requests of others
+    Paramters:
+        device: DeviceService
+        max_clients: connections accepted at the same time, later ones are closed
+        backlog: listen backlog
+    '''
+
+    def __init__(self, device, max_clients=64, backlog=128):
+        NetworkService.__init__(self, device, max_clients)
+        self.backlog = backlog
+        self.__loop = None
+        self.__stopped = None
+        self.__executor = None
+        self.__connections = {}  # writer: task serving it
+
+    def create_data_client(self, key):
+        return AsyncDataClient(key, self.__loop)
+
+    def start(self, host='', port=5025):
+        '''
+        Start network service, run the event loop until stop()
+        '''
+        sys.stdout.write('Start running network service (asyncio)...\n')
+        loop = asyncio.new_event_loop()
+        self.__loop = loop
+        self.__executor = concurrent.futures.ThreadPoolExecutor(self.max_clients, thread_name_prefix='control')
+        try:
+            loop.run_until_complete(self.__serve(host, port))
+        finally:
+            self.__loop = None
+            loop.run_until_complete(loop.shutdown_asyncgens())
+            loop.close()
+            self.__executor.shutdown(wait=False)
+
+    def stop(self):
+        '''
+        Stop network service
+        '''
+        loop, stopped = self.__loop, self.__stopped
+        if loop and stopped:
+            try:
+                loop.call_soon_threadsafe(stopped.set)
+            except RuntimeError:  # loop closed
+                pass
+        NetworkService.stop(self)
+
+    async def __serve(self, host, port):
+        self.__stopped = asyncio.Event()
+        server = await asyncio.start_server(self.__serve_client, host or None, port, reuse_address=True,
+                                            backlog=self.backlog)
+        sys.stdout.write('Listening on 0.0.0.0:{0}\n'.format(port))
+        try:
+            await self.__stopped.wait()
+        finally:
+            server.close()
+            tasks = list(self.__connections.values())
+            for writer in list(self.__connections):
+                writer.close()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await server.wait_closed()
+
+    async def __serve_client(self, reader, writer):
+        '''
+        Process command and other input from one control connection
+        '''
+        address = writer.get_extra_info('peername')
+        sys.stdout.write('Accept connection from \"{0}:{1}\"\n'.format(address[0], address[1]))
+        control = StreamControl(self.__loop, writer)
+        self.__connections[writer] = asyncio.current_task()
+        if not self.open_client(control):
+            self.reject_client(control)
+            await asyncio.sleep(0)  # let the reply be written
+            self.__connections.pop(writer, None)
+            writer.close()
+            return
+        try:
+            while not self.__stopped.is_set():
+                request = await reader.readline()
+                if not request:
+                    break
+                await self.__loop.run_in_executor(self.__executor, self.process_request, control, request.decode('ascii'))
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except:
+            traceback.print_exc()
+        finally:
+            await self.__loop.run_in_executor(self.__executor, self.close_client, control)
+            self.__connections.pop(writer, None)
+            writer.close()
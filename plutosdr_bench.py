@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+# -*-coding:utf-8-*-
+# Description: End-to-end throughput benchmark of DeviceService/NetworkService over loopback with a simulated device
+
+import argparse
+import contextlib
+import json
+import multiprocessing
+import os
+import socket
+import sys
+import threading
+import time
+
+from plutosdr import DeviceService, NetworkService
+from plutosdr_aio import AsyncNetworkService
+from plutosdr_sim import ReplayBackend, SimulatedBackend
+
+HEADER_SIZE = 33  # '=sqqqii'
+MULTICAST_GROUP = '239.255.50.25'
+
+
+def receive_data(port_pipe, counters, stop_event, multicast_port=None):
+    '''
+    UDP consumer running in its own process, so its CPU time is not charged to the server
+    Parameters:
+        port_pipe: pipe used to report the bound UDP port
+        counters: shared array [packets, samples]
+        stop_event: set when the benchmark case finishes
+        multicast_port: join MULTICAST_GROUP on this port (loopback interface) instead of a unicast port
+    '''
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 8 * 1024 * 1024)
+    if multicast_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, True)
+        sock.bind(('', multicast_port))
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP,
+                        socket.inet_aton(MULTICAST_GROUP) + socket.inet_aton('127.0.0.1'))
+    else:
+        sock.bind(('127.0.0.1', 0))
+    sock.settimeout(0.2)
+    port_pipe.send(sock.getsockname()[1])
+    buffer = bytearray(64 * 1024)
+    packets = samples = 0
+    while not stop_event.is_set():
+        try:
+            size = sock.recv_into(buffer)
+        except socket.timeout:
+            continue
+        packets += 1
+        samples += (size - HEADER_SIZE) // 4
+        counters[0], counters[1] = packets, samples
+    sock.close()
+
+
+class BenchmarkCase():
+    '''
+    One DeviceService/NetworkService pair over loopback fed by SimulatedBackend
+    Parameters:
+        sampling_count: I/Q sampling count per refill
+        clients: number of UDP consumers
+        rate: sampling rate requested through the control protocol
+        pace: pace of the simulated device, 0 means as fast as possible
+        server: "thread" (NetworkService) or "asyncio" (AsyncNetworkService)
+        multicast: consumers join one multicast stream requested by a single control connection
+        replay: recording played (memory-mapped) instead of the synthetic waveform
+        workers: serve data from this many worker processes through shared memory (ShmNetworkService), 0 for none
+    '''
+
+    def __init__(self, sampling_count, clients, rate, pace, server='thread', multicast=False, replay=None, workers=0):
+        self.sampling_count = sampling_count
+        self.clients = clients
+        self.rate = rate
+        self.pace = pace
+        self.server = server
+        self.multicast = multicast
+        self.workers = workers
+        self.__backend = ReplayBackend(replay, pace=pace) if replay else SimulatedBackend(pace=pace)
+        self.__receivers = []
+        self.__controls = []
+        self.__device = None
+        self.__network = None
+        self.__server = None
+        self.__stop_event = multiprocessing.Event()
+
+    def setup(self):
+        '''
+        Spawn consumers, start the services and register every consumer through the control protocol
+        '''
+        ports = []
+        multicast_port = free_port(socket.SOCK_DGRAM) if self.multicast else None
+        for _ in range(self.clients):
+            parent, child = multiprocessing.Pipe()
+            counters = multiprocessing.RawArray('q', 2)
+            receiver = multiprocessing.Process(target=receive_data,
+                                               args=(child, counters, self.__stop_event, multicast_port))
+            receiver.daemon = True
+            receiver.start()
+            ports.append(parent.recv())
+            self.__receivers.append((receiver, counters))
+
+        self.__device = DeviceService(sampling_count=self.sampling_count, context='sim:', backend=self.__backend)
+        if self.workers:
+            from plutosdr_shm import ShmNetworkService
+            self.__network = ShmNetworkService(self.__device, max_clients=self.clients, workers=self.workers)
+        elif self.server == 'asyncio':
+            self.__network = AsyncNetworkService(self.__device, max_clients=self.clients)
+        else:
+            self.__network = NetworkService(self.__device, max_clients=self.clients)
+        port = free_port()
+        self.__server = threading.Thread(target=self.__network.start, args=('127.0.0.1', port))
+        self.__server.daemon = True
+        self.__server.start()
+
+        if self.multicast:
+            control = connect(port)
+            control.sendall('*multicast={0}:{1}:1\n'.format(MULTICAST_GROUP, multicast_port).encode('ascii'))
+            self.__controls.append(control)
+        else:
+            for udp_port in ports:
+                control = connect(port)
+                control.sendall('*udp=127.0.0.1:{0}\n'.format(udp_port).encode('ascii'))
+                self.__controls.append(control)
+        self.__controls[0].sendall('#long:sampling_frequency:{0}\n'.format(self.rate).encode('ascii'))
+        self.__controls[0].sendall(b'*task=on\n')
+
+    def snapshot(self):
+        '''
+        Take counters at one instant
+        '''
+        cpu = time.process_time()
+        if self.workers:  # as last reported by the workers
+            cpu += self.__network.worker_statistics()['worker_cpu_seconds']
+        return {
+            'time': time.perf_counter(),
+            'cpu': cpu,
+            'refills': self.__backend.refills,
+            'dropped_buffers': self.__backend.dropped_buffers,
+            'ring_dropped': self.__device.statistics()['ring_dropped'],
+            'client_dropped': sum(client['dropped'] for client in self.__network.statistics().values()),
+            'packets': sum(counters[0] for _, counters in self.__receivers),
+            'samples': sum(counters[1] for _, counters in self.__receivers)
+        }
+
+    def teardown(self):
+        for control in self.__controls:
+            control.close()
+        self.__network.stop()
+        self.__server.join(5)
+        self.__stop_event.set()
+        for receiver, _ in self.__receivers:
+            receiver.join(5)
+
+    def run(self, warmup, duration):
+        '''
+        Run the case and return its metrics
+        '''
+        self.setup()
+        try:
+            time.sleep(warmup)
+            begin = self.snapshot()
+            time.sleep(duration)
+            end = self.snapshot()
+        finally:
+            self.teardown()
+        elapsed = end['time'] - begin['time']
+        captured = (end['refills'] - begin['refills']) * self.sampling_count / elapsed / 1e6
+        cpu = (end['cpu'] - begin['cpu']) / elapsed * 100
+        return {
+            'sampling_count': self.sampling_count,
+            'clients': self.clients,
+            'rate': self.rate,
+            'pace': self.pace,
+            'server': self.server,
+            'multicast': self.multicast,
+            'workers': self.workers,
+            'captured_msps': captured,
+            'delivered_msps': (end['samples'] - begin['samples']) / elapsed / 1e6 / self.clients,
+            'packets_per_second': (end['packets'] - begin['packets']) / elapsed,
+            'cpu_percent': cpu,
+            'cpu_percent_per_msps': cpu / captured if captured else float('nan'),
+            'dropped_buffers': end['dropped_buffers'] - begin['dropped_buffers'],
+            'ring_dropped': end['ring_dropped'] - begin['ring_dropped'],
+            'client_dropped': end['client_dropped'] - begin['client_dropped']
+        }
+
+
+def free_port(kind=socket.SOCK_STREAM):
+    sock = socket.socket(socket.AF_INET, kind)
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def connect(port, timeout=5):
+    deadline = time.time() + timeout
+    while True:
+        try:
+            return socket.create_connection(('127.0.0.1', port))
+        except OSError:
+            if time.time() > deadline:
+                raise
+            time.sleep(0.05)
+
+
+def parse_list(value):
+    return [int(float(item)) for item in value.split(',') if item]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='PlutoSDR service throughput benchmark (simulated device over loopback)')
+    parser.add_argument('--counts', type=parse_list, default=[512, 2048, 8192], help='sampling_count values, eg. 512,2048,8192')
+    parser.add_argument('--clients', type=parse_list, default=[1, 2, 3], help='client counts, eg. 1,2,3')
+    parser.add_argument('--rate', type=int, default=10000000, help='sampling_frequency in samples/s')
+    parser.add_argument('--pace', type=float, default=1.0, help='simulated device pace, 1 for real time, 0 for flat-out')
+    parser.add_argument('--server', choices=('thread', 'asyncio'), default='thread', help='network service implementation')
+    parser.add_argument('--multicast', action='store_true',
+                        help='also run every case as one multicast stream joined by all consumers')
+    parser.add_argument('--workers', type=parse_list, default=[0],
+                        help='worker process counts of the shared memory data plane, eg. 0,1,2,4 (0 for none)')
+    parser.add_argument('--replay', help='replay this I/Q recording (eg. a .sigmf-data file) instead of synthetic tones')
+    parser.add_argument('--warmup', type=float, default=1.0, help='seconds before measuring')
+    parser.add_argument('--duration', type=float, default=5.0, help='seconds measured per case')
+    parser.add_argument('--json', help='write results to this file')
+    parser.add_argument('--verbose', action='store_true', help='keep the service log on stdout')
+    args = parser.parse_args()
+
+    report = sys.stdout
+    columns = ('sampling_count', 'clients', 'multicast', 'workers', 'captured_msps', 'delivered_msps', 'packets_per_second',
+               'cpu_percent', 'cpu_percent_per_msps', 'dropped_buffers', 'ring_dropped', 'client_dropped')
+    report.write('{0:>14} {1:>7} {2:>9} {3:>7} {4:>13} {5:>14} {6:>18} {7:>11} {8:>20} {9:>15} {10:>12} {11:>14}\n'.format(*columns))
+    results = []
+    for sampling_count in args.counts:
+        for clients in args.clients:
+            for multicast in (False, True) if args.multicast else (False,):
+                for workers in args.workers:
+                    case = BenchmarkCase(sampling_count, clients, args.rate, args.pace, args.server, multicast,
+                                         args.replay, workers)
+                    with open(os.devnull, 'w') as devnull:
+                        with contextlib.redirect_stdout(report if args.verbose else devnull):
+                            result = case.run(args.warmup, args.duration)
+                    results.append(result)
+                    report.write('{0:>14} {1:>7} {2!s:>9} {3:>7} {4:>13.3f} {5:>14.3f} {6:>18.1f} {7:>11.1f} {8:>20.2f} {9:>15} {10:>12} {11:>14}\n'.format(
+                        *[result[column] for column in columns]))
+                    report.flush()
+    if args.json:
+        with open(args.json, 'w') as fd:
+            json.dump(results, fd, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+# -*-coding:utf-8-*-
+# Description: Compact I/Q payload encodings of the data stream, encoder (server) and decoder (client)
+
+import struct
+import zlib
+
+import numpy as np
+
+from plutosdr import DATA_HEADER_V2, FULL_SCALE
+
+# Extension following the v2 header of encoded datagrams: encoding, scale exponent, reserved, payload bytes
+ENCODING_HEADER = struct.Struct('=BbHI')
+
+ENCODING_INT16 = 0  # 16bit little endian I/Q, as format v1
+ENCODING_INT12 = 1  # 12bit two's complement, 2 values in 3 bytes
+ENCODING_INT8 = 2   # 8bit, value = int8 << exponent
+ENCODING_ZLIB = 3   # lossless, 16bit I/Q split into low and high byte planes then zlib compressed
+ENCODINGS = {'i16': ENCODING_INT16, 'i12': ENCODING_INT12, 'i8': ENCODING_INT8, 'zlib': ENCODING_ZLIB}
+
+
+def pack_int12(iq):
+    '''
+    Pack int16 values (even count) into 12bit, out of range values are clipped
+    '''
+    values = np.clip(iq, -FULL_SCALE, FULL_SCALE - 1).astype(np.uint16) & 0xfff
+    first, second = values[0::2], values[1::2]
+    packed = np.empty((len(first), 3), dtype=np.uint8)
+    packed[:, 0] = first & 0xff
+    packed[:, 1] = (first >> 8) | ((second & 0xf) << 4)
+    packed[:, 2] = second >> 4
+    return packed.tobytes()
+
+
+def unpack_int12(payload):
+    packed = np.frombuffer(payload, dtype=np.uint8).reshape(-1, 3).astype(np.uint16)
+    values = np.empty((len(packed), 2), dtype=np.uint16)
+    values[:, 0] = packed[:, 0] | ((packed[:, 1] & 0xf) << 8)
+    values[:, 1] = (packed[:, 1] >> 4) | (packed[:, 2] << 4)
+    values = values.reshape(-1).astype(np.int16)
+    return (values << 4) >> 4  # sign extend
+
+
+def pack_int8(iq):
+    '''
+    Scale int16 values into int8 with the smallest exponent keeping the peak in range
+    Return: (exponent, payload)
+    '''
+    peak = int(np.max(np.abs(iq.astype(np.int32)))) if len(iq) else 0
+    exponent = 0
+    while (peak >> exponent) > 127:
+        exponent += 1
+    if exponent:
+        rounded = (iq.astype(np.int32) + (1 << (exponent - 1))) >> exponent
+        return exponent, np.clip(rounded, -128, 127).astype(np.int8).tobytes()
+    return exponent, iq.astype(np.int8).tobytes()
+
+
+def unpack_int8(payload, exponent):
+    return np.frombuffer(payload, dtype=np.int8).astype(np.int16) << exponent
+
+
+def pack_zlib(iq, level=1):
+    planes = iq.view(np.uint8).reshape(-1, 2).T  # low bytes, then high bytes (mostly sign extension)
+    return zlib.compress(planes.tobytes(), level)
+
+
+def unpack_zlib(payload):
+    planes = np.frombuffer(zlib.decompress(payload), dtype=np.uint8).reshape(2, -1)
+    return planes.T.copy().view(np.int16).reshape(-1)
+
+
+def encode(encoding, iq):
+    '''
+    Encode int16 I/Q values
+    Return: (exponent, payload)
+    '''
+    if encoding == ENCODING_INT12:
+        return 0, pack_int12(iq)
+    if encoding == ENCODING_INT8:
+        return pack_int8(iq)
+    if encoding == ENCODING_ZLIB:
+        return 0, pack_zlib(iq)
+    return 0, iq.tobytes()
+
+
+def decode(encoding, exponent, payload):
+    '''
+    Decode a payload back into int16 I/Q values (I, Q interleaved)
+    '''
+    if encoding == ENCODING_INT12:
+        return unpack_int12(payload)
+    if encoding == ENCODING_INT8:
+        return unpack_int8(payload, exponent)
+    if encoding == ENCODING_ZLIB:
+        return unpack_zlib(payload)
+    return np.frombuffer(payload, dtype=np.int16)
+
+
+class SampleEncoder():
+    '''
+    Per-client stage sending I/Q in a compact encoding, always with the v2 header followed by ENCODING_HEADER.
+    A frame is encoded once per encoding however many clients ask for it
+    Parameters:
+        encoding: name, see ENCODINGS
+    '''
+
+    def __init__(self, encoding):
+        if encoding not in ENCODINGS:
+            raise ValueError('unknown encoding: {0}'.format(encoding))
+        self.name = encoding
+        self.encoding = ENCODINGS[encoding]
+
+    def process(self, frame):
+        '''
+        Return the encoded datagrams of a frame as (header, payload) tuples
+        '''
+        datagrams = frame.encoded.get(self.encoding)
+        if datagrams is None:
+            datagrams = []
+            for header, payload in zip(frame.headers_v2, frame.payloads):
+                exponent, encoded = encode(self.encoding, np.frombuffer(payload, dtype=np.int16))
+                extended = bytearray(header)
+                extended[2] = DATA_HEADER_V2.size + ENCODING_HEADER.size
+                extended += ENCODING_HEADER.pack(self.encoding, exponent, 0, len(encoded))
+                datagrams.append((bytes(extended), encoded))
+            frame.encoded[self.encoding] = datagrams
+        return datagrams
+
+
+def decode_datagram(datagram):
+    '''
+    Client side decoder of a data datagram (format v2, encoded or not)
+    Return: (header fields as DATA_HEADER_V2 tuple, int16 I/Q values with I and Q interleaved)
+    '''
+    header = DATA_HEADER_V2.unpack_from(datagram)
+    if header[0] != b'$':
+        raise ValueError('not a v2 data datagram')
+    size = header[2]
+    if size >= DATA_HEADER_V2.size + ENCODING_HEADER.size:
+        encoding, exponent, _, length = ENCODING_HEADER.unpack_from(datagram, DATA_HEADER_V2.size)
+        return header, decode(encoding, exponent, datagram[size: size + length])
+    return header, np.frombuffer(datagram, dtype=np.int16, offset=size)
@@ -0,0 +1,383 @@
+#!/usr/bin/env python3
+# -*-coding:utf-8-*-
+# Description: Vectorized per-client processing stages applied to captured frames before they are sent
+
+import collections
+import struct
+import threading
+
+import numpy as np
+
+from plutosdr import FULL_SCALE
+
+# Spectrum header: '%', version, header size, format, fft size, averages, overlap (percent), sequence, sample counter,
+# timestamp (ns), frequency, bandwidth, sampling rate, gain, bins, dB offset, dB step
+SPECTRUM_HEADER = struct.Struct('=sBBBIHHIQqqqqiiff')
+
+# Spectrum formats, float32 dBFS or uint8 (dBFS = offset + value * step)
+FORMAT_FLOAT32 = 0
+FORMAT_UINT8 = 1
+FORMATS = {'f32': FORMAT_FLOAT32, 'u8': FORMAT_UINT8}
+
+WINDOWS = {
+    'rect': np.ones,
+    'hann': np.hanning,
+    'hamming': np.hamming,
+    'blackman': np.blackman
+}
+
+# Largest payload which fits in one UDP datagram together with the header
+MAX_DATAGRAM = 65507
+
+
+def frame_samples(frame):
+    '''
+    Complex64 view of the I/Q held by a frame (scaled to full scale 1.0)
+    '''
+    iq = np.frombuffer(frame.buffer, dtype=np.int16, count=frame.size // 2)
+    return iq.astype(np.float32).view(np.complex64) * np.float32(1.0 / FULL_SCALE)
+
+
+class PsdEstimator():
+    '''
+    Welch power spectral density of the sample stream, one spectrum datagram per "averages" segments
+    Parameters:
+        fft_size: FFT length (bins), a power of 2
+        overlap: overlap of consecutive segments in percent (0~90)
+        window: window name, see WINDOWS
+        averages: segments averaged per spectrum
+        output: 'f32' (float32 dBFS) or 'u8' (uint8, dBFS = db_offset + value * db_step)
+        db_offset, db_step: uint8 scaling
+    '''
+
+    def __init__(self, fft_size=1024, overlap=50, window='hann', averages=8, output='f32', db_offset=-160.0, db_step=0.625):
+        if fft_size < 16 or fft_size & (fft_size - 1):
+            raise ValueError('fft size must be a power of 2: {0}'.format(fft_size))
+        if window not in WINDOWS or output not in FORMATS or not 0 <= overlap <= 90 or averages < 1:
+            raise ValueError('invalid psd setting: {0}:{1}:{2}:{3}'.format(overlap, window, averages, output))
+        self.format = FORMATS[output]
+        if SPECTRUM_HEADER.size + fft_size * (4 if self.format == FORMAT_FLOAT32 else 1) > MAX_DATAGRAM:
+            raise ValueError('fft size {0} does not fit in one datagram as {1}'.format(fft_size, output))
+        self.fft_size = fft_size
+        self.overlap = overlap
+        self.window_name = window
+        self.averages = averages
+        self.db_offset, self.db_step = (db_offset, db_step) if self.format == FORMAT_UINT8 else (0.0, 1.0)
+        self.hop = max(1, fft_size - fft_size * overlap // 100)
+        self.window = WINDOWS[window](fft_size).astype(np.float32)
+        self.__normalize = 1.0 / float(np.sum(self.window)) ** 2
+        self.__header = bytearray(SPECTRUM_HEADER.size)
+        self.__sequence = 0
+        self.reset()
+
+    def settings(self):
+        return (self.fft_size, self.overlap, self.window_name, self.averages,
+                'f32' if self.format == FORMAT_FLOAT32 else 'u8')
+
+    def reset(self):
+        '''
+        Forget buffered samples and partial averages (retune, gap in the stream)
+        '''
+        self.__tail = np.zeros(0, dtype=np.complex64)
+        self.__accumulator = np.zeros(self.fft_size, dtype=np.float64)
+        self.__accumulated = 0
+        self.__first_sample = 0
+        self.__next_sample = None
+        self.__parameters = None
+
+    def process(self, frame):
+        '''
+        Consume a frame, return the spectrum datagrams completed by it as (header, payload) tuples
+        '''
+        parameters = (frame.frequency, frame.rf_bandwidth, frame.sampling_rate)
+        if parameters != self.__parameters:
+            self.reset()
+            self.__parameters = parameters
+        elif frame.sample_counter != self.__next_sample:
+            self.__tail = self.__tail[:0]  # dropped frames: segments must not straddle the gap
+        self.__next_sample = frame.sample_counter + frame.size // 4
+
+        samples = frame_samples(frame)
+        base = frame.sample_counter - len(self.__tail)  # sample counter of samples[0]
+        if len(self.__tail):
+            samples = np.concatenate((self.__tail, samples))
+        segments = (len(samples) - self.fft_size) // self.hop + 1 if len(samples) >= self.fft_size else 0
+        self.__tail = samples[segments * self.hop:].copy()
+        if not segments:
+            return []
+
+        windows = np.lib.stride_tricks.sliding_window_view(samples, self.fft_size)[::self.hop][:segments]
+        spectra = np.fft.fft(windows * self.window, axis=1)
+        power = spectra.real ** 2 + spectra.imag ** 2
+
+        datagrams = []
+        index = 0
+        while index < segments:
+            count = min(segments - index, self.averages - self.__accumulated)
+            if not self.__accumulated:
+                self.__first_sample = base + index * self.hop
+            self.__accumulator += power[index: index + count].sum(axis=0)
+            self.__accumulated += count
+            index += count
+            if self.__accumulated == self.averages:
+                datagrams.append(self.__emit(frame))
+                self.__accumulator[:] = 0
+                self.__accumulated = 0
+        return datagrams
+
+    def __emit(self, frame):
+        spectrum = np.fft.fftshift(10 * np.log10(self.__accumulator * (self.__normalize / self.averages) + 1e-20))
+        if self.format == FORMAT_UINT8:
+            payload = np.clip(np.rint((spectrum - self.db_offset) / self.db_step), 0, 255).astype(np.uint8)
+        else:
+            payload = spectrum.astype(np.float32)
+        SPECTRUM_HEADER.pack_into(self.__header, 0, b'%', 1, SPECTRUM_HEADER.size, self.format, self.fft_size,
+                                  self.averages, self.overlap, self.__sequence, self.__first_sample, frame.timestamp,
+                                  frame.frequency, frame.rf_bandwidth, frame.sampling_rate, frame.gain, self.fft_size,
+                                  self.db_offset, self.db_step)
+        self.__sequence = (self.__sequence + 1) & 0xffffffff
+        return bytes(self.__header), payload.tobytes()
+
+
+def design_lowpass(decimation, taps_per_phase=16, beta=8.0):
+    '''
+    Kaiser windowed-sinc lowpass for decimation, passband ~0.8 of the output Nyquist band, unity DC gain
+    Return: taps reshaped into polyphase form (taps_per_phase, decimation)
+    '''
+    if decimation not in _FILTERS:
+        length = taps_per_phase * decimation
+        n = np.arange(length) - (length - 1) / 2.0
+        cutoff = 0.45 / decimation  # cycles/sample at the input rate
+        taps = 2 * cutoff * np.sinc(2 * cutoff * n) * np.kaiser(length, beta)
+        taps /= np.sum(taps)
+        _FILTERS[decimation] = taps[::-1].astype(np.float32).reshape(taps_per_phase, decimation)
+    return _FILTERS[decimation]
+
+
+# Filter designs shared by every converter, keyed by decimation
+_FILTERS = {}
+
+
+class DigitalDownConverter():
+    '''
+    NCO frequency shift followed by a polyphase FIR decimator, state is kept across frames
+    Parameters:
+        offset: channel center relative to the RX LO (Hz)
+        rate: requested output sampling rate, the decimation is the nearest integer ratio
+    '''
+
+    def __init__(self, offset, rate):
+        if rate <= 0:
+            raise ValueError('invalid output rate: {0}'.format(rate))
+        self.offset = offset
+        self.rate = rate
+        self.input_rate = None
+        self.decimation = 1
+        self.__phasors = {}
+        self.reset()
+
+    def reset(self):
+        '''
+        Drop filter history and NCO phase (retune, gap in the stream)
+        '''
+        self.__history = np.zeros(0, dtype=np.complex64)
+        self.__phase = 1.0 + 0j
+        self.__next_sample = None
+
+    def output_rate(self):
+        return self.input_rate // self.decimation if self.input_rate else self.rate
+
+    def __configure(self, input_rate):
+        self.input_rate = input_rate
+        self.decimation = max(1, int(round(input_rate / float(self.rate))))
+        self.__taps = design_lowpass(self.decimation)
+        self.__phasors.clear()
+        self.reset()
+
+    def __nco(self, count):
+        '''
+        Phasor table for count samples (cached) and the phase step over the whole table
+        '''
+        if count not in self.__phasors:
+            step = -2 * np.pi * self.offset / self.input_rate
+            self.__phasors[count] = (np.exp(1j * step * np.arange(count)).astype(np.complex64), np.exp(1j * step * count))
+        return self.__phasors[count]
+
+    def process(self, frame, target):
+        '''
+        Shift and decimate the I/Q of a frame, write int16 I/Q into target (bytearray)
+        Return: bytes written
+        '''
+        if frame.sampling_rate != self.input_rate:
+            self.__configure(frame.sampling_rate)
+        elif frame.sample_counter != self.__next_sample:
+            self.reset()
+        self.__next_sample = frame.sample_counter + frame.size // 4
+
+        samples = frame_samples(frame)
+        if self.offset:
+            phasors, rotation = self.__nco(len(samples))
+            samples = samples * (phasors * np.complex64(self.__phase))
+            self.__phase *= rotation
+            self.__phase /= abs(self.__phase)
+        if len(self.__history):
+            samples = np.concatenate((self.__history, samples))
+
+        taps_per_phase, decimation = self.__taps.shape
+        blocks = len(samples) // decimation
+        outputs = blocks - taps_per_phase + 1
+        if outputs <= 0:
+            self.__history = samples
+            return 0
+        # Polyphase: rows are input blocks of one output period, each of the taps_per_phase sub-filters is applied
+        # to a shifted run of rows, so only retained outputs are computed
+        rows = samples[:blocks * decimation].reshape(blocks, decimation)
+        output = rows[0:outputs] @ self.__taps[0]
+        for index in range(1, taps_per_phase):
+            output += rows[index:index + outputs] @ self.__taps[index]
+        self.__history = samples[outputs * decimation:]
+
+        count = min(outputs, len(target) // 4)
+        iq = np.frombuffer(target, dtype=np.int16, count=count * 2)
+        np.clip(np.rint(output[:count].view(np.float32) * FULL_SCALE), -32768, 32767, out=iq, casting='unsafe')
+        return count * 4
+
+
+# Hann windows of frame_level, keyed by fft size
+_WINDOWS = {}
+
+# Longest pre-trigger hold of a squelch: seconds, and samples whatever the sampling rate (16MB of I/Q)
+MAX_PRE_TRIGGER = 1.0
+MAX_PRE_TRIGGER_SAMPLES = 1 << 22
+
+
+def frame_level(frame, fft_size=0):
+    '''
+    Power of a frame in dBFS, over the whole band (fft_size 0) or in the strongest bin of fft_size averaged
+    Hann windowed segments (a full scale tone reads 0 dBFS either way). Cached in the frame, shared by every
+    squelch asking for the same measure
+    '''
+    level = frame.levels.get(fft_size)
+    if level is None:
+        iq = np.frombuffer(frame.buffer, dtype=np.int16, count=frame.size // 2).astype(np.float32)
+        if fft_size and len(iq) >= fft_size * 2:
+            segments = len(iq) // (fft_size * 2)
+            samples = iq[:segments * fft_size * 2].view(np.complex64).reshape(segments, fft_size)
+            window = _WINDOWS.get(fft_size)
+            if window is None:
+                window = _WINDOWS[fft_size] = np.hanning(fft_size).astype(np.float32)
+            spectrum = np.fft.fft(samples * window, axis=1)
+            power = np.max(np.mean(spectrum.real ** 2 + spectrum.imag ** 2, axis=0)) / float(np.sum(window)) ** 2
+        else:
+            power = np.dot(iq, iq) / max(len(iq) // 2, 1)
+        level = 10.0 * np.log10(max(float(power), 1e-3) / (FULL_SCALE * FULL_SCALE))
+        frame.levels[fft_size] = level
+    return level
+
+
+class Squelch():
+    '''
+    Energy detection gate of a client's stream: frames are forwarded while their level is above threshold,
+    with the frames of the pre-trigger hold before the level rises and the post-trigger hold after it falls.
+    Every opening and closing is queued in events as ("open", first sample counter, its timestamp, level) or
+    ("close", sample counter after the burst, its timestamp, burst samples)
+    Parameters:
+        threshold: dBFS, see frame_level
+        pre, post: pre/post-trigger hold in seconds (whole frames are held), pre at most MAX_PRE_TRIGGER
+        fft_size: 0 for the power of the whole band, else the strongest subband of an fft_size FFT (power of 2)
+    '''
+
+    def __init__(self, threshold, pre=0.0, post=0.0, fft_size=0):
+        if fft_size and (fft_size < 16 or fft_size & (fft_size - 1)):
+            raise ValueError('fft size must be a power of 2: {0}'.format(fft_size))
+        if pre < 0 or post < 0 or pre > MAX_PRE_TRIGGER:
+            raise ValueError('invalid squelch hold: {0}:{1}'.format(pre, post))
+        self.threshold = threshold
+        self.pre = pre
+        self.post = post
+        self.fft_size = fft_size
+        self.open = False
+        self.events = collections.deque()
+        self.bursts = 0
+        self.forwarded = 0  # samples forwarded
+        self.total = 0      # samples gated
+        self.__history = collections.deque()  # frames of the pre-trigger hold, one reference each
+        self.__history_samples = 0
+        self.__remaining = 0                  # samples of the post-trigger hold left
+        self.__start = 0                      # sample counter of the burst start
+        self.__lock = threading.Lock()        # process on the dispatch thread against close from a control thread
+        self.__closed = False
+
+    def close(self):
+        '''
+        Release the frames of the pre-trigger hold, frames processed afterwards are forwarded as they come
+        '''
+        self.__lock.acquire()
+        try:
+            self.__closed = True
+            while self.__history:
+                self.__history.popleft().release()
+            self.__history_samples = 0
+        finally:
+            self.__lock.release()
+
+    def process(self, frame):
+        '''
+        Gate a frame, return the frames to forward (each with one reference owned by the caller)
+        '''
+        self.__lock.acquire()
+        try:
+            if self.__closed:
+                frame.retain()
+                return [frame]
+            return self.__process(frame)
+        finally:
+            self.__lock.release()
+
+    def __process(self, frame):
+        samples = frame.size // 4
+        self.total += samples
+        level = frame_level(frame, self.fft_size)
+        outputs = []
+        if level >= self.threshold:
+            if not self.open:
+                self.open = True
+                self.bursts += 1
+                first = self.__history[0] if self.__history else frame
+                self.__start = first.sample_counter
+                self.events.append(('open', first.sample_counter, first.timestamp, level))
+                outputs.extend(self.__history)
+                self.__history.clear()
+                self.__history_samples = 0
+            self.__remaining = int(self.post * frame.sampling_rate)
+        elif self.open and self.__remaining > 0:
+            self.__remaining -= samples
+        elif self.open:
+            self.open = False
+            self.events.append(('close', frame.sample_counter, frame.timestamp, frame.sample_counter - self.__start))
+        if self.open:
+            frame.retain()
+            outputs.append(frame)
+            self.forwarded += sum(output.size // 4 for output in outputs)
+        else:
+            self.__hold(frame)
+        return outputs
+
+    def __hold(self, frame):
+        '''
+        Keep a frame for the pre-trigger hold, dropping the oldest ones beyond it (and everything before a gap)
+        '''
+        history = self.__history
+        if history and history[-1].sample_counter + history[-1].size // 4 != frame.sample_counter:
+            while history:
+                history.popleft().release()
+            self.__history_samples = 0
+        hold = min(int(self.pre * frame.sampling_rate), MAX_PRE_TRIGGER_SAMPLES)
+        if not hold:
+            return
+        frame.retain()
+        history.append(frame)
+        self.__history_samples += frame.size // 4
+        while self.__history_samples - history[0].size // 4 >= hold:
+            self.__history_samples -= history[0].size // 4
+            history.popleft().release()
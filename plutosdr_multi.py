@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+# -*-coding:utf-8-*-
+# Description: Serve several PlutoSDR devices from one host, every device with its own port, capture and parameters
+
+import argparse
+import collections
+import json
+import multiprocessing
+import sys
+import threading
+import traceback
+
+from plutosdr import DeviceService, NetworkService, state_file
+from plutosdr_stats import MetricsServer
+
+# One device to serve: name (metrics label), context uri, control port, initial RX buffer size, connection limit,
+# "thread", "asyncio" or "shm[:workers]" network service, kernel buffers, parameters applied at start ({name: value}),
+# the port of its own metrics endpoint (None for none) and the file its parameters persist to (None for the default
+# state_file of its context, "" for none)
+DeviceSpec = collections.namedtuple('DeviceSpec', 'name context port sampling_count max_clients server kernel_buffers '
+                                                  'parameters metrics_port state')
+DeviceSpec.__new__.__defaults__ = (2048, 3, 'thread', 4, None, None, None)
+
+
+def device_specs(contexts, port=5025, sampling_count=2048, max_clients=3, server='thread'):
+    '''
+    Specs of devices given by context uri, named "pluto0", "pluto1"... on consecutive ports from port
+    '''
+    return [DeviceSpec('pluto{0}'.format(index), context, port + index, sampling_count, max_clients, server)
+            for index, context in enumerate(contexts)]
+
+
+def load_config(path):
+    '''
+    Read a device list from a JSON file, eg.
+    {"isolation": "process", "metrics_port": 9100,
+     "devices": [{"name": "north", "context": "ip:192.168.2.1", "port": 5025, "parameters": {"frequency": 433920000}},
+                 {"name": "south", "context": "usb:1.2.5", "port": 5026, "sampling_count": 16384}]}
+    Return: (device specs, isolation, metrics port)
+    '''
+    with open(path) as fd:
+        config = json.load(fd)
+    if isinstance(config, list):
+        config = {'devices': config}
+    specs = []
+    for index, entry in enumerate(config['devices']):
+        entry = dict(entry)
+        entry.setdefault('name', 'pluto{0}'.format(index))
+        entry.setdefault('port', 5025 + index)
+        specs.append(DeviceSpec(**entry))
+    return specs, config.get('isolation', 'thread'), config.get('metrics_port')
+
+
+def check_specs(specs):
+    '''
+    Raise ValueError when names, ports or contexts are shared by several devices
+    '''
+    for field in ('name', 'port', 'context'):
+        values = [getattr(spec, field) for spec in specs]
+        duplicates = set(value for value in values if values.count(value) > 1)
+        if duplicates:
+            raise ValueError('devices share the same {0}: {1}'.format(field, ', '.join(str(value) for value in duplicates)))
+
+
+class DeviceServer():
+    '''
+    DeviceService and network service of one device, run() blocks until stop()
+    Parameters:
+        spec: DeviceSpec
+    '''
+
+    def __init__(self, spec):
+        self.spec = spec
+        self.__network = None
+        self.__metrics_server = None
+        self.__stopped = False
+        self.__lock = threading.Lock()
+
+    def run(self):
+        spec = self.spec
+        try:
+            device = DeviceService(sampling_count=spec.sampling_count, context=spec.context,
+                                   kernel_buffers=spec.kernel_buffers,
+                                   state_path=state_file(spec.context) if spec.state is None else spec.state)
+            if spec.parameters:
+                device.set_parameters(list(spec.parameters.items()))
+            if spec.server == 'asyncio':
+                from plutosdr_aio import AsyncNetworkService
+                network = AsyncNetworkService(device, spec.max_clients)
+            elif spec.server.startswith('shm'):
+                from plutosdr_shm import ShmNetworkService
+                workers = spec.server.partition(':')[2]
+                network = ShmNetworkService(device, spec.max_clients, int(workers) if workers else 2)
+            else:
+                network = NetworkService(device, spec.max_clients)
+            self.__lock.acquire()
+            try:
+                self.__network = network
+                if self.__stopped:
+                    return
+                if spec.metrics_port:
+                    self.__metrics_server = MetricsServer(self.metrics, spec.metrics_port)
+            finally:
+                self.__lock.release()
+            sys.stdout.write('Serve device \"{0}\" ({1}) on port {2}\n'.format(spec.name, spec.context, spec.port))
+            network.start(port=spec.port)
+        finally:
+            self.stop()
+
+    def stop(self):
+        self.__lock.acquire()
+        try:
+            network, self.__network = self.__network, None
+            metrics_server, self.__metrics_server = self.__metrics_server, None
+            self.__stopped = True
+        finally:
+            self.__lock.release()
+        if metrics_server:
+            metrics_server.stop()
+        if network:
+            network.stop()
+
+    def metrics(self):
+        '''
+        Metrics of this device, labelled with its name
+        '''
+        network = self.__network
+        return {'devices': {self.spec.name: network.metrics() if network else {}}}
+
+
+def run_device(spec, stop_event):
+    '''
+    Process entry of a device served in its own process, it stops when stop_event is set or on Ctrl-C
+    '''
+    server = DeviceServer(spec)
+
+    def watch():
+        stop_event.wait()
+        server.stop()
+
+    watcher = threading.Thread(target=watch, name='stop-watcher')
+    watcher.daemon = True
+    watcher.start()
+    try:
+        server.run()
+    except KeyboardInterrupt:
+        pass
+
+
+class MultiDeviceServer():
+    '''
+    Serve every device of a list at the same time. Devices never share a lock or a thread: with "thread" isolation
+    each runs its capture/dispatch/poll threads and network service in this process (refills release the GIL),
+    with "process" isolation each device is served by its own process so Python work scales across cores
+    Parameters:
+        specs: DeviceSpec list
+        isolation: "thread" or "process"
+        metrics_port: Prometheus endpoint of all devices ("thread"), or of the first device and the following ports
+                      for the next ones ("process"), None for none
+    '''
+
+    def __init__(self, specs, isolation='thread', metrics_port=None):
+        if isolation not in ('thread', 'process'):
+            raise ValueError('unknown isolation: {0}'.format(isolation))
+        check_specs(specs)
+        if isolation == 'process' and metrics_port:
+            specs = [spec._replace(metrics_port=metrics_port + index) for index, spec in enumerate(specs)]
+        self.specs = specs
+        self.isolation = isolation
+        self.metrics_port = metrics_port
+        self.__servers = []
+        self.__workers = []
+        self.__metrics_server = None
+        self.__stop_event = multiprocessing.Event()
+
+    def start(self):
+        '''
+        Start serving every device, return at once
+        '''
+        for spec in self.specs:
+            if self.isolation == 'process':
+                # Not daemonic: a device process starts processes of its own ("shm" workers), stop() ends it
+                worker = multiprocessing.Process(target=run_device, args=(spec, self.__stop_event),
+                                                 name='device-{0}'.format(spec.name))
+            else:
+                server = DeviceServer(spec)
+                self.__servers.append(server)
+                worker = threading.Thread(target=self.__run, args=(server,), name='device-{0}'.format(spec.name))
+                worker.daemon = True
+            worker.start()
+            self.__workers.append(worker)
+        if self.isolation == 'thread' and self.metrics_port:
+            self.__metrics_server = MetricsServer(self.metrics, self.metrics_port)
+
+    def serve(self):
+        '''
+        Start and block until every device stopped or Ctrl-C
+        '''
+        self.start()
+        try:
+            while any(worker.is_alive() for worker in self.__workers):
+                for worker in self.__workers:
+                    worker.join(0.5)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+
+    def stop(self, timeout=10):
+        self.__stop_event.set()
+        if self.__metrics_server:
+            self.__metrics_server.stop()
+            self.__metrics_server = None
+        for server in self.__servers:
+            server.stop()
+        for worker in self.__workers:
+            worker.join(timeout)
+            if worker.is_alive() and self.isolation == 'process':
+                sys.stdout.write('Device process \"{0}\" did not stop, terminating it.\n'.format(worker.name))
+                worker.terminate()
+                worker.join(timeout)
+        self.__workers = []
+        self.__servers = []
+
+    def metrics(self):
+        '''
+        Metrics of the devices served by this process, by device name
+        '''
+        metrics = {'devices': {}}
+        for server in self.__servers:
+            metrics['devices'].update(server.metrics()['devices'])
+        return metrics
+
+    @staticmethod
+    def __run(server):
+        try:
+            server.run()
+        except:
+            traceback.print_exc()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve several PlutoSDR devices, one control port per device')
+    parser.add_argument('contexts', nargs='*', help='device context uris, eg. ip:192.168.2.1 usb:1.2.5')
+    parser.add_argument('--config', help='JSON device list, see load_config')
+    parser.add_argument('--port', type=int, default=5025, help='control port of the first device, next ones follow')
+    parser.add_argument('--count', type=int, default=2048, help='initial sampling count of every device')
+    parser.add_argument('--max-clients', type=int, default=3, help='connections accepted per device')
+    parser.add_argument('--server', default='thread', help='network service implementation: thread, asyncio or shm[:workers]')
+    parser.add_argument('--isolation', choices=('thread', 'process'), help='serve devices from threads or processes')
+    parser.add_argument('--metrics', type=int, help='Prometheus metrics port')
+    args = parser.parse_args()
+
+    isolation, metrics_port = 'thread', None
+    if args.config:
+        specs, isolation, metrics_port = load_config(args.config)
+    else:
+        specs = device_specs(args.contexts or ['ip:192.168.2.1'], args.port, args.count, args.max_clients, args.server)
+    MultiDeviceServer(specs, args.isolation or isolation, args.metrics or metrics_port).serve()
+
+
+if __name__ == '__main__':
+    main()
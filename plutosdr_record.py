@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+# -*-coding:utf-8-*-
+# Description: Server-side recorder of the captured I/Q into rotating SigMF recordings (.sigmf-data + .sigmf-meta)
+
+import datetime
+import json
+import os
+import sys
+import threading
+import time
+import traceback
+
+from plutosdr import FrameQueue
+
+SIGMF_VERSION = '1.0.0'
+SIGMF_EXTENSION_VERSION = '1.0.0'  # "pluto" namespace of the capture segments
+WRITE_SIZE = 4 * 1024 * 1024  # bytes of frames gathered into one write
+WRITE_FRAMES = 512            # frames gathered into one write, below IOV_MAX of writev
+
+
+def iso_datetime(timestamp):
+    '''
+    SigMF datetime of a timestamp in ns since epoch
+    '''
+    moment = datetime.datetime.fromtimestamp(timestamp / 1e9, tz=datetime.timezone.utc)
+    return moment.strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+
+
+class Recording():
+    '''
+    One SigMF recording being written: the data file and the metadata written beside it when it is closed
+    Parameters:
+        path: path without extension
+        frame: first frame of the recording, gives the global metadata
+        preallocate: bytes reserved on disk at once (0 for none)
+    '''
+
+    def __init__(self, path, frame, preallocate=0):
+        self.path = path
+        self.sampling_rate = frame.sampling_rate
+        self.samples = 0
+        self.began = time.time()
+        self.__fd = os.open(path + '.sigmf-data', os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0))
+        if preallocate and hasattr(os, 'posix_fallocate'):
+            try:
+                os.posix_fallocate(self.__fd, 0, preallocate)
+            except OSError:
+                pass
+        self.__captures = []
+        self.__annotations = []
+        self.__previous = None
+        self.__next_sample = None
+        self.__global = {
+            'core:datatype': 'ci16_le',
+            'core:sample_rate': frame.sampling_rate,
+            'core:version': SIGMF_VERSION,
+            'core:hw': 'PlutoSDR (AD9361)',
+            'core:recorder': 'plutosdr.py',
+            'core:description': 'I/Q as captured, 12bit samples in 16bit integers',
+            'core:extensions': [
+                {'name': 'pluto', 'version': SIGMF_EXTENSION_VERSION, 'optional': True}  # rf_bandwidth, gain of captures
+            ]
+        }
+
+    @property
+    def size(self):
+        return self.samples * 4
+
+    def write(self, frames):
+        '''
+        Write frames in one call, adding capture segments for retunes and gaps
+        '''
+        for frame in frames:
+            self.__describe(frame)
+            self.samples += frame.size // 4
+        buffers = [memoryview(frame.buffer)[:frame.size] for frame in frames]
+        if hasattr(os, 'writev'):
+            written, expected = os.writev(self.__fd, buffers), sum(len(buffer) for buffer in buffers)
+            if written < expected:  # short write, finish with the remainder
+                self.__write_all(memoryview(b''.join(buffers))[written:])
+        else:
+            self.__write_all(memoryview(b''.join(buffers)))
+
+    def __write_all(self, view):
+        while len(view):
+            view = view[os.write(self.__fd, view):]
+
+    def __describe(self, frame):
+        '''
+        Open a capture segment when parameters change or samples are missing, annotate retunes
+        '''
+        parameters = (frame.frequency, frame.rf_bandwidth, frame.gain)
+        if parameters == self.__previous and frame.sample_counter == self.__next_sample:
+            self.__next_sample = frame.sample_counter + frame.size // 4
+            return
+        self.__captures.append({
+            'core:sample_start': self.samples,
+            'core:global_index': frame.sample_counter,
+            'core:frequency': frame.frequency,
+            'core:datetime': iso_datetime(frame.timestamp),
+            'pluto:rf_bandwidth': frame.rf_bandwidth,
+            'pluto:gain': frame.gain
+        })
+        if self.__previous and parameters[:2] != self.__previous[:2]:
+            self.__annotations.append({
+                'core:sample_start': self.samples,
+                'core:sample_count': 0,
+                'core:freq_lower_edge': frame.frequency - frame.rf_bandwidth // 2,
+                'core:freq_upper_edge': frame.frequency + frame.rf_bandwidth // 2,
+                'core:comment': 'retune to {0} Hz, bandwidth {1} Hz (parameter version {2})'.format(
+                    frame.frequency, frame.rf_bandwidth, frame.parameter_version)
+            })
+        self.__previous = parameters
+        self.__next_sample = frame.sample_counter + frame.size // 4
+
+    def close(self):
+        '''
+        Cut preallocated space and write the metadata
+        '''
+        try:
+            os.ftruncate(self.__fd, self.size)
+        finally:
+            os.close(self.__fd)
+        with open(self.path + '.sigmf-meta', 'w') as fd:
+            json.dump({'global': self.__global, 'captures': self.__captures, 'annotations': self.__annotations}, fd, indent=2)
+
+
+class Recorder():
+    '''
+    Recording sink of a DeviceService: captured frames are queued on the dispatch thread and written
+    by a dedicated writer thread in large writes, recordings rotate by size, time and sampling rate
+    Parameters:
+        path: path prefix of the recordings, "<path>-0000.sigmf-data", "<path>-0000.sigmf-meta"...
+        max_bytes: rotate when a data file reaches this size (0 for no limit)
+        max_seconds: rotate after this duration (0 for no limit)
+        depth: frames buffered in memory before dropping (the gap shows as a new capture segment)
+    '''
+
+    def __init__(self, path, max_bytes=1024 * 1024 * 1024, max_seconds=0, depth=256):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        self.files = 0
+        self.written = 0
+        self.failed = 0
+        self.__queue = FrameQueue(depth, 'drop-newest')
+        self.__device = None
+        self.__recording = None
+        self.__writer = None
+
+    def start(self, device):
+        '''
+        Attach to a device and start the writer thread
+        '''
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.__device = device
+        self.__writer = threading.Thread(target=self.__write_data)
+        self.__writer.daemon = True
+        self.__writer.start()
+        device.add_data_sink(self.put)
+        sys.stdout.write('Start recording to \"{0}\"\n'.format(self.path))
+
+    def stop(self):
+        '''
+        Detach from the device, write what is queued and close the recording
+        '''
+        if self.__device:
+            self.__device.remove_data_sink(self.put)
+        self.__queue.close(drain=True)  # wakes the writer up, it writes what is queued and ends
+        if self.__writer:
+            self.__writer.join()
+        sys.stdout.write('Stop recording to \"{0}\"\n'.format(self.path))
+
+    def put(self, frame):
+        self.__queue.put(frame)
+
+    def statistics(self):
+        return {'path': self.path, 'files': self.files, 'bytes': self.written, 'dropped': self.__queue.dropped,
+                'queued': len(self.__queue), 'failed': self.failed}
+
+    def __write_data(self):
+        '''
+        Writer thread, frames queued up to WRITE_SIZE go to disk in one write
+        '''
+        while True:
+            frame = self.__queue.get()
+            if frame is None:  # closed and drained
+                break
+            frames = [frame]
+            size = frame.size
+            while size < WRITE_SIZE and len(frames) < WRITE_FRAMES:
+                frame = self.__queue.get(0)
+                if frame is None:
+                    break
+                frames.append(frame)
+                size += frame.size
+            try:
+                self.__write(frames)
+            except:
+                self.failed += 1
+                traceback.print_exc()
+            finally:
+                for frame in frames:
+                    frame.release()
+        self.__queue.close()
+        if self.__recording:
+            self.__rotate(None)
+
+    def __write(self, frames):
+        index = 0
+        while index < len(frames):
+            recording = self.__recording
+            if recording is None or self.__expired(recording, frames[index]):
+                recording = self.__rotate(frames[index])
+            # frames for this recording: same sampling rate, within max_bytes
+            end, size = index, recording.size
+            while end < len(frames) and frames[end].sampling_rate == recording.sampling_rate and \
+                    (not self.max_bytes or size < self.max_bytes or end == index):
+                size += frames[end].size
+                end += 1
+            recording.write(frames[index:end])
+            self.written += sum(frame.size for frame in frames[index:end])
+            index = end
+
+    def __expired(self, recording, frame):
+        return frame.sampling_rate != recording.sampling_rate or \
+            (self.max_bytes and recording.size >= self.max_bytes) or \
+            (self.max_seconds and time.time() - recording.began >= self.max_seconds)
+
+    def __rotate(self, frame):
+        '''
+        Close the current recording and open the next one for frame (None to only close)
+        '''
+        if self.__recording:
+            self.__recording.close()
+            self.__recording = None
+        if frame is not None:
+            self.__recording = Recording('{0}-{1:04d}'.format(self.path, self.files), frame, self.max_bytes)
+            self.files += 1
+        return self.__recording
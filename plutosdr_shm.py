@@ -0,0 +1,734 @@
+#!/usr/bin/env python3
+# -*-coding:utf-8-*-
+# Description: Multi-process data plane, the capture process hands refilled buffers to worker processes through
+# a shared memory ring and every worker packetizes, processes and sends for its share of the clients
+
+import collections
+import multiprocessing
+import queue
+import struct
+import sys
+import threading
+import time
+import traceback
+from multiprocessing import shared_memory
+
+from plutosdr import (FLAG_SWEEP, MAX_IQ_SIZE, ChannelPipeline, DataClient, Frame, FrameQueue, NetworkService,
+                      Notifier, Packetizer, forward_frame)
+from plutosdr_stats import Histogram
+
+# Ring header: slot count, slot size, write index (absolute index of the next frame to be published)
+RING_HEADER = struct.Struct('=QQQ')
+WRITE_INDEX = struct.Struct('=Q')
+WRITE_INDEX_OFFSET = 16
+RING_HEADER_SIZE = 64
+
+# Slot table after the ring header: entry n % slots is the slot holding the frame of absolute index n
+TABLE_ENTRY = struct.Struct('=Q')
+
+# Slot header: generation, size, sequence number, sample counter, timestamp, frequency, bandwidth, sampling rate,
+# gain, flags, parameter version. The generation of a slot is odd while it is written, 2n+2 once it holds
+# the complete frame of absolute index n
+SLOT_HEADER = struct.Struct('=QQIQqqqqiiI')
+GENERATION = struct.Struct('=Q')
+SLOT_HEADER_SIZE = 128  # bytes reserved for the slot header, data starts cache line aligned
+
+MIN_SLOT_SIZE = 256 * 1024  # slots stay large enough for buffers rebuilt bigger ("*buffer="), larger frames span slots
+POLL_INTERVAL = 0.0005      # seconds a worker sleeps when it caught up with the capture process
+REPORT_INTERVAL = 0.5       # seconds between counter reports of the workers
+
+
+class SharedRing():
+    '''
+    Single producer ring of captured frames in shared memory, read by any number of processes.
+    The producer claims the free slot released first and marks it odd (being written), fills it (the capture
+    thread refills straight into it, see SlotPacketizer, other frames are copied), marks it even (complete) and
+    then publishes it at the write index through the slot table; a reader copies a complete slot and checks its
+    generation again, a slot claimed again meanwhile is counted lost. Generations, the slot table and the write
+    index are only read and written under the lock of the ring, which is the memory barrier of the handoff on any
+    host (stores of the shared memory are not seen in program order on ARM); slot data is filled and copied
+    outside of it. The producer never waits for readers longer than they read a slot header, readers falling
+    more than the ring behind skip ahead
+    Parameters:
+        name: name of an existing ring to attach, None to create one
+        slots: slot count of a created ring
+        slot_size: data bytes per slot of a created ring, rounded up to whole datagrams
+        lock: lock of the ring to attach (the lock attribute of the ring created, given to the reader processes)
+    '''
+
+    def __init__(self, name=None, slots=64, slot_size=MIN_SLOT_SIZE, lock=None):
+        if name is None:
+            self.lock = multiprocessing.Lock()
+            slot_size = -(-slot_size // MAX_IQ_SIZE) * MAX_IQ_SIZE
+            self.__memory = shared_memory.SharedMemory(create=True, size=RING_HEADER_SIZE + self.__table_size(slots) +
+                                                       slots * (SLOT_HEADER_SIZE + slot_size))
+            try:
+                RING_HEADER.pack_into(self.__memory.buf, 0, slots, slot_size, 0)
+            except:
+                self.__memory.close()
+                self.__memory.unlink()
+                raise
+        else:
+            if lock is None:
+                raise ValueError('the lock of ring \"{0}\" is required to attach it'.format(name))
+            self.lock = lock
+            self.__memory = shared_memory.SharedMemory(name=name)
+            slots, slot_size, _ = RING_HEADER.unpack_from(self.__memory.buf)
+        self.name = self.__memory.name
+        self.slots = slots
+        self.slot_size = slot_size
+        self.view = self.__memory.buf
+        self.__slots_offset = RING_HEADER_SIZE + self.__table_size(slots)
+        self.__index = self.write_index  # index of the next frame published by this process (producer only)
+        self.__free = collections.deque(range(slots))  # slots released by the producer, the oldest first
+        self.written = 0
+        self.dropped = 0  # frames not published, every slot was still held by frames of the producer
+
+    @staticmethod
+    def __table_size(slots):
+        return -(-slots * TABLE_ENTRY.size // 64) * 64
+
+    @property
+    def write_index(self):
+        return WRITE_INDEX.unpack_from(self.view, WRITE_INDEX_OFFSET)[0]
+
+    def slot_offset(self, slot):
+        return self.__slots_offset + slot * (SLOT_HEADER_SIZE + self.slot_size)
+
+    def slot_of(self, index):
+        '''
+        Slot published at absolute index, read under the lock
+        '''
+        return TABLE_ENTRY.unpack_from(self.view, RING_HEADER_SIZE + (index % self.slots) * TABLE_ENTRY.size)[0]
+
+    def slot_data(self, slot):
+        base = self.slot_offset(slot) + SLOT_HEADER_SIZE
+        return self.view[base: base + self.slot_size]
+
+    def claim(self, reserve=0):
+        '''
+        Take the free slot released first and mark it being written (producer only)
+        Return: the slot, None when no more than reserve slots are free
+        '''
+        try:
+            if len(self.__free) <= reserve:
+                return None
+            slot = self.__free.popleft()
+        except IndexError:  # taken meanwhile by another thread of the producer
+            return None
+        self.lock.acquire()
+        GENERATION.pack_into(self.view, self.slot_offset(slot), 1)
+        self.lock.release()
+        return slot
+
+    def release(self, slot):
+        '''
+        Give back a claimed slot once its frame is no longer referenced, published or not (producer only)
+        '''
+        self.__free.append(slot)
+
+    def publish(self, slot, frame, size, offset=0):
+        '''
+        Mark a claimed slot complete with the headers of frame from offset and publish it at the write index
+        '''
+        index = self.__index
+        self.lock.acquire()
+        SLOT_HEADER.pack_into(self.view, self.slot_offset(slot), 2 * index + 2, size,
+                              (frame.sequence + offset // MAX_IQ_SIZE) & 0xffffffff, frame.sample_counter + offset // 4,
+                              frame.timestamp, frame.frequency, frame.rf_bandwidth, frame.sampling_rate, frame.gain,
+                              frame.flags if not offset else frame.flags & FLAG_SWEEP,
+                              frame.parameter_version & 0xffffffff)
+        TABLE_ENTRY.pack_into(self.view, RING_HEADER_SIZE + (index % self.slots) * TABLE_ENTRY.size, slot)
+        WRITE_INDEX.pack_into(self.view, WRITE_INDEX_OFFSET, index + 1)
+        self.lock.release()
+        self.__index = index + 1
+
+    def write(self, frame):
+        '''
+        Publish a frame, never waits: a frame refilled into a slot of this ring is published in place, any other
+        is copied into the next free slots (several when it is larger than a slot).
+        Called from the dispatch thread of the capture process as its data sinker
+        '''
+        if isinstance(frame, SlotFrame) and frame.ring is self:
+            self.publish(frame.slot, frame, frame.size)
+            self.written += 1
+            return
+        source = memoryview(frame.buffer)
+        offset = 0
+        while offset < frame.size:
+            size = min(frame.size - offset, self.slot_size)
+            slot = self.claim()
+            if slot is None:
+                self.dropped += 1
+                return
+            base = self.slot_offset(slot) + SLOT_HEADER_SIZE
+            self.view[base: base + size] = source[offset: offset + size]
+            self.publish(slot, frame, size, offset)
+            self.release(slot)
+            offset += size
+        self.written += 1
+
+    def close(self):
+        self.view = None
+        self.__memory.close()
+
+    def unlink(self):
+        self.__memory.unlink()
+
+
+class RingReader():
+    '''
+    Read position of one process in a SharedRing, it starts at the next frame published
+    '''
+
+    def __init__(self, ring):
+        self.__ring = ring
+        self.index = ring.write_index
+        self.lost = 0  # frames whose slot was claimed again before they were read
+
+    def read(self, packetizer):
+        '''
+        Copy the next complete slot into a frame of packetizer and pack its headers
+        Return: the frame (one reference owned by the caller), None when no slot is ready
+        '''
+        ring = self.__ring
+        view = ring.view
+        while True:
+            if self.index >= ring.write_index:  # without the lock: seen late at worst
+                return None
+            ring.lock.acquire()
+            write_index = ring.write_index
+            if write_index - self.index > ring.slots:  # lapped, resume half a ring behind the producer
+                skipped = write_index - ring.slots // 2 - self.index
+                self.lost += skipped
+                self.index += skipped
+            base = ring.slot_offset(ring.slot_of(self.index))
+            expected = 2 * self.index + 2
+            header = SLOT_HEADER.unpack_from(view, base)
+            ring.lock.release()
+            if header[0] != expected:  # claimed again since it was published
+                self.lost += 1
+                self.index += 1
+                continue
+            size = header[1]
+            frame = packetizer.acquire()
+            frame.buffer[:size] = view[base + SLOT_HEADER_SIZE: base + SLOT_HEADER_SIZE + size]
+            ring.lock.acquire()
+            generation = GENERATION.unpack_from(view, base)[0]
+            ring.lock.release()
+            if generation != expected:  # claimed again while copying
+                frame.release()
+                self.lost += 1
+                self.index += 1
+                continue
+            (_, _, sequence, sample_counter, timestamp, frequency, bandwidth, rate, gain, flags,
+             parameter_version) = header
+            packetizer.packetize(frame, size, frequency, bandwidth, rate, gain, sample_counter, timestamp, flags,
+                                 parameter_version, sequence)
+            self.index += 1
+            return frame
+
+
+class SlotFrame(Frame):
+    '''
+    Frame of a SlotPacketizer, its buffer is a slot of the ring
+    '''
+
+    def __init__(self, packetizer, size, ring, slot):
+        Frame.__init__(self, packetizer, size, ring.slot_data(slot)[:size])
+        self.ring = ring
+        self.slot = slot
+
+
+class SlotPacketizer(Packetizer):
+    '''
+    Packetizer of the capture process whose frames are slots of a SharedRing, the capture thread refills straight
+    into shared memory and the ring publishes the frame without copying it. A slot goes back to the ring when its
+    frame is released. Frames larger than a slot, or acquired while half of the ring is held by frames still
+    referenced, are frames of Packetizer which the ring copies
+    Parameters:
+        ring: SharedRing created by this process
+        sampling_count: I/Q sampling count per refill
+    '''
+
+    def __init__(self, ring, sampling_count):
+        Packetizer.__init__(self, sampling_count, frames=2)
+        self.__ring = ring
+        self.__size = sampling_count * 4
+        self.__lock = threading.Lock()
+        self.__frames = [None] * ring.slots  # frame of every slot, built again after a resize
+
+    def resize(self, sampling_count):
+        Packetizer.resize(self, sampling_count)
+        self.__size = sampling_count * 4
+
+    def acquire(self):
+        size = self.__size
+        slot = self.__ring.claim(self.__ring.slots // 2) if size <= self.__ring.slot_size else None
+        if slot is None:
+            return Packetizer.acquire(self)
+        frame = self.__frames[slot]
+        if frame is None or len(frame.buffer) != size:
+            frame = self.__frames[slot] = SlotFrame(self, size, self.__ring, slot)
+        frame.refs = 1
+        return frame
+
+    def retain(self, frame):
+        if not isinstance(frame, SlotFrame):
+            Packetizer.retain(self, frame)
+            return
+        self.__lock.acquire()
+        frame.refs += 1
+        self.__lock.release()
+
+    def release(self, frame):
+        if not isinstance(frame, SlotFrame):
+            Packetizer.release(self, frame)
+            return
+        self.__lock.acquire()
+        frame.refs -= 1
+        released = frame.refs == 0
+        self.__lock.release()
+        if released:
+            self.__ring.release(frame.slot)
+
+    def close(self):
+        '''
+        Drop the frames viewing the slots, the ring can be closed once the frames still referenced are released
+        '''
+        self.__frames = [None] * self.__ring.slots
+
+
+class RingWorker():
+    '''
+    Data plane of one worker process: it reads every frame from the ring and serves the clients assigned to it
+    with the DataClient, ChannelPipeline and encoders of the single process server
+    Parameters:
+        ring_name, ring_lock: name and lock of the SharedRing
+        outbox: queue receiving the counter reports
+        index: index of this worker
+    '''
+
+    def __init__(self, ring_name, ring_lock, outbox, index):
+        self.index = index
+        self.__ring = SharedRing(ring_name, lock=ring_lock)
+        self.__reader = RingReader(self.__ring)
+        self.__packetizer = Packetizer(self.__ring.slot_size // 4)
+        self.__outbox = outbox
+        self.__lock = threading.Lock()
+        self.__clients = {}
+        self.__pipelines = {}  # (offset, rate): pipeline shared by the clients of this worker
+        self.__stopped = threading.Event()
+
+    def run(self, inbox):
+        control = threading.Thread(target=self.__control, args=(inbox,), name='control')
+        control.daemon = True
+        control.start()
+        try:
+            while not self.__stopped.is_set():
+                frame = self.__reader.read(self.__packetizer)
+                if frame is None:
+                    time.sleep(POLL_INTERVAL)
+                    continue
+                try:
+                    self.__broadcast(frame)
+                except:
+                    traceback.print_exc()
+                finally:
+                    frame.release()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.__lock.acquire()
+            for client in self.__clients.values():
+                client.close()
+            self.__clients.clear()
+            self.__lock.release()
+            self.__ring.close()
+
+    def __broadcast(self, frame):
+        '''
+        Same as NetworkService.__broadcast_data for the clients of this worker
+        '''
+        self.__lock.acquire()
+        clients = [client for client in self.__clients.values() if client.group is None]
+        self.__lock.release()
+        outputs = {}
+        try:
+            for client in clients:
+                pipeline = client.pipeline
+                if pipeline is not None and pipeline not in outputs:
+                    try:
+                        outputs[pipeline] = pipeline.process(frame)
+                    except:
+                        outputs[pipeline] = None
+                        traceback.print_exc()
+                output = outputs[pipeline] if pipeline is not None else frame
+                if not output:
+                    continue
+                try:
+                    for notification in forward_frame(client, output):
+                        self.__outbox.put(('notify', self.index, client.key, notification))
+                except:
+                    traceback.print_exc()
+        finally:
+            for output in outputs.values():
+                if output:
+                    output.release()
+
+    def __control(self, inbox):
+        '''
+        Apply the settings forwarded by RemoteDataClient and report counters every REPORT_INTERVAL
+        '''
+        reported = time.perf_counter()
+        while not self.__stopped.is_set():
+            try:
+                message = inbox.get(timeout=REPORT_INTERVAL)
+            except queue.Empty:
+                message = None
+            except (EOFError, OSError):  # parent gone
+                break
+            if message:
+                try:
+                    self.__apply(message)
+                except:
+                    traceback.print_exc()
+            if time.perf_counter() - reported >= REPORT_INTERVAL:
+                reported = time.perf_counter()
+                self.__report()
+        self.__stopped.set()
+
+    def __apply(self, message):
+        command, key, arguments = message[0], message[1] if len(message) > 1 else None, message[2:]
+        if command == 'stop':
+            self.__stopped.set()
+            return
+        self.__lock.acquire()
+        try:
+            if command == 'open':
+                self.__clients[key] = DataClient(key, *arguments)
+                return
+            client = self.__clients.get(key)
+            if client is None:
+                return
+            if command == 'close':
+                del self.__clients[key]
+                self.__set_pipeline(client, None)
+                client.close()
+            elif command == 'connect':
+                client.connect(*arguments)
+            elif command == 'connect_tcp':
+                client.connect_tcp(*arguments)
+            elif command == 'configure':
+                client.configure(*arguments)
+            elif command == 'set':
+                setattr(client, arguments[0], arguments[1])
+            elif command == 'squelch':  # settings only, the squelch holds frames of this process
+                from plutosdr_dsp import Squelch
+                client.squelch = Squelch(*arguments[0]) if arguments[0] else None
+            elif command == 'pipeline':
+                self.__set_pipeline(client, arguments[0])
+        finally:
+            self.__lock.release()
+
+    def __set_pipeline(self, client, key):
+        previous = client.pipeline
+        pipeline = None
+        if key:
+            pipeline = self.__pipelines.get(key)
+            if pipeline is None:
+                pipeline = ChannelPipeline(self.__ring.slot_size // 4, key[0], key[1])
+                self.__pipelines[key] = pipeline
+            pipeline.subscribers += 1
+        client.pipeline = pipeline
+        if previous:
+            previous.subscribers -= 1
+            if not previous.subscribers:
+                del self.__pipelines[previous.key]
+
+    def __report(self):
+        self.__lock.acquire()
+        clients = list(self.__clients.values())
+        self.__lock.release()
+        statistics = {}
+        for client in clients:
+            statistics[client.key] = client.statistics()
+            statistics[client.key]['send_time'] = client.send_time
+            squelch = client.squelch
+            if squelch:
+                statistics[client.key]['squelch'] = (squelch.open, squelch.bursts, squelch.forwarded, squelch.total)
+        try:
+            self.__outbox.put(('stats', self.index, statistics, time.process_time(), self.__reader.lost))
+        except (EOFError, OSError):
+            self.__stopped.set()
+
+
+def run_worker(ring_name, ring_lock, inbox, outbox, index):
+    '''
+    Process entry of a worker
+    '''
+    try:
+        RingWorker(ring_name, ring_lock, outbox, index).run(inbox)
+    except KeyboardInterrupt:
+        pass
+
+
+class RemoteDataClient():
+    '''
+    Data client of the capture process for a client served by a worker process: the settings NetworkService
+    makes are forwarded to the worker, the counters come back with its reports
+    Parameters:
+        key: identifier of the client
+        inbox: queue of the worker
+        depth, policy: initial queue setting, see FrameQueue
+    '''
+
+    def __init__(self, key, inbox, depth=32, policy='drop-oldest'):
+        self.key = key
+        self.ack = False
+        self.closed = False
+        self.control = None
+        self.sent = 0
+        self.failed = 0
+        self.send_time = Histogram()
+        self.__inbox = inbox
+        self.__version = 1
+        self.__processor = None
+        self.__encoder = None
+        self.__group = None
+        self.__squelch = None
+        self.__pipeline = None
+        self.__notifier = Notifier(key)
+        self.__statistics = {'policy': policy, 'depth': depth, 'queued': 0, 'dropped': 0, 'sent': 0, 'failed': 0}
+        inbox.put(('open', key, depth, policy))
+
+    @property
+    def version(self):
+        return self.__version
+
+    @version.setter
+    def version(self, version):
+        self.__version = version
+        self.__inbox.put(('set', self.key, 'version', version))
+
+    @property
+    def processor(self):
+        return self.__processor
+
+    @processor.setter
+    def processor(self, processor):
+        self.__processor = processor
+        self.__inbox.put(('set', self.key, 'processor', processor))
+
+    @property
+    def encoder(self):
+        return self.__encoder
+
+    @encoder.setter
+    def encoder(self, encoder):
+        self.__encoder = encoder
+        self.__inbox.put(('set', self.key, 'encoder', encoder))
+
+    @property
+    def group(self):
+        return self.__group
+
+    @group.setter
+    def group(self, group):
+        self.__group = group
+        self.__inbox.put(('set', self.key, 'group', group))
+
+    @property
+    def squelch(self):
+        '''
+        Settings of the squelch run by the worker, its counters are updated by the reports
+        '''
+        return self.__squelch
+
+    @squelch.setter
+    def squelch(self, squelch):
+        self.__squelch = squelch
+        settings = (squelch.threshold, squelch.pre, squelch.post, squelch.fft_size) if squelch else None
+        self.__inbox.put(('squelch', self.key, settings))
+
+    @property
+    def pipeline(self):
+        return self.__pipeline
+
+    @pipeline.setter
+    def pipeline(self, pipeline):
+        '''
+        The ChannelPipeline of the capture process only counts subscribers, the worker runs its own
+        '''
+        self.__pipeline = pipeline
+        self.__inbox.put(('pipeline', self.key, pipeline.key if pipeline else None))
+
+    def connect(self, host, port, ttl=None, interface=None):
+        self.__inbox.put(('connect', self.key, host, port, ttl, interface))
+
+    def connect_tcp(self, host, port):
+        self.__inbox.put(('connect_tcp', self.key, host, port))
+
+    def configure(self, depth, policy):
+        if policy not in FrameQueue.POLICIES or depth < 1:
+            raise ValueError('invalid queue setting: {0}:{1}'.format(policy, depth))
+        self.__statistics['policy'], self.__statistics['depth'] = policy, depth
+        self.__inbox.put(('configure', self.key, depth, policy))
+
+    def put(self, frame):
+        pass  # frames reach the worker through the ring
+
+    def notify(self, line):
+        '''
+        Queue a line reported by the worker for the control connection, never blocks, see Notifier
+        '''
+        if self.control and not self.closed:
+            self.__notifier.put(self.control, line)
+
+    def update(self, statistics):
+        '''
+        Take the counters reported by the worker
+        '''
+        self.send_time = statistics.pop('send_time')
+        squelch = statistics.pop('squelch', None)
+        if squelch and self.__squelch:
+            self.__squelch.open, self.__squelch.bursts, self.__squelch.forwarded, self.__squelch.total = squelch
+        self.sent, self.failed = statistics['sent'], statistics['failed']
+        self.__statistics = statistics
+
+    def statistics(self):
+        return dict(self.__statistics)
+
+    def close(self):
+        self.closed = True
+        self.__notifier.close()
+        self.__inbox.put(('close', self.key))
+
+
+class ShmNetworkService(NetworkService):
+    '''
+    NetworkService whose data plane runs in worker processes so that capture, packetizing, DSP and sends
+    do not compete for one interpreter lock. This process captures every frame straight into a SharedRing
+    and serves control connections; clients are spread over the workers (fewest clients first)
+    Paramters:
+        device: DeviceService
+        max_clients: connections accepted at the same time
+        workers: number of worker processes
+        slots: slots of the ring, a worker lagging more than this many frames loses some
+    '''
+
+    def __init__(self, device, max_clients=3, workers=2, slots=64):
+        NetworkService.__init__(self, device, max_clients)
+        self.__device = device
+        self.__outbox = multiprocessing.Queue()
+        self.__ring = SharedRing(slots=slots, slot_size=max(device.sampling_count * 4, MIN_SLOT_SIZE))
+        self.__inboxes = []
+        self.__workers = []
+        self.__clients = []  # RemoteDataClient of every worker, with the index of its worker
+        self.__reports = {}  # worker index: (cpu seconds, slots lost)
+        self.__lock = threading.Lock()
+        self.__stopped = threading.Event()
+        self.__collector = None
+        self.__packetizer = None
+        try:
+            for index in range(workers):
+                inbox = multiprocessing.Queue()
+                worker = multiprocessing.Process(target=run_worker, name='worker-{0}'.format(index),
+                                                 args=(self.__ring.name, self.__ring.lock, inbox, self.__outbox, index))
+                worker.daemon = True
+                worker.start()
+                self.__inboxes.append(inbox)
+                self.__workers.append(worker)
+            self.__collector = threading.Thread(target=self.__collect, name='collector')
+            self.__collector.daemon = True
+            self.__collector.start()
+            device.set_data_sinker(self.__ring.write)
+            self.__packetizer = SlotPacketizer(self.__ring, device.sampling_count)
+            device.set_packetizer(self.__packetizer)
+        except:
+            self.__release()  # the workers started so far end and the ring is unlinked, nothing outlives a failure
+            raise
+        sys.stdout.write('Serve data from {0} worker processes through shared memory \"{1}\"\n'.format(
+            workers, self.__ring.name))
+
+    def create_data_client(self, key):
+        self.__lock.acquire()
+        try:
+            self.__clients = [(client, index) for client, index in self.__clients if not client.closed]
+            load = [0] * len(self.__workers)
+            for _, index in self.__clients:
+                load[index] += 1
+            index = load.index(min(load))
+            client = RemoteDataClient(key, self.__inboxes[index])
+            self.__clients.append((client, index))
+            return client
+        finally:
+            self.__lock.release()
+
+    def stop(self):
+        NetworkService.stop(self)
+        self.__release()
+
+    def __release(self):
+        '''
+        Stop the workers and the collector, capture into frames of the device again, close and unlink the ring
+        '''
+        for inbox in self.__inboxes:
+            inbox.put(('stop', ))
+        for worker in self.__workers:
+            worker.join(5)
+            if worker.is_alive():
+                worker.terminate()
+        self.__stopped.set()
+        if self.__collector:
+            self.__collector.join()
+        if self.__packetizer:
+            self.__device.set_packetizer(None)
+            self.__packetizer.close()
+        try:
+            self.__ring.close()
+        except BufferError:  # a frame still referenced views a slot, the mapping goes when it is released
+            pass
+        finally:
+            self.__ring.unlink()
+
+    def worker_statistics(self):
+        '''
+        Frames written to the ring and dropped (every slot held), CPU seconds and ring frames lost of the workers
+        (as last reported)
+        '''
+        reports = list(self.__reports.values())
+        return {'workers': len(self.__workers), 'ring_written': self.__ring.written, 'ring_unpublished': self.__ring.dropped,
+                'worker_cpu_seconds': sum(cpu for cpu, _ in reports), 'ring_lost': sum(lost for _, lost in reports)}
+
+    def metrics(self):
+        metrics = NetworkService.metrics(self)
+        metrics.update(self.worker_statistics())
+        return metrics
+
+    def __collect(self):
+        '''
+        Collector thread, hands the counters reported by the workers to their RemoteDataClient
+        and sends their squelch notifications
+        '''
+        while not self.__stopped.is_set():
+            try:
+                message = self.__outbox.get(timeout=REPORT_INTERVAL)
+            except queue.Empty:
+                continue
+            except (EOFError, OSError):
+                break
+            index = message[1]
+            self.__lock.acquire()
+            clients = dict((client.key, client) for client, worker in self.__clients if worker == index)
+            self.__lock.release()
+            if message[0] == 'notify':  # squelch notification for the control connection of a client
+                client = clients.get(message[2])
+                if client:
+                    client.notify(message[3])
+                continue
+            _, _, statistics, cpu, lost = message
+            self.__reports[index] = (cpu, lost)
+            for key, values in statistics.items():
+                if key in clients:
+                    clients[key].update(values)
@@ -0,0 +1,489 @@
+#!/usr/bin/env python3
+# -*-coding:utf-8-*-
+# Description: Simulated Adalm-Pluto ('ad9361-phy' + 'cf-ad9361-lpc') used without hardware
+
+import errno
+import mmap
+import os
+import threading
+import time
+
+import numpy as np
+
+from plutosdr import FULL_SCALE, RX_STATUS_OVERFLOW, RX_STATUS_REGISTER
+
+# Number of I/Q samples in the precomputed waveform table, tones are snapped to its bins
+TABLE_SIZE = 1 << 16
+
+
+class SimulatedAttribute():
+    '''
+    A read/write attribute behaving like iio.Attr
+    '''
+
+    def __init__(self, value='0'):
+        self.__value = value
+
+    @property
+    def value(self):
+        return self.__value
+
+    @value.setter
+    def value(self, value):
+        self.__value = str(value)
+
+
+class SimulatedChannel():
+    '''
+    A channel behaving like iio.Channel
+    '''
+
+    def __init__(self, id_, output, attrs):
+        self.id = id_
+        self.output = output
+        self.enabled = False
+        self.attrs = {name: SimulatedAttribute(value) for name, value in attrs.items()}
+
+
+class SimulatedDevice():
+    '''
+    A device behaving like iio.Device, registers are kept in a dict
+    '''
+
+    def __init__(self, name, channels):
+        self.name = name
+        self.channels = channels
+        self.registers = {}
+
+    def reg_read(self, reg):
+        return self.registers.get(reg, 0)
+
+    def reg_write(self, reg, value):
+        self.registers[reg] = value
+
+
+class SimulatedContext():
+    '''
+    A context behaving like iio.Context with the two devices used by DeviceService
+    '''
+
+    def __init__(self):
+        self.generation = 0  # backend generation it was created in, see SimulatedBackend.unplug
+        # Same channel order as the 'ad9361-phy' device of a real Pluto (indices used by DeviceService):
+        # 0: RX LO, 1: TX LO, 2/3: unused, 4: RX voltage0, 5: TX voltage0
+        self.phy = SimulatedDevice('ad9361-phy', [
+            SimulatedChannel('altvoltage0', True, {'frequency': '2400000000', 'powerdown': '0', 'fastlock_store': '0',
+                                                   'fastlock_recall': '0', 'fastlock_load': '0', 'fastlock_save': '0'}),
+            SimulatedChannel('altvoltage1', True, {'frequency': '2450000000', 'powerdown': '0'}),
+            SimulatedChannel('temp0', False, {'input': '35000'}),
+            SimulatedChannel('voltage2', False, {'raw': '306'}),
+            SimulatedChannel('voltage0', False, {'rf_bandwidth': '18000000', 'sampling_frequency': '30720000',
+                                                 'gain_control_mode': 'slow_attack', 'hardwaregain': '71.000000 dB',
+                                                 'rf_port_select': 'A_BALANCED', 'rssi': '104.25 dB'}),
+            SimulatedChannel('voltage0', True, {'rf_bandwidth': '18000000', 'sampling_frequency': '30720000',
+                                                'hardwaregain': '-10.000000 dB', 'rf_port_select': 'A'})
+        ])
+        self.rx = SimulatedDevice('cf-ad9361-lpc', [
+            SimulatedChannel('voltage0', False, {}),  # I
+            SimulatedChannel('voltage1', False, {})   # Q
+        ])
+        self.devices = [self.phy, self.rx]
+
+    def find_device(self, name):
+        for device in self.devices:
+            if device.name == name:
+                return device
+        return None
+
+
+class Pacer():
+    '''
+    Clock of a simulated receiver: it waits until a buffer has been "received" and tells how many
+    buffers the kernel lost because they were not refilled in time
+    Parameters:
+        backend: backend supplying pace and kernel_buffers
+    '''
+
+    def __init__(self, backend):
+        self.__backend = backend
+        self.__clock = None   # wall time when sample 0 was "received"
+        self.__samples = 0    # samples handed out since clock start
+
+    def reset(self):
+        self.__clock = None
+
+    def wait(self, rate, count):
+        '''
+        Wait for the next buffer of count samples, return the number of buffers lost before it
+        '''
+        pace = self.__backend.pace
+        if pace <= 0:
+            return 0
+        now = time.perf_counter()
+        if self.__clock is None:
+            self.__clock = now
+            self.__samples = 0
+        # Kernel buffers hold samples which are not refilled in time, anything older is lost
+        lag = int((now - self.__clock) * rate * pace) - self.__samples
+        backlog = self.__backend.kernel_buffers * count
+        dropped = 0
+        if lag > backlog:
+            dropped = (lag - backlog) // count + 1
+            self.__samples += dropped * count
+        self.__samples += count
+        delay = self.__clock + self.__samples / (rate * pace) - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        return dropped
+
+
+class SimulatedBuffer():
+    '''
+    A RX buffer behaving like iio.Buffer, it produces interleaved int16 I/Q at the configured sampling rate
+    Parameters:
+        backend: simulated backend owning the synthetic waveform
+        context: simulated context which supplies sampling rate and gain
+        sampling_count: I/Q sampling count per refill
+    '''
+
+    def __init__(self, backend, context, sampling_count):
+        self.__backend = backend
+        self.__context = context
+        self.__phy = context.phy
+        self.__sampling_count = sampling_count
+        self.__latched = 0   # table offset of the latched buffer
+        self.__offset = 0
+        self.__rate = None
+        self.__table = None
+        self.__pacer = Pacer(backend)
+        self.refills = 0
+        self.dropped_buffers = 0
+        self.overflows = 0
+
+    def __waveform(self, rate):
+        if rate != self.__rate:
+            self.__rate = rate
+            self.__table = self.__backend.waveform(rate)
+            self.__offset = 0
+            self.__pacer.reset()
+        return self.__table
+
+    def refill(self):
+        '''
+        Block until sampling_count samples have been "received" (when paced), then latch them
+        '''
+        self.__backend.check(self.__context)
+        rate = int(self.__phy.channels[4].attrs['sampling_frequency'].value)
+        table = self.__waveform(rate)
+        count = self.__sampling_count
+        dropped = self.__pacer.wait(rate, count)
+        if dropped:
+            self.dropped_buffers += dropped
+            self.overflows += 1
+            self.__offset = (self.__offset + dropped * count) % TABLE_SIZE
+            self.__backend.flag_overflow(self.__phy)
+        self.__latched = self.__offset
+        self.__offset = (self.__offset + count) % TABLE_SIZE
+        self.refills += 1
+
+    def read(self):
+        '''
+        Read the latched buffer, interleaved int16 I/Q in machine byte order
+        '''
+        target = bytearray(self.__sampling_count * 4)
+        self.read_into(target)
+        return target
+
+    def read_into(self, target):
+        '''
+        Copy the latched buffer into a preallocated bytearray, return the byte count
+        '''
+        if self.__table is None:
+            return 0
+        count = min(self.__sampling_count, len(target) // 4)
+        iq = np.frombuffer(target, dtype=np.int16, count=count * 2).reshape(count, 2)
+        start = self.__latched
+        head = min(count, TABLE_SIZE - start)
+        iq[:head] = self.__table[start: start + head]
+        while head < count:  # wrap around, buffers may be larger than the table
+            size = min(count - head, TABLE_SIZE)
+            iq[head: head + size] = self.__table[:size]
+            head += size
+        return count * 4
+
+
+class ReplayBuffer():
+    '''
+    A RX buffer behaving like iio.Buffer which plays interleaved int16 I/Q from a memory-mapped file
+    at the configured sampling rate, paced like SimulatedBuffer
+    Parameters:
+        backend: replay backend owning the mapping
+        context: simulated context which supplies the sampling rate
+        sampling_count: I/Q sampling count per refill
+    '''
+
+    def __init__(self, backend, context, sampling_count):
+        self.__backend = backend
+        self.__context = context
+        self.__phy = context.phy
+        self.__sampling_count = sampling_count
+        self.__view = backend.samples()
+        self.__pacer = Pacer(backend)
+        self.__rate = None
+        self.__offset = 0
+        self.__latched = (0, 0)  # byte offset and size of the latched buffer
+        self.refills = 0
+        self.dropped_buffers = 0
+        self.overflows = 0
+
+    def refill(self):
+        '''
+        Block until sampling_count samples have been "received" (when paced), then latch them.
+        Without loop nothing is received past the end of the file
+        '''
+        self.__backend.check(self.__context)
+        rate = int(self.__phy.channels[4].attrs['sampling_frequency'].value)
+        if rate != self.__rate:
+            self.__rate = rate
+            self.__pacer.reset()
+        size = self.__sampling_count * 4
+        length = len(self.__view)
+        if self.__offset >= length and not self.__backend.loop:
+            self.__latched = (0, 0)
+            time.sleep(0.1)
+            return
+        dropped = self.__pacer.wait(rate, self.__sampling_count)
+        if dropped:
+            self.dropped_buffers += dropped
+            self.overflows += 1
+            self.__offset += dropped * size
+            self.__backend.flag_overflow(self.__phy)
+        if self.__offset >= length:
+            self.__offset = self.__offset % length if self.__backend.loop else length
+        self.__latched = (self.__offset, min(size, length - self.__offset))
+        self.__offset += size if self.__backend.loop else self.__latched[1]
+        self.refills += 1
+
+    def read(self):
+        target = bytearray(self.__sampling_count * 4)
+        return target[:self.read_into(target)]
+
+    def read_into(self, target):
+        '''
+        Copy the latched buffer from the mapping into a preallocated bytearray, return the byte count.
+        A buffer crossing the end of a looped file continues at its beginning
+        '''
+        offset, size = self.__latched
+        size = min(size if not self.__backend.loop else self.__sampling_count * 4, len(target))
+        if not size:
+            return 0
+        view = self.__view
+        head = min(size, len(view) - offset)
+        target[:head] = view[offset: offset + head]
+        while head < size:  # looped: wrap around
+            count = min(size - head, len(view))
+            target[head: head + count] = view[:count]
+            head += count
+        return size
+
+
+class SimulatedBackend():
+    '''
+    Device backend producing synthetic I/Q, it honors the attribute writes DeviceService performs
+    Parameters:
+        tones: offsets (Hz) of complex tones relative to the RX LO
+        amplitude: amplitude of each tone relative to full scale
+        noise: standard deviation of the gaussian noise in LSB
+        pace: 1.0 produces samples in real time, 2.0 twice as fast, 0 as fast as possible
+        kernel_buffers: number of buffers queued by the "kernel" before samples are dropped
+    '''
+
+    BUFFER = SimulatedBuffer
+
+    def __init__(self, tones=(250000, ), amplitude=0.5, noise=20.0, pace=1.0, kernel_buffers=4):
+        self.tones = tuple(tones)
+        self.amplitude = amplitude
+        self.noise = noise
+        self.pace = pace
+        self.kernel_buffers = kernel_buffers
+        self.__lock = threading.Lock()
+        self.__contexts = []
+        self.__buffers = []
+        self.__cache = {}
+        self.__generation = 0
+        self.__unplugged = 0.0  # perf_counter time until which no context can be created
+
+    @classmethod
+    def from_uri(cls, uri):
+        '''
+        Create backend from "sim:key=value,key=value", tone may repeat
+        eg. "sim:", "sim:tone=250000,tone=-1000000,noise=5,pace=0"
+        '''
+        kwargs = {}
+        tones = []
+        options = uri.split(':', 1)[1] if ':' in uri else ''
+        for option in options.split(','):
+            if '=' not in option:
+                continue
+            name, value = option.split('=', 1)
+            if name == 'tone':
+                tones.append(float(value))
+            elif name in ('amplitude', 'noise', 'pace'):
+                kwargs[name] = float(value)
+            elif name == 'kernel_buffers':
+                kwargs[name] = int(value)
+        if tones:
+            kwargs['tones'] = tones
+        return cls(**kwargs)
+
+    def unplug(self, seconds):
+        '''
+        Simulate a lost device: buffers of the contexts created so far fail from now on,
+        and creating a context fails for the next seconds
+        '''
+        self.__generation += 1
+        self.__unplugged = time.perf_counter() + seconds
+
+    def check(self, context):
+        '''
+        Raise like libiio does for a device which is gone
+        '''
+        if context.generation != self.__generation:
+            raise OSError(errno.ENODEV, os.strerror(errno.ENODEV))
+
+    def create_context(self, uri):
+        if time.perf_counter() < self.__unplugged:
+            raise OSError(errno.ETIMEDOUT, os.strerror(errno.ETIMEDOUT))
+        context = SimulatedContext()
+        context.generation = self.__generation
+        self.__lock.acquire()
+        self.__contexts.append(context)
+        self.__lock.release()
+        return context
+
+    def create_buffer(self, device, sampling_count, cyclic=False):
+        context = self.__find_context(rx=device)
+        if context is None:
+            raise ValueError('device is not created by this backend')
+        buffer = self.BUFFER(self, context, sampling_count)
+        self.__lock.acquire()
+        self.__buffers.append(buffer)
+        self.__lock.release()
+        return buffer
+
+    def set_kernel_buffers(self, device, count):
+        self.kernel_buffers = count
+
+    def stale_refills(self, kernel_buffers):
+        return 0  # samples are synthesized (or read) at refill time with the current settings
+
+    def set_bb_rate(self, device, rate):
+        rate = int(rate)
+        device.channels[4].attrs['sampling_frequency'].value = str(rate)
+        device.channels[5].attrs['sampling_frequency'].value = str(rate)
+        return 0
+
+    def read_into(self, buffer, target):
+        return buffer.read_into(target)
+
+    def read_overflow(self, device):
+        status = device.reg_read(RX_STATUS_REGISTER)
+        if status & RX_STATUS_OVERFLOW:
+            device.reg_write(RX_STATUS_REGISTER, status & ~RX_STATUS_OVERFLOW)
+        return bool(status & RX_STATUS_OVERFLOW)
+
+    def waveform(self, rate):
+        '''
+        Waveform table for sampling rate, tones are rounded to table bins so the table loops seamlessly
+        '''
+        self.__lock.acquire()
+        try:
+            if rate not in self.__cache:
+                n = np.arange(TABLE_SIZE)
+                signal = np.zeros(TABLE_SIZE, dtype=np.complex128)
+                for tone in self.tones:
+                    bin_ = round(tone * TABLE_SIZE / rate)
+                    signal += self.amplitude * FULL_SCALE * np.exp(2j * np.pi * bin_ * n / TABLE_SIZE)
+                if self.noise:
+                    generator = np.random.default_rng(rate)
+                    signal += generator.normal(0, self.noise, TABLE_SIZE) + 1j * generator.normal(0, self.noise, TABLE_SIZE)
+                iq = np.empty((TABLE_SIZE, 2), dtype=np.int16)
+                iq[:, 0] = np.clip(np.round(signal.real), -FULL_SCALE, FULL_SCALE - 1)
+                iq[:, 1] = np.clip(np.round(signal.imag), -FULL_SCALE, FULL_SCALE - 1)
+                self.__cache[rate] = iq
+            return self.__cache[rate]
+        finally:
+            self.__lock.release()
+
+    def flag_overflow(self, phy):
+        '''
+        Latch the overflow bit in the 'cf-ad9361-lpc' status register like the HDL core does
+        '''
+        context = self.__find_context(phy=phy)
+        if context:
+            context.rx.reg_write(RX_STATUS_REGISTER, context.rx.reg_read(RX_STATUS_REGISTER) | RX_STATUS_OVERFLOW)
+
+    @property
+    def refills(self):
+        return sum(buffer.refills for buffer in self.__buffers)
+
+    @property
+    def dropped_buffers(self):
+        return sum(buffer.dropped_buffers for buffer in self.__buffers)
+
+    @property
+    def overflows(self):
+        return sum(buffer.overflows for buffer in self.__buffers)
+
+    def __find_context(self, phy=None, rx=None):
+        for context in self.__contexts:
+            if context.phy is phy or context.rx is rx:
+                return context
+        return None
+
+
+class ReplayBackend(SimulatedBackend):
+    '''
+    Device backend replaying a recording (raw interleaved int16 I/Q, eg. a ".sigmf-data" file) through the
+    same capture path as a device, attribute writes are honored, samples are played at the configured sampling rate
+    Parameters:
+        path: data file
+        pace: 1.0 plays in real time, 2.0 twice as fast, 0 as fast as possible
+        loop: start again at the end of the file
+        kernel_buffers: number of buffers queued by the "kernel" before samples are dropped
+    '''
+
+    BUFFER = ReplayBuffer
+
+    def __init__(self, path, pace=1.0, loop=True, kernel_buffers=4):
+        SimulatedBackend.__init__(self, pace=pace, kernel_buffers=kernel_buffers)
+        self.path = path
+        self.loop = loop
+        if os.path.getsize(path) < 4:
+            raise ValueError('no I/Q in replay file: {0}'.format(path))
+        with open(path, 'rb') as fd:
+            self.__map = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+
+    @classmethod
+    def from_uri(cls, uri):
+        '''
+        Create backend from "replay:path,key=value", eg. "replay:recordings/fm-0000.sigmf-data,pace=0,loop=0"
+        '''
+        options = uri.split(':', 1)[1].split(',')
+        kwargs = {}
+        for option in options[1:]:
+            name, _, value = option.partition('=')
+            if name == 'pace':
+                kwargs[name] = float(value)
+            elif name == 'loop':
+                kwargs[name] = value not in ('0', 'false', 'off')
+            elif name == 'kernel_buffers':
+                kwargs[name] = int(value)
+        return cls(options[0], **kwargs)
+
+    def samples(self):
+        '''
+        Read-only view of the whole I/Q pairs in the file, no copy
+        '''
+        view = memoryview(self.__map)
+        return view[:len(view) // 4 * 4]
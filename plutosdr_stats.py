@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+# -*-coding:utf-8-*-
+# Description: Low-overhead latency histograms, Prometheus text exposition and a sampling profiler of the service threads
+
+import collections
+import os
+import sys
+import threading
+import traceback
+
+
+class Histogram():
+    '''
+    Latency histogram with power of 2 microsecond buckets: bucket i counts durations below 2**i us.
+    observe() takes no lock, concurrent observers may lose an increment which is fine for monitoring
+    '''
+
+    BUCKETS = 24  # 2**23 us ~ 8.4s, one more bucket for anything longer
+
+    def __init__(self):
+        self.counts = [0] * (self.BUCKETS + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        index = int(seconds * 1e6).bit_length()
+        self.counts[index if index < self.BUCKETS else self.BUCKETS] += 1
+        self.count += 1
+        self.sum += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    @classmethod
+    def bound(cls, index):
+        '''
+        Upper bound of bucket index in seconds (inf for the last one)
+        '''
+        return (1 << index) / 1e6 if index < cls.BUCKETS else float('inf')
+
+    def quantile(self, q):
+        '''
+        Upper bound (seconds) of the bucket holding quantile q, 0 when empty
+        '''
+        target = q * sum(self.counts)
+        total = 0
+        for index, count in enumerate(self.counts):
+            total += count
+            if count and total >= target:
+                return min(self.bound(index), self.max)
+        return 0.0
+
+    def summary(self):
+        '''
+        "count:mean:p50:p99:max" with durations in microseconds
+        '''
+        mean = self.sum / self.count if self.count else 0.0
+        return '{0}:{1:.1f}:{2:.0f}:{3:.0f}:{4:.0f}'.format(self.count, mean * 1e6, self.quantile(0.5) * 1e6,
+                                                          self.quantile(0.99) * 1e6, self.max * 1e6)
+
+
+def prometheus_text(metrics, prefix='plutosdr_'):
+    '''
+    Render metrics in the Prometheus text format
+    Parameters:
+        metrics: {name: number or Histogram, "clients": {key: {name: number or Histogram}}}, client values get a
+                 "client" label; or {"devices": {name: metrics}} for several devices, values get a "device" label
+    '''
+    lines = []
+    series = collections.OrderedDict()
+    devices = metrics.get('devices', {'': metrics})
+    for device, values in devices.items():
+        labels = 'device="{0}"'.format(device) if device else ''
+        for name, value in values.items():
+            if name not in ('clients', 'devices'):
+                series.setdefault(name, []).append((labels, value))
+        for key, client in values.get('clients', {}).items():
+            client_labels = ','.join(label for label in (labels, 'client="{0}"'.format(key)) if label)
+            for name, value in client.items():
+                if isinstance(value, (int, float, Histogram)) and not isinstance(value, bool):
+                    series.setdefault('client_' + name, []).append((client_labels, value))
+    for name, samples in series.items():
+        name = prefix + name
+        if isinstance(samples[0][1], Histogram):
+            lines.append('# TYPE {0} histogram'.format(name))
+            for labels, histogram in samples:
+                separator = ',' if labels else ''
+                total = 0
+                for index, count in enumerate(histogram.counts):
+                    total += count
+                    bound = '+Inf' if index == Histogram.BUCKETS else repr(Histogram.bound(index))
+                    lines.append('{0}_bucket{{{1}{2}le="{3}"}} {4}'.format(name, labels, separator, bound, total))
+                lines.append('{0}_sum{1} {2!r}'.format(name, '{' + labels + '}' if labels else '', histogram.sum))
+                lines.append('{0}_count{1} {2}'.format(name, '{' + labels + '}' if labels else '', histogram.count))
+        else:
+            lines.append('# TYPE {0} gauge'.format(name))
+            for labels, value in samples:
+                lines.append('{0}{1} {2}'.format(name, '{' + labels + '}' if labels else '', value))
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsServer():
+    '''
+    HTTP endpoint serving "GET /metrics" in the Prometheus text format from its own thread
+    Parameters:
+        collect: callable returning the metrics, see prometheus_text
+        port: TCP port
+        host: address to bind
+    '''
+
+    def __init__(self, collect, port, host=''):
+        try:  # imported here, http.server takes longer to import than the whole service
+            from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        except ImportError:  # python < 3.7
+            raise RuntimeError('http.server is not available')
+        self.port = port
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                try:
+                    body = prometheus_text(collect()).encode('utf-8')
+                except:
+                    traceback.print_exc()
+                    self.send_error(500)
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.__httpd = ThreadingHTTPServer((host, port), Handler)
+        self.__httpd.daemon_threads = True
+        self.__thread = threading.Thread(target=self.__httpd.serve_forever, name='metrics')
+        self.__thread.daemon = True
+        self.__thread.start()
+        sys.stdout.write('Serving metrics on port {0}\n'.format(port))
+
+    def stop(self):
+        self.__httpd.shutdown()
+        self.__httpd.server_close()
+        self.__thread.join()
+
+
+class SamplingProfiler():
+    '''
+    Statistical profiler: every interval it samples the innermost frame of every thread of the process,
+    it can be started and stopped at any time and costs nothing while stopped
+    Parameters:
+        interval: seconds between samples
+    '''
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.samples = 0
+        self.__counts = collections.Counter()
+        self.__stop = threading.Event()
+        self.__thread = None
+
+    @property
+    def running(self):
+        return self.__thread is not None
+
+    def start(self):
+        if self.__thread is None:
+            self.__stop.clear()
+            self.__thread = threading.Thread(target=self.__sample, name='profiler')
+            self.__thread.daemon = True
+            self.__thread.start()
+
+    def stop(self):
+        if self.__thread is not None:
+            self.__stop.set()
+            self.__thread.join()
+            self.__thread = None
+
+    def reset(self):
+        self.samples = 0
+        self.__counts.clear()
+
+    def top(self, count=10):
+        '''
+        Most sampled locations as ("thread function file:line", samples)
+        '''
+        return self.__counts.most_common(count)
+
+    def __sample(self):
+        me = threading.get_ident()
+        while not self.__stop.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                code = frame.f_code
+                location = '{0} {1} {2}:{3}'.format(names.get(ident, ident), code.co_name,
+                                                    os.path.basename(code.co_filename), frame.f_lineno)
+                self.__counts[location] += 1
+            self.samples += 1
@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+# -*-coding:utf-8-*-
+# Description: Shared helpers of the tests, everything runs against the simulated device ("sim:")
+
+import contextlib
+import os
+import socket
+import sys
+import threading
+import time
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from plutosdr import DeviceService, Packetizer  # noqa: E402
+from plutosdr_sim import SimulatedAttribute, SimulatedBackend  # noqa: E402
+
+SAMPLING_COUNT = 1024
+SAMPLING_RATE = 1024000  # 1ms per frame of SAMPLING_COUNT samples
+
+
+def tone(count, offset, rate, amplitude=1024.0, start=0):
+    '''
+    Interleaved int16 I/Q of a complex tone at offset Hz, start is the index of the first sample
+    '''
+    n = np.arange(start, start + count)
+    signal = amplitude * np.exp(2j * np.pi * offset * n / rate)
+    iq = np.empty((count, 2), dtype=np.int16)
+    iq[:, 0] = np.round(signal.real)
+    iq[:, 1] = np.round(signal.imag)
+    return iq.reshape(-1)
+
+
+def make_frame(packetizer, iq, sample_counter=0, rate=SAMPLING_RATE, frequency=101700000):
+    '''
+    Frame of packetizer holding iq (interleaved int16, the frame size), one reference owned by the caller
+    '''
+    frame = packetizer.acquire()
+    frame.buffer[:] = iq.astype(np.int16).tobytes()
+    packetizer.packetize(frame, len(frame.buffer), frequency, 2000000, rate, 10, sample_counter=sample_counter)
+    return frame
+
+
+class RecordingAttribute(SimulatedAttribute):
+    '''
+    Attribute appending every write to a shared log as (name, value)
+    '''
+
+    def __init__(self, log, name, value):
+        SimulatedAttribute.__init__(self, value)
+        self.__log = log
+        self.__name = name
+
+    @SimulatedAttribute.value.setter
+    def value(self, value):
+        SimulatedAttribute.value.fset(self, value)
+        self.__log.append((self.__name, str(value)))
+
+
+class RecordingBackend(SimulatedBackend):
+    '''
+    Simulated backend logging the RX/TX attribute writes in order, the baseband rate as one "sampling_frequency"
+    write (not the two attribute writes it is made of)
+    '''
+
+    def __init__(self, **kwargs):
+        kwargs.setdefault('pace', 1.0)
+        SimulatedBackend.__init__(self, **kwargs)
+        self.writes = []
+        self.contexts = []
+
+    def create_context(self, uri):
+        context = SimulatedBackend.create_context(self, uri)
+        for channel in context.phy.channels:
+            channel.attrs = {name: RecordingAttribute(self.writes, name, attr.value) if name != 'sampling_frequency'
+                             else attr for name, attr in channel.attrs.items()}
+        self.contexts.append(context)
+        return context
+
+    def set_bb_rate(self, device, rate):
+        self.writes.append(('sampling_frequency', str(int(rate))))
+        return SimulatedBackend.set_bb_rate(self, device, rate)
+
+
+class Sink():
+    '''
+    Data sinker keeping the frames it is given (one reference each)
+    '''
+
+    def __init__(self):
+        self.frames = []
+        self.__condition = threading.Condition()
+
+    def __call__(self, frame):
+        frame.retain()
+        self.__condition.acquire()
+        self.frames.append(frame)
+        self.__condition.notify_all()
+        self.__condition.release()
+
+    def wait(self, predicate, timeout=10.0):
+        '''
+        Wait until predicate(frames) is true, return it
+        '''
+        deadline = time.perf_counter() + timeout
+        self.__condition.acquire()
+        try:
+            while not predicate(self.frames):
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    return False
+                self.__condition.wait(remaining)
+            return True
+        finally:
+            self.__condition.release()
+
+    def release(self):
+        self.__condition.acquire()
+        frames, self.frames = self.frames, []
+        self.__condition.release()
+        for frame in frames:
+            frame.release()
+
+
+def wait_for(predicate, timeout=10.0, interval=0.02):
+    deadline = time.perf_counter() + timeout
+    while not predicate():
+        if time.perf_counter() > deadline:
+            return False
+        time.sleep(interval)
+    return True
+
+
+def free_port():
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        return probe.getsockname()[1]
+
+
+@contextlib.contextmanager
+def serving(service):
+    '''
+    Run a NetworkService on a free port in a thread, yield the port, stop it (which releases its device) on exit
+    '''
+    port = free_port()
+    thread = threading.Thread(target=service.start, kwargs={'host': '127.0.0.1', 'port': port}, daemon=True)
+    thread.start()
+    try:
+        assert wait_for(lambda: listening(port), timeout=5)
+        yield port
+    finally:
+        service.stop()
+        thread.join(5)
+        assert not thread.is_alive()
+
+
+def listening(port):
+    '''
+    True once the port is bound, probed without connecting (a connection would take a client slot)
+    '''
+    try:
+        with socket.socket() as probe:
+            probe.bind(('127.0.0.1', port))
+        return False
+    except OSError:
+        time.sleep(0.05)  # bound, listening right after
+        return True
+
+
+@pytest.fixture
+def packetizer():
+    return Packetizer(SAMPLING_COUNT, frames=4)
+
+
+@pytest.fixture
+def backend():
+    return RecordingBackend()
+
+
+@pytest.fixture
+def device(backend):
+    device = DeviceService(4096, 'sim:', backend=backend, poll_interval=0.05)
+    del backend.writes[:]
+    yield device
+    device.stop()
+    device.release()
@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+# -*-coding:utf-8-*-
+# Description: asyncio network service: data reaches a client, the client limit holds and everything closes
+
+import socket
+
+import numpy as np
+
+from conftest import RecordingBackend, serving, wait_for
+from plutoclient import PlutoClient
+from plutosdr import DeviceService
+from plutosdr_aio import AsyncNetworkService
+
+
+def test_client_receives_and_closes():
+    service = AsyncNetworkService(DeviceService(4096, 'sim:', backend=RecordingBackend()), max_clients=2)
+    with serving(service) as port:
+        client = PlutoClient('127.0.0.1', port)
+        try:
+            client.start()
+            blocks = []
+            while sum(len(block.samples) for block in blocks) < 16 * 4096:
+                received = client.receive(5)
+                assert received
+                blocks.extend(received)
+            assert all(block.frequency == 101700000 and block.sampling_rate == 2560000 for block in blocks)
+            assert blocks[0].samples.dtype == np.complex64
+            assert 0.45 < np.abs(np.concatenate([block.samples for block in blocks])).mean() < 0.55  # sim tone 0.5
+            counters = [block.sample_counter for block in blocks]
+            assert counters == sorted(counters)
+            assert client.query('queue')['queue'].startswith('drop-oldest')
+            assert len(service.statistics()) == 1
+        finally:
+            client.close()
+        assert wait_for(lambda: not service.statistics())
+
+
+def test_client_limit():
+    service = AsyncNetworkService(DeviceService(4096, 'sim:', backend=RecordingBackend()), max_clients=1)
+    with serving(service) as port:
+        first = PlutoClient('127.0.0.1', port)
+        try:
+            with socket.create_connection(('127.0.0.1', port), 5) as rejected:
+                rejected.settimeout(5)
+                assert rejected.makefile('rb').readline().startswith(b'Your request has been closed')
+            first.start()
+            assert first.receive(5)
+        finally:
+            first.close()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+# -*-coding:utf-8-*-
+# Description: RX buffer rebuilt at runtime ("*buffer="): sizes of the frames after it, auto sizing, pending requests
+
+import threading
+import time
+
+from conftest import RecordingBackend, Sink, serving
+from plutoclient import PlutoClient
+from plutosdr import FLAG_OVERFLOW, DeviceService, NetworkService
+
+
+class GatedBackend(RecordingBackend):
+    '''
+    Backend whose buffer creation waits for gate once the first buffer was created, to keep a rebuild in progress
+    '''
+
+    def __init__(self):
+        RecordingBackend.__init__(self)
+        self.gate = threading.Event()
+        self.rebuilding = threading.Event()
+        self.created = []
+
+    def create_buffer(self, device, sampling_count, cyclic=False):
+        if self.created:
+            self.rebuilding.set()
+            assert self.gate.wait(10)
+        self.created.append(sampling_count)
+        return RecordingBackend.create_buffer(self, device, sampling_count, cyclic)
+
+
+def test_rebuild(device):
+    sink = Sink()
+    device.set_data_sinker(sink)
+    device.start()
+    try:
+        assert sink.wait(lambda frames: len(frames) >= 2)
+        assert device.set_buffer(2048, 8) == (2048, 8)
+        count = len(sink.frames)
+        assert sink.wait(lambda frames: any(frame.size == 2048 * 4 for frame in frames[count:]))
+        following = [frame for frame in sink.frames[count:] if frame.size == 2048 * 4]
+        assert following[0].flags & FLAG_OVERFLOW  # samples are lost while rebuilding
+        assert device.buffer_settings() == {'sampling_count': 2048, 'kernel_buffers': 8, 'auto_latency': None,
+                                            'rebuilds': 1}
+        assert device.set_buffer(2048, 8) == (2048, 8)  # nothing to rebuild
+        assert device.buffer_settings()['rebuilds'] == 1
+    finally:
+        device.stop()
+        sink.release()
+
+
+def test_pending_request_is_replaced():
+    backend = GatedBackend()
+    device = DeviceService(4096, 'sim:', backend=backend)
+    device.start()
+    try:
+        taken = threading.Thread(target=device.set_buffer, args=(2048,), kwargs={'timeout': 10})
+        taken.start()
+        assert backend.rebuilding.wait(5)  # the capture thread is rebuilding with 2048
+        replies = []
+        pending = threading.Thread(target=lambda: replies.append(device.set_buffer(8192, timeout=10)))
+        pending.start()
+        time.sleep(0.1)
+        begin = time.perf_counter()
+        device.set_buffer(16384, timeout=0)
+        pending.join(5)
+        assert not pending.is_alive() and time.perf_counter() - begin < 1.0  # replaced, its caller returned at once
+        backend.gate.set()
+        taken.join(5)
+        assert device.set_buffer(16384, timeout=5)[0] == 16384
+        assert backend.created == [4096, 2048, 16384]  # 8192 was never built
+    finally:
+        backend.gate.set()
+        device.stop()
+        device.release()
+
+
+def test_buffer_command():
+    device = DeviceService(4096, 'sim:', backend=RecordingBackend())
+    service = NetworkService(device, 4)
+    with serving(service) as port:
+        with PlutoClient('127.0.0.1', port) as client:
+            client.start()
+            client.command(buffer=':8')
+            assert client.expect('buffer') == {'buffer': '4096', 'kernel_buffers': '8', 'auto': 'off', 'rebuilds': '1'}
+            client.command(buffer='auto:20')
+            fields = client.expect('buffer')
+            count, kernel_buffers = DeviceService.auto_buffer(device.snapshot.sampling_frequency, 0.02)
+            assert fields == {'buffer': str(count), 'kernel_buffers': str(kernel_buffers), 'auto': '20',
+                              'rebuilds': '2'}
+            assert client.query('buffer')['auto'] == '20'
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+# -*-coding:utf-8-*-
+# Description: Client library against a simulated service: sample blocks, header versions and acknowledged parameters
+
+import numpy as np
+import pytest
+
+from conftest import RecordingBackend, serving
+from plutoclient import PlutoClient
+from plutosdr import DeviceService, NetworkService
+from plutosdr_aio import AsyncNetworkService
+
+
+def blocks(client, samples):
+    '''
+    Blocks received until they hold samples samples
+    '''
+    received = []
+    while sum(len(block.samples) for block in received) < samples:
+        batch = client.receive(timeout=5)
+        assert batch
+        received.extend(batch)
+    return received
+
+
+@pytest.mark.parametrize('service_class', [NetworkService, AsyncNetworkService])
+def test_blocks(service_class):
+    service = service_class(DeviceService(4096, 'sim:', backend=RecordingBackend()), 4)
+    with serving(service) as port:
+        with PlutoClient('127.0.0.1', port) as client:
+            client.start()
+            received = blocks(client, 16 * 4096)
+    for block in received:
+        assert block.samples.dtype == np.complex64
+        assert block.frequency == 101700000 and block.sampling_rate > 0
+        assert 0.45 < np.abs(block.samples).max() < 0.55  # the simulated tone at half of full scale
+    for previous, following in zip(received, received[1:]):
+        # blocks only split at batch boundaries, the counters go on when nothing was lost
+        if not following.lost:
+            assert following.sample_counter == previous.sample_counter + len(previous.samples)
+
+
+def test_header_v1():
+    service = NetworkService(DeviceService(4096, 'sim:', backend=RecordingBackend()), 4)
+    with serving(service) as port:
+        with PlutoClient('127.0.0.1', port, header='v1') as client:
+            client.start()
+            received = blocks(client, 4 * 4096)
+    # v1 carries neither sequence numbers nor sample counters
+    assert all(block.sequence == 0 and block.sample_counter == 0 and block.flags == 0 for block in received)
+    assert all(block.frequency == 101700000 for block in received)
+
+
+def test_acknowledged_parameters():
+    service = NetworkService(DeviceService(4096, 'sim:', backend=RecordingBackend()), 4)
+    with serving(service) as port:
+        with PlutoClient('127.0.0.1', port) as client:
+            client.set_ack(True)
+            client.start()
+            blocks(client, 4096)  # sampling, else nothing is acknowledged as captured (-1)
+            ack = client.set_parameters(frequency=433920000)
+            assert ack['ack'] > 0 and ack['sample'] >= 0
+            received = blocks(client, 8 * 4096)
+            while received[-1].frequency != 433920000:
+                received.extend(blocks(client, 4096))
+    # datagrams from the acknowledged sample on are captured with the new frequency
+    assert all(block.frequency == 433920000 for block in received if block.sample_counter >= ack['sample'])
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+# -*-coding:utf-8-*-
+# Description: Payload encodings of plutosdr_codec, encoded and decoded back
+
+import numpy as np
+import pytest
+
+from conftest import make_frame, tone
+from plutosdr_codec import DATA_HEADER_V2, ENCODING_HEADER, ENCODINGS, SampleEncoder, decode, decode_datagram, encode
+
+
+def samples(count=4096, scale=2047, seed=1):
+    generator = np.random.default_rng(seed)
+    return generator.integers(-scale - 1, scale + 1, count * 2).astype(np.int16)
+
+
+@pytest.mark.parametrize('name', ['i16', 'i12', 'zlib'])
+def test_lossless_round_trip(name):
+    iq = samples()
+    exponent, payload = encode(ENCODINGS[name], iq)
+    assert exponent == 0
+    assert np.array_equal(decode(ENCODINGS[name], exponent, payload), iq)
+
+
+def test_zlib_keeps_16bit_values():
+    iq = samples(scale=32767)
+    _, payload = encode(ENCODINGS['zlib'], iq)
+    assert np.array_equal(decode(ENCODINGS['zlib'], 0, payload), iq)
+
+
+def test_int12_packs_two_values_in_three_bytes_and_clips():
+    iq = np.array([5000, -5000, 2047, -2048], dtype=np.int16)
+    _, payload = encode(ENCODINGS['i12'], iq)
+    assert len(payload) == 6
+    assert list(decode(ENCODINGS['i12'], 0, payload)) == [2047, -2048, 2047, -2048]
+
+
+def test_int8_scales_to_the_peak():
+    iq = samples()
+    exponent, payload = encode(ENCODINGS['i8'], iq)
+    assert exponent == 5  # peak 2048 (-2048) >> 5 fits in int8
+    assert len(payload) == len(iq)
+    error = np.abs(decode(ENCODINGS['i8'], exponent, payload).astype(np.int32) - iq)
+    assert error.max() <= 1 << (exponent - 1)
+
+
+def test_int8_small_values_are_exact():
+    iq = np.array([-127, 127, 0, 5], dtype=np.int16)
+    exponent, payload = encode(ENCODINGS['i8'], iq)
+    assert exponent == 0
+    assert np.array_equal(decode(ENCODINGS['i8'], exponent, payload), iq)
+
+
+@pytest.mark.parametrize('name', ['i16', 'i12', 'zlib'])
+def test_datagram_round_trip(packetizer, name):
+    iq = tone(1024, 100000, 1024000)
+    frame = make_frame(packetizer, iq, sample_counter=4096)
+    encoder = SampleEncoder(name)
+    datagrams = encoder.process(frame)
+    assert encoder.process(frame) is datagrams  # encoded once per frame
+    header, payload = datagrams[0]
+    assert header[2] == DATA_HEADER_V2.size + ENCODING_HEADER.size
+    fields, decoded = decode_datagram(b''.join((header, payload)))
+    assert fields[8] == 4096  # sample counter
+    assert fields[12] == 1024000  # sampling rate
+    assert np.array_equal(decoded, iq)
+    frame.release()
+
+
+def test_plain_v2_datagram(packetizer):
+    iq = tone(1024, -200000, 1024000)
+    frame = make_frame(packetizer, iq)
+    header, payload = frame.datagrams_for(2)[0]
+    _, decoded = decode_datagram(b''.join((header, payload)))
+    assert np.array_equal(decoded, iq)
+    frame.release()
+
+
+def test_unknown_encoding():
+    with pytest.raises(ValueError):
+        SampleEncoder('i4')
+    with pytest.raises(ValueError):
+        decode_datagram(b'#' + bytes(DATA_HEADER_V2.size))
@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+# -*-coding:utf-8-*-
+# Description: Channel stage of plutosdr_dsp, a tone must come out at its offset from the channel center
+
+import numpy as np
+import pytest
+
+from conftest import make_frame, tone
+from plutosdr import Packetizer
+from plutosdr_dsp import DigitalDownConverter
+
+
+def run_ddc(ddc, offset, frames=8, count=8192, rate=2048000):
+    packetizer = Packetizer(count, frames=2)
+    target = bytearray(count * 4)
+    outputs = []
+    for index in range(frames):
+        frame = make_frame(packetizer, tone(count, offset, rate, start=index * count), sample_counter=index * count,
+                           rate=rate)
+        size = ddc.process(frame, target)
+        outputs.append(np.frombuffer(bytes(target[:size]), dtype=np.int16))
+        frame.release()
+    iq = np.concatenate(outputs).astype(np.float32)
+    return iq[0::2] + 1j * iq[1::2]
+
+
+@pytest.mark.parametrize('channel, offset', [(300000, 350000), (-500000, -520000), (0, 40000)])
+def test_ddc_shifts_tone_to_baseband(channel, offset):
+    ddc = DigitalDownConverter(channel, 256000)
+    samples = run_ddc(ddc, offset)
+    assert ddc.decimation == 8 and ddc.output_rate() == 256000
+    assert len(samples) > 4096
+    samples = samples[-4096:]
+    power = np.abs(np.fft.fftshift(np.fft.fft(samples)))
+    frequencies = np.fft.fftshift(np.fft.fftfreq(len(samples), 1.0 / 256000))
+    assert frequencies[np.argmax(power)] == pytest.approx(offset - channel, abs=256000 / 4096)
+    assert np.abs(samples).mean() == pytest.approx(1024, rel=0.05)  # passband gain is unity
+
+
+def test_ddc_rejects_tone_outside_channel():
+    inside = run_ddc(DigitalDownConverter(0, 256000), 50000)[-4096:]
+    outside = run_ddc(DigitalDownConverter(0, 256000), 600000)[-4096:]
+    assert 20 * np.log10(np.abs(inside).mean() / max(np.abs(outside).mean(), 1e-3)) > 40
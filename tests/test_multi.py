@@ -0,0 +1,37 @@
+#!/usr/bin/env python3
+# -*-coding:utf-8-*-
+# Description: Several simulated devices served at once, from threads or from processes with their own workers
+
+import multiprocessing
+
+import pytest
+
+from conftest import free_port, listening, wait_for
+from plutoclient import PlutoClient
+from plutosdr_multi import DeviceSpec, MultiDeviceServer
+
+FREQUENCIES = [433920000, 868000000]
+
+
+@pytest.mark.parametrize('isolation, server', [('thread', 'thread'), ('thread', 'asyncio'), ('process', 'shm:1')])
+def test_two_devices(isolation, server):
+    specs = [DeviceSpec('pluto{0}'.format(index), 'sim:tone={0}'.format(100000 * (index + 1)), free_port(), 4096,
+                        server=server, parameters={'frequency': frequency}, state='')
+             for index, frequency in enumerate(FREQUENCIES)]
+    multi = MultiDeviceServer(specs, isolation)
+    multi.start()
+    try:
+        for spec, frequency in zip(specs, FREQUENCIES):
+            assert wait_for(lambda: listening(spec.port), timeout=10)
+            with PlutoClient('127.0.0.1', spec.port) as client:
+                client.start()
+                blocks = []
+                while sum(len(block.samples) for block in blocks) < 4 * 4096:
+                    received = client.receive(timeout=5)
+                    assert received
+                    blocks.extend(received)
+            assert all(block.frequency == frequency for block in blocks)
+    finally:
+        multi.stop()
+    # device processes and the workers they started all ended
+    assert not multiprocessing.active_children()
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+# -*-coding:utf-8-*-
+# Description: Multicast fan-out: one stream per group whatever the number of clients joined to it
+
+import socket
+import threading
+
+import pytest
+
+from conftest import RecordingBackend, free_port, serving, wait_for
+from plutoclient import PlutoClient
+from plutosdr import DATA_HEADER_V2, DeviceService, NetworkService
+from plutosdr_aio import AsyncNetworkService
+
+GROUP = '239.255.50.26'
+
+
+def join(port):
+    '''
+    Socket receiving GROUP:port on the loopback interface
+    '''
+    receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    receiver.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    receiver.bind(('', port))
+    receiver.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, socket.inet_aton(GROUP) + socket.inet_aton('127.0.0.1'))
+    receiver.settimeout(5)
+    return receiver
+
+
+@pytest.mark.parametrize('service_class', [NetworkService, AsyncNetworkService])
+def test_one_stream_per_group(service_class):
+    service = service_class(DeviceService(4096, 'sim:', backend=RecordingBackend()), 4)
+    port = free_port()
+    key = '{0}:{1}'.format(GROUP, port)
+    receiver = join(port)
+    with serving(service) as control_port:
+        clients = []
+        try:
+            # Clients connect and join at the same time, the first one opens the stream
+            threads = [threading.Thread(target=lambda: clients.append(PlutoClient('127.0.0.1', control_port)))
+                       for _ in range(3)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join(10)
+            assert len(clients) == 3
+            threads = [threading.Thread(target=client.command, kwargs={'multicast': '{0}:{1}:1'.format(GROUP, port)})
+                       for client in clients]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join(10)
+            assert wait_for(lambda: key in service.statistics(), timeout=5)
+            clients[0].start()
+
+            datagram = receiver.recv(65536)
+            fields = DATA_HEADER_V2.unpack_from(datagram)
+            assert fields[0] == b'$' and fields[10] == 101700000
+            statistics = service.statistics()
+            assert [name for name in statistics if str(name).startswith(GROUP)] == [key]
+            assert wait_for(lambda: service.statistics()[key]['sent'] > 0)
+
+            clients[0].command(multicast='off')
+            clients[1].command(multicast='off')
+            clients[1].query('queue')  # requests of a connection are handled in order
+            assert key in service.statistics()
+            clients[2].command(multicast='off')
+            assert wait_for(lambda: key not in service.statistics(), timeout=5)
+        finally:
+            for client in clients:
+                client.close()
+            receiver.close()
+
+
+class AcceptDuringJoin(AsyncNetworkService):
+    '''
+    Service whose multicast streams open a control connection while connecting, and wait for the event loop
+    to accept it
+    '''
+
+    def __init__(self, device, max_clients):
+        AsyncNetworkService.__init__(self, device, max_clients)
+        self.port = None
+        self.accepted = threading.Event()
+        self.accepted_in_time = None
+        self.probes = []
+
+    def open_client(self, control):
+        opened = AsyncNetworkService.open_client(self, control)
+        self.accepted.set()
+        return opened
+
+    def create_data_client(self, key):
+        client = AsyncNetworkService.create_data_client(self, key)
+        if str(key).startswith(GROUP):
+            connect = client.connect
+
+            def connect_while_accepting(*args):
+                self.accepted.clear()
+                self.probes.append(socket.create_connection(('127.0.0.1', self.port)))
+                self.accepted_in_time = self.accepted.wait(2)
+                connect(*args)
+            client.connect = connect_while_accepting
+        return client
+
+
+def test_join_while_a_client_connects():
+    service = AcceptDuringJoin(DeviceService(4096, 'sim:', backend=RecordingBackend()), 4)
+    port = free_port()
+    with serving(service) as control_port:
+        service.port = control_port
+        client = PlutoClient('127.0.0.1', control_port)
+        try:
+            client.command(multicast='{0}:{1}:1'.format(GROUP, port))
+            assert client.query('queue')
+            assert service.accepted_in_time  # the event loop was not blocked by the join
+            assert '{0}:{1}'.format(GROUP, port) in service.statistics()
+        finally:
+            client.close()
+            for probe in service.probes:
+                probe.close()
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+# -*-coding:utf-8-*-
+# Description: Parameter snapshot and transactions of DeviceService: stamping of frames, order and coalescing
+
+import pytest
+
+from conftest import RecordingBackend, Sink, wait_for
+from plutosdr import FLAG_OVERFLOW, FLAG_PARAMETERS_CHANGED, DeviceService
+
+
+def names(backend):
+    return [name for name, _ in backend.writes]
+
+
+def test_frames_carry_the_snapshot(device, backend):
+    sink = Sink()
+    device.set_data_sinker(sink)
+    try:
+        device.start()
+        assert sink.wait(lambda frames: len(frames) >= 2)
+        snapshot = device.snapshot
+        frame = sink.frames[-1]
+        assert (frame.frequency, frame.rf_bandwidth, frame.sampling_rate, frame.gain, frame.parameter_version) == \
+            (snapshot.frequency, snapshot.rf_bandwidth, snapshot.sampling_frequency, snapshot.gain, snapshot.version)
+
+        # AGC gain read back by the poller is swapped in without a new version
+        backend.contexts[0].phy.channels[4].attrs['hardwaregain'].value = '42.000000 dB'
+        assert wait_for(lambda: device.snapshot.gain == 42)
+        assert device.snapshot.version == snapshot.version
+        count = len(sink.frames)
+        assert sink.wait(lambda frames: len(frames) > count + 2)
+        assert sink.frames[-1].gain == 42
+    finally:
+        device.stop()
+        sink.release()
+
+
+def test_polled_overflow_flags_the_next_frame(device, backend):
+    sink = Sink()
+    device.set_data_sinker(sink)
+    try:
+        device.start()
+        assert sink.wait(lambda frames: len(frames) >= 2)
+        backend.flag_overflow(backend.contexts[0].phy)
+        assert wait_for(lambda: device.metrics()['overflows'] == 1)
+        overflow_sample = device.metrics()['overflow_sample']
+        assert sink.wait(lambda frames: any(frame.flags & FLAG_OVERFLOW for frame in frames))
+        flagged = [frame for frame in sink.frames if frame.flags & FLAG_OVERFLOW]
+        assert len(flagged) == 1
+        assert flagged[0].sample_counter >= overflow_sample - device.sampling_count
+    finally:
+        device.stop()
+        sink.release()
+
+
+def test_gain_mode_before_manual_gain(device, backend):
+    version = device.snapshot.version
+    new_version, _, written = device.set_parameters([('hardwaregain', 20), ('gain_control_mode', 'manual')])
+    assert written == ['gain_control_mode', 'hardwaregain']
+    assert names(backend) == ['gain_control_mode', 'hardwaregain']
+    assert new_version == version + 1  # one snapshot per transaction
+
+
+def test_later_value_wins(device, backend):
+    device.set_parameters([('frequency', 433000000), ('frequency', 868000000)])
+    assert backend.writes == [('frequency', '868000000')]
+    assert device.snapshot.frequency == 868000000
+
+
+def test_bandwidth_derives_the_rate_once(device, backend):
+    device.set_parameters([('sampling_frequency', 4000000), ('rf_bandwidth', 5000000)])
+    assert backend.writes == [('rf_bandwidth', '5000000'), ('rf_bandwidth', '5000000'),
+                              ('sampling_frequency', '6400000')]
+
+
+def test_explicit_rate_after_bandwidth_wins(device, backend):
+    device.set_parameters([('rf_bandwidth', 5000000), ('sampling_frequency', 8000000)])
+    assert names(backend).count('sampling_frequency') == 1
+    assert ('sampling_frequency', '8000000') in backend.writes
+    assert device.snapshot.sampling_frequency == 8000000
+
+
+def test_unchanged_and_invalid_values_are_skipped(device, backend):
+    version = device.snapshot.version
+    new_version, _, written = device.set_parameters([('frequency', 101700000), ('gain_control_mode', 'loud'),
+                                                     ('antenna', 'B')])
+    assert written == [] and backend.writes == []
+    assert new_version == version
+
+
+def test_values_are_clamped(device, backend):
+    device.set_parameters([('frequency', 1), ('hardwaregain', 100)])
+    assert ('frequency', '70000000') in backend.writes
+    assert ('hardwaregain', '71') in backend.writes
+
+
+@pytest.mark.parametrize('stale', [0, 3])
+def test_frames_are_stamped_from_the_acknowledged_one(stale):
+    class StaleBackend(RecordingBackend):
+        def stale_refills(self, kernel_buffers):
+            return stale  # refills the kernel queued before a retune still carry the old frequency
+
+    device = DeviceService(4096, 'sim:', backend=StaleBackend(), poll_interval=0.05)
+    sink = Sink()
+    device.set_data_sinker(sink)
+    try:
+        device.start()
+        assert sink.wait(lambda frames: len(frames) >= 2)
+        version, _, _ = device.set_parameters([('frequency', 433000000)])
+        sequence, counter = device.wait_applied(version, timeout=5)
+        assert counter >= 0
+        assert sink.wait(lambda frames: any(frame.sample_counter > counter for frame in frames))
+        frames = sorted(sink.frames, key=lambda frame: frame.sample_counter)
+        index = [frame.sample_counter for frame in frames].index(counter)
+        assert frames[index].sequence == sequence
+        assert frames[index].flags & FLAG_PARAMETERS_CHANGED
+        assert frames[index].frequency == 433000000 and frames[index].parameter_version == version
+        assert all(frame.frequency == 101700000 and not frame.flags & FLAG_PARAMETERS_CHANGED
+                   for frame in frames[:index])
+        assert all(frame.frequency == 433000000 for frame in frames[index:])
+    finally:
+        device.stop()
+        device.release()
+        sink.release()
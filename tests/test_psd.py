@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+# -*-coding:utf-8-*-
+# Description: Spectrum streaming of plutosdr_dsp, tones must show up in their bins
+
+import numpy as np
+import pytest
+
+from conftest import SAMPLING_COUNT, make_frame, tone
+from plutosdr_dsp import SPECTRUM_HEADER, PsdEstimator
+
+
+def spectrum(header, payload):
+    fields = SPECTRUM_HEADER.unpack(bytes(header))
+    dtype = np.float32 if fields[3] == 0 else np.uint8
+    return fields, np.frombuffer(payload, dtype=dtype)
+
+
+@pytest.mark.parametrize('offset', [248000, -124000, 0])  # bin centers
+def test_psd_tone_bin(packetizer, offset):
+    psd = PsdEstimator(fft_size=256, overlap=50, averages=4)
+    datagrams = []
+    for index in range(4):
+        frame = make_frame(packetizer, tone(SAMPLING_COUNT, offset, 1024000, start=index * SAMPLING_COUNT),
+                           sample_counter=index * SAMPLING_COUNT)
+        datagrams.extend(psd.process(frame))
+        frame.release()
+    assert datagrams
+    fields, values = spectrum(*datagrams[0])
+    assert fields[4] == 256 and fields[14] == 256
+    assert fields[8] == 0  # sample counter of the first segment
+    assert int(np.argmax(values)) == 128 + offset // 4000
+    assert values.max() == pytest.approx(-6.0, abs=0.5)  # amplitude 1024 of 2048 full scale
+
+
+def test_psd_uint8_scaling(packetizer):
+    psd = PsdEstimator(fft_size=128, averages=1, output='u8')
+    frame = make_frame(packetizer, tone(SAMPLING_COUNT, 128000, 1024000))
+    fields, values = spectrum(*psd.process(frame)[0])
+    frame.release()
+    assert values.dtype == np.uint8
+    peak = fields[15] + values.max() * fields[16]
+    assert int(np.argmax(values)) == 64 + 16
+    assert peak == pytest.approx(-6.0, abs=1.0)
+
+
+def test_psd_invalid_settings():
+    with pytest.raises(ValueError):
+        PsdEstimator(fft_size=1000)
+    with pytest.raises(ValueError):
+        PsdEstimator(window='kaiser')
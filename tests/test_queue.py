@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+# -*-coding:utf-8-*-
+# Description: FrameQueue policies and the frame references they hold
+
+import threading
+
+import pytest
+
+from conftest import SAMPLING_COUNT, make_frame, tone
+from plutosdr import FrameQueue
+
+
+def frames(packetizer, count):
+    return [make_frame(packetizer, tone(SAMPLING_COUNT, 0, 1024000), sample_counter=index * SAMPLING_COUNT)
+            for index in range(count)]
+
+
+def release(frames_):
+    for frame in frames_:
+        frame.release()
+
+
+def test_drop_oldest(packetizer):
+    queue = FrameQueue(2, 'drop-oldest')
+    first, second, third = frames(packetizer, 3)
+    assert all(queue.put(frame) for frame in (first, second, third))
+    assert queue.dropped == 1 and len(queue) == 2
+    assert first.refs == 1  # the queue released the dropped frame
+    assert queue.get(0) is second
+    assert queue.get(0) is third
+    assert queue.get(0) is None
+    release((first, second, second, third, third))
+    assert packetizer.allocated == 4
+
+
+def test_drop_newest(packetizer):
+    queue = FrameQueue(2, 'drop-newest')
+    first, second, third = frames(packetizer, 3)
+    assert queue.put(first) and queue.put(second)
+    assert not queue.put(third)
+    assert queue.dropped == 1 and third.refs == 1
+    assert queue.get(0) is first
+    assert queue.get(0) is second
+    release((first, first, second, second, third))
+
+
+def test_block_waits_for_room(packetizer):
+    queue = FrameQueue(1, 'block')
+    first, second = frames(packetizer, 2)
+    queue.put(first)
+    results = []
+    producer = threading.Thread(target=lambda: results.append(queue.put(second)))
+    producer.start()
+    producer.join(0.2)
+    assert producer.is_alive() and not results
+    assert queue.get(1) is first
+    producer.join(1)
+    assert results == [True] and queue.dropped == 0
+    assert queue.get(1) is second
+    release((first, first, second, second))
+
+
+def test_close_releases_and_wakes(packetizer):
+    queue = FrameQueue(1, 'block')
+    first, second = frames(packetizer, 2)
+    queue.put(first)
+    results = []
+    producer = threading.Thread(target=lambda: results.append(queue.put(second)))
+    producer.start()
+    producer.join(0.1)
+    queue.close()
+    producer.join(1)
+    assert results == [False]
+    assert first.refs == 1 and second.refs == 1
+    assert queue.get(10) is None  # at once
+    assert not queue.put(first)
+    release((first, second))
+
+
+def test_close_drain_leaves_frames_for_get(packetizer):
+    queue = FrameQueue(4)
+    first, second = frames(packetizer, 2)
+    queue.put(first)
+    queue.put(second)
+    queue.close(drain=True)
+    assert queue.get(10) is first
+    assert queue.get(10) is second
+    assert queue.get(10) is None
+    release((first, first, second, second))
+
+
+def test_configure(packetizer):
+    queue = FrameQueue(3)
+    queued = frames(packetizer, 3)
+    for frame in queued:
+        queue.put(frame)
+    queue.configure(1, 'drop-newest')
+    assert queue.dropped == 2 and len(queue) == 1
+    assert queue.get(0) is queued[2]
+    with pytest.raises(ValueError):
+        queue.configure(0, 'drop-oldest')
+    with pytest.raises(ValueError):
+        FrameQueue(4, 'drop-random')
+    release(queued + [queued[2]])
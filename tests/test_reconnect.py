@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+# -*-coding:utf-8-*-
+# Description: Lost device: the capture thread reconnects, restores the parameters set and streams on,
+#              parameters persisted across restarts
+
+import json
+
+from conftest import RecordingBackend, Sink, wait_for
+from plutosdr import FLAG_OVERFLOW, DeviceService
+
+
+def test_unplug_reconnects_with_parameters(device, backend):
+    sink = Sink()
+    device.set_data_sinker(sink)
+    device.set_parameters([('frequency', 433000000), ('gain_control_mode', 'manual'), ('hardwaregain', 30)])
+    device.start()
+    try:
+        assert sink.wait(lambda frames: len(frames) >= 4)
+        backend.unplug(0.3)
+        assert wait_for(lambda: device.statistics()['reconnects'] == 1 and device.statistics()['connected'])
+        context = backend.contexts[-1]
+        assert len(backend.contexts) >= 2
+        assert context.phy.channels[0].attrs['frequency'].value == '433000000'
+        assert context.phy.channels[4].attrs['gain_control_mode'].value == 'manual'
+        assert context.phy.channels[4].attrs['hardwaregain'].value == '30'
+
+        count = len(sink.frames)
+        assert sink.wait(lambda frames: len(frames) >= count + 4)
+        frames = list(sink.frames)
+        gaps = [index for index in range(1, len(frames))
+                if frames[index].timestamp - frames[index - 1].timestamp > 0.2e9]  # device unplugged for 0.3s
+        assert len(gaps) == 1
+        assert frames[gaps[0]].flags & FLAG_OVERFLOW  # samples were lost meanwhile
+        assert all(frame.frequency == 433000000 for frame in frames)
+        counters = [frame.sample_counter for frame in frames]
+        assert counters == sorted(counters)
+    finally:
+        device.stop()
+        device.release()
+        sink.release()
+
+
+def test_start_without_device():
+    backend = RecordingBackend()
+    backend.unplug(1.0)
+    device = DeviceService(4096, 'sim:', backend=backend, connect_timeout=0.1)
+    try:
+        assert device.statistics()['connected'] == 0
+        device.set_parameters([('frequency', 868000000)])  # kept until the device is there
+        sink = Sink()
+        device.set_data_sinker(sink)
+        device.start()
+        assert sink.wait(lambda frames: len(frames) >= 2)
+        assert device.statistics()['connected'] == 1
+        assert backend.contexts[-1].phy.channels[0].attrs['frequency'].value == '868000000'
+        assert sink.frames[-1].frequency == 868000000
+        sink.release()
+    finally:
+        device.stop()
+        device.release()
+
+
+def test_only_rx_parameters_are_persisted(tmp_path):
+    path = str(tmp_path / 'state' / 'pluto.json')
+    first = DeviceService(4096, 'sim:', backend=RecordingBackend(), state_path=path)
+    first.set_parameters([('frequency', 433000000), ('gain_control_mode', 'manual'), ('tx_enabled', 'true')])
+    first.release()
+    with open(path) as fd:
+        assert json.load(fd)['parameters'] == {'frequency': 433000000, 'gain_control_mode': 'manual'}
+
+    backend = RecordingBackend()
+    second = DeviceService(4096, 'sim:', backend=backend, state_path=path)
+    assert second.snapshot.frequency == 433000000
+    assert backend.contexts[0].phy.channels[0].attrs['frequency'].value == '433000000'
+    assert backend.contexts[0].phy.channels[4].attrs['gain_control_mode'].value == 'manual'
+    assert 'powerdown' not in [name for name, value in backend.writes[-4:]]  # TX left off
+    second.release()
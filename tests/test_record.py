@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+# -*-coding:utf-8-*-
+# Description: Server-side SigMF recorder: rotation by size and sampling rate, data files and their metadata
+
+import json
+
+import numpy as np
+
+from conftest import SAMPLING_COUNT, SAMPLING_RATE, make_frame, tone
+from plutosdr_record import SIGMF_VERSION, Recorder
+
+FRAME_BYTES = SAMPLING_COUNT * 4
+
+
+class Device():
+    '''
+    Device the recorder attaches to, frames are given to its sinks by the test
+    '''
+
+    def __init__(self):
+        self.sinks = []
+
+    def add_data_sink(self, callback):
+        self.sinks.append(callback)
+
+    def remove_data_sink(self, callback):
+        self.sinks.remove(callback)
+
+
+def record(recorder, packetizer, frames):
+    '''
+    Record frames given as make_frame keyword arguments, return the I/Q of each frame
+    '''
+    device = Device()
+    recorder.start(device)
+    samples = []
+    for index, kwargs in enumerate(frames):
+        iq = tone(SAMPLING_COUNT, 1000 * (index + 1), SAMPLING_RATE)
+        frame = make_frame(packetizer, iq, **kwargs)
+        for sink in device.sinks:
+            sink(frame)
+        frame.release()
+        samples.append(iq)
+    recorder.stop()
+    assert not device.sinks
+    return samples
+
+
+def load(path):
+    with open(path + '.sigmf-meta') as fd:
+        meta = json.load(fd)
+    return np.fromfile(path + '.sigmf-data', dtype=np.int16), meta
+
+
+def test_rotation_by_size(tmp_path, packetizer):
+    recorder = Recorder(str(tmp_path / 'capture'), max_bytes=3 * FRAME_BYTES)
+    counters = [index * SAMPLING_COUNT for index in range(8)]
+    samples = record(recorder, packetizer, [{'sample_counter': counter} for counter in counters])
+    assert recorder.files == 3 and recorder.written == 8 * FRAME_BYTES
+    assert recorder.statistics()['dropped'] == 0 and recorder.statistics()['failed'] == 0
+    for index, frames in enumerate([(0, 3), (3, 6), (6, 8)]):
+        data, meta = load(str(tmp_path / 'capture-{0:04d}'.format(index)))
+        # preallocated space is cut at close
+        assert np.array_equal(data, np.concatenate(samples[frames[0]:frames[1]]))
+        assert meta['global']['core:datatype'] == 'ci16_le' and meta['global']['core:version'] == SIGMF_VERSION
+        assert meta['global']['core:sample_rate'] == SAMPLING_RATE
+        assert [capture['core:global_index'] for capture in meta['captures']] == [counters[frames[0]]]
+        assert meta['annotations'] == []
+
+
+def test_rotation_by_sampling_rate(tmp_path, packetizer):
+    recorder = Recorder(str(tmp_path / 'capture'), max_bytes=0)
+    record(recorder, packetizer, [{'sample_counter': 0}, {'sample_counter': SAMPLING_COUNT},
+                                  {'sample_counter': 2 * SAMPLING_COUNT, 'rate': 2 * SAMPLING_RATE}])
+    assert recorder.files == 2
+    data, meta = load(str(tmp_path / 'capture-0000'))
+    assert len(data) == 2 * SAMPLING_COUNT * 2 and meta['global']['core:sample_rate'] == SAMPLING_RATE
+    data, meta = load(str(tmp_path / 'capture-0001'))
+    assert len(data) == SAMPLING_COUNT * 2 and meta['global']['core:sample_rate'] == 2 * SAMPLING_RATE
+
+
+def test_capture_segments(tmp_path, packetizer):
+    recorder = Recorder(str(tmp_path / 'capture'))
+    record(recorder, packetizer, [
+        {'sample_counter': 0},
+        {'sample_counter': SAMPLING_COUNT},
+        {'sample_counter': 4 * SAMPLING_COUNT},                          # gap
+        {'sample_counter': 5 * SAMPLING_COUNT, 'frequency': 433920000},  # retune
+        {'sample_counter': 6 * SAMPLING_COUNT, 'frequency': 433920000}])
+    assert recorder.files == 1
+    data, meta = load(str(tmp_path / 'capture-0000'))
+    assert len(data) == 5 * SAMPLING_COUNT * 2
+    captures = meta['captures']
+    assert [capture['core:sample_start'] for capture in captures] == [0, 2 * SAMPLING_COUNT, 3 * SAMPLING_COUNT]
+    assert [capture['core:global_index'] for capture in captures] == [0, 4 * SAMPLING_COUNT, 5 * SAMPLING_COUNT]
+    assert [capture['core:frequency'] for capture in captures] == [101700000, 101700000, 433920000]
+    assert all(capture['pluto:rf_bandwidth'] == 2000000 and capture['pluto:gain'] == 10 for capture in captures)
+    assert [extension['name'] for extension in meta['global']['core:extensions']] == ['pluto']
+    annotations = meta['annotations']
+    assert len(annotations) == 1  # the gap is a segment, only the retune is annotated
+    assert annotations[0]['core:sample_start'] == 3 * SAMPLING_COUNT
+    assert annotations[0]['core:freq_lower_edge'] == 433920000 - 1000000
+    assert annotations[0]['core:freq_upper_edge'] == 433920000 + 1000000
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+# -*-coding:utf-8-*-
+# Description: Replay of a recording through the capture path, once or looped, and the "replay:" uri options
+
+import numpy as np
+
+from conftest import SAMPLING_COUNT, Sink
+from plutosdr import DeviceService
+from plutosdr_sim import ReplayBackend
+
+
+def recording(tmp_path, samples):
+    '''
+    Raw interleaved int16 I/Q file of samples counting up, return its path and its I/Q
+    '''
+    iq = np.arange(2 * samples, dtype=np.int16)
+    path = str(tmp_path / 'replay.sigmf-data')
+    iq.tofile(path)
+    return path, iq
+
+
+def test_uri_options(tmp_path):
+    path, _ = recording(tmp_path, SAMPLING_COUNT)
+    backend = ReplayBackend.from_uri('replay:{0},pace=0,loop=off,kernel_buffers=2'.format(path))
+    assert backend.path == path and backend.pace == 0 and not backend.loop and backend.kernel_buffers == 2
+    backend = ReplayBackend.from_uri('replay:{0}'.format(path))
+    assert backend.pace == 1.0 and backend.loop
+
+
+def test_replay_once(tmp_path):
+    path, iq = recording(tmp_path, 2 * SAMPLING_COUNT + SAMPLING_COUNT // 2)
+    device = DeviceService(SAMPLING_COUNT, 'replay:{0},pace=0,loop=0'.format(path))
+    sink = Sink()
+    device.set_data_sinker(sink)
+    try:
+        device.start()
+        assert sink.wait(lambda frames: len(frames) >= 3)
+        assert not sink.wait(lambda frames: len(frames) > 3, timeout=0.5)  # nothing past the end of the file
+        assert [frame.size // 4 for frame in sink.frames] == [SAMPLING_COUNT, SAMPLING_COUNT, SAMPLING_COUNT // 2]
+        played = b''.join(bytes(memoryview(frame.buffer)[:frame.size]) for frame in sink.frames)
+        assert played == iq.tobytes()
+    finally:
+        device.stop()
+        device.release()
+        sink.release()
+
+
+def test_replay_loop(tmp_path):
+    path, iq = recording(tmp_path, 2 * SAMPLING_COUNT + SAMPLING_COUNT // 2)
+    device = DeviceService(SAMPLING_COUNT, 'replay:{0},pace=0'.format(path))
+    sink = Sink()
+    device.set_data_sinker(sink)
+    try:
+        device.start()
+        assert sink.wait(lambda frames: len(frames) >= 8)
+        for frame in sink.frames[:8]:
+            # buffers crossing the end of the file go on at its beginning
+            assert frame.size == SAMPLING_COUNT * 4
+            start = frame.sample_counter * 2
+            expected = np.take(iq, np.arange(start, start + 2 * SAMPLING_COUNT), mode='wrap')
+            assert np.array_equal(np.frombuffer(frame.buffer, dtype=np.int16, count=2 * SAMPLING_COUNT), expected)
+    finally:
+        device.stop()
+        device.release()
+        sink.release()
@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+# -*-coding:utf-8-*-
+# Description: Shared memory data plane: the ring of captured frames and the worker processes reading it
+
+import multiprocessing
+from multiprocessing import shared_memory
+
+import numpy as np
+import pytest
+
+import plutosdr_shm
+from conftest import SAMPLING_COUNT, RecordingBackend, Sink, make_frame, serving
+from plutoclient import PlutoClient
+from plutosdr import DeviceService, Packetizer
+from plutosdr_shm import RingReader, SharedRing, ShmNetworkService, SlotFrame
+
+
+def test_startup_failure_unlinks_the_ring(monkeypatch):
+    rings = []
+    started = []
+
+    class Ring(SharedRing):
+        def __init__(self, *args, **kwargs):
+            SharedRing.__init__(self, *args, **kwargs)
+            rings.append(self)
+
+    process = multiprocessing.Process
+
+    class Process(process):
+        def start(self):
+            if started:
+                raise OSError('no more processes')
+            process.start(self)
+            started.append(self)
+
+    monkeypatch.setattr(plutosdr_shm, 'SharedRing', Ring)
+    monkeypatch.setattr(plutosdr_shm.multiprocessing, 'Process', Process)
+    device = DeviceService(4096, 'sim:', backend=RecordingBackend())
+    try:
+        with pytest.raises(OSError):
+            ShmNetworkService(device, workers=2)
+    finally:
+        device.release()
+    assert len(rings) == 1 and len(started) == 1
+    assert not started[0].is_alive()
+    with pytest.raises(FileNotFoundError):
+        shared_memory.SharedMemory(name=rings[0].name)
+
+
+@pytest.fixture
+def ring():
+    ring = SharedRing(slots=4, slot_size=SAMPLING_COUNT * 4)
+    yield ring
+    ring.close()
+    ring.unlink()
+
+
+def write(ring, packetizer, index):
+    '''
+    Write the frame of index to the ring, its samples and sample counter tell which one it is
+    '''
+    iq = np.full(2 * SAMPLING_COUNT, index, dtype=np.int16)
+    frame = make_frame(packetizer, iq, sample_counter=index * SAMPLING_COUNT, frequency=100000000 + index)
+    ring.write(frame)
+    frame.release()
+
+
+def read(reader, packetizer):
+    '''
+    Index of the frames read until none is ready, checked against their samples
+    '''
+    indexes = []
+    while True:
+        frame = reader.read(packetizer)
+        if frame is None:
+            return indexes
+        index = frame.sample_counter // SAMPLING_COUNT
+        assert frame.frequency == 100000000 + index and frame.size == SAMPLING_COUNT * 4
+        assert np.all(np.frombuffer(frame.buffer, dtype=np.int16) == index)
+        indexes.append(index)
+        frame.release()
+
+
+def test_ring_wraparound(ring, packetizer):
+    reader = RingReader(ring)
+    for index in range(3 * ring.slots + 1):
+        write(ring, packetizer, index)
+        assert read(reader, Packetizer(SAMPLING_COUNT)) == [index]
+    assert reader.lost == 0 and ring.written == 3 * ring.slots + 1 and ring.dropped == 0
+
+
+def test_ring_lapped_reader(ring, packetizer):
+    reader = RingReader(ring)
+    for index in range(10):
+        write(ring, packetizer, index)
+    # more than the ring behind: it resumes half a ring behind the producer, what it skipped is lost
+    assert read(reader, Packetizer(SAMPLING_COUNT)) == [8, 9]
+    assert reader.lost == 8
+
+
+def test_ring_slot_claimed_during_a_read(packetizer):
+    ring = SharedRing(slots=2, slot_size=SAMPLING_COUNT * 4)
+    try:
+        reader = RingReader(ring)
+        write(ring, packetizer, 0)
+
+        class Producing(Packetizer):
+            '''
+            Packetizer of the reader, the producer writes two frames while it copies the first slot: the second one
+            claims the slot being read
+            '''
+            def acquire(self):
+                if ring.written < 2:
+                    write(ring, packetizer, 1)
+                    write(ring, packetizer, 2)
+                return Packetizer.acquire(self)
+
+        assert read(reader, Producing(SAMPLING_COUNT)) == [1, 2]
+        assert reader.lost == 1
+    finally:
+        ring.close()
+        ring.unlink()
+
+
+def test_attach_requires_the_lock():
+    ring = SharedRing(slots=4)
+    try:
+        with pytest.raises(ValueError):
+            SharedRing(ring.name)
+        reader = SharedRing(ring.name, lock=ring.lock)
+        assert (reader.slots, reader.slot_size) == (ring.slots, ring.slot_size)
+        reader.close()
+    finally:
+        ring.close()
+        ring.unlink()
+
+
+def test_clients_of_two_workers():
+    service = ShmNetworkService(DeviceService(4096, 'sim:', backend=RecordingBackend()), 4, workers=2)
+    with serving(service) as port:
+        clients = [PlutoClient('127.0.0.1', port) for _ in range(2)]  # one per worker, fewest clients first
+        try:
+            clients[0].start()
+            for client in clients:
+                received = []
+                while sum(len(block.samples) for block in received) < 8 * 4096:
+                    blocks = client.receive(timeout=5)
+                    assert blocks
+                    received.extend(blocks)
+                assert all(block.frequency == 101700000 for block in received)
+                for previous, following in zip(received, received[1:]):
+                    if not following.lost:
+                        assert following.sample_counter == previous.sample_counter + len(previous.samples)
+        finally:
+            for client in clients:
+                client.close()
+    assert service.worker_statistics()['ring_written'] > 0
+
+
+def test_capture_into_slots():
+    device = DeviceService(4096, 'sim:', backend=RecordingBackend())
+    service = ShmNetworkService(device, workers=1)
+    sink = Sink()
+    try:
+        device.add_data_sink(sink)
+        device.start()
+        assert sink.wait(lambda frames: len(frames) >= 4)
+        # the capture thread refilled into the ring, which published the slots as they are
+        frames = sink.frames[:4]
+        assert all(isinstance(frame, SlotFrame) for frame in frames)
+        assert len(set(frame.slot for frame in frames)) == 4  # slots held by frames are not reused
+        statistics = service.worker_statistics()
+        assert statistics['ring_written'] >= 4 and statistics['ring_unpublished'] == 0
+    finally:
+        device.stop()
+        sink.release()
+        service.stop()
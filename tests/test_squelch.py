@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+# -*-coding:utf-8-*-
+# Description: Squelch gating: bursts forwarded with their holds, notifications, held frames released
+
+import numpy as np
+import pytest
+
+from conftest import SAMPLING_COUNT, make_frame, tone
+from plutosdr import DataClient, forward_frame
+from plutosdr_dsp import MAX_PRE_TRIGGER, Squelch, frame_level
+
+
+class Client():
+    '''
+    Data client keeping the frames queued to it
+    '''
+
+    def __init__(self, squelch):
+        self.squelch = squelch
+        self.frames = []
+
+    def put(self, frame):
+        frame.retain()
+        self.frames.append(frame)
+
+
+def stream(packetizer, pattern):
+    '''
+    Contiguous frames, "x" a loud tone and "." silence
+    '''
+    frames = []
+    for index, symbol in enumerate(pattern):
+        iq = tone(SAMPLING_COUNT, 64000, 1024000) if symbol == 'x' else np.zeros(SAMPLING_COUNT * 2, dtype=np.int16)
+        frames.append(make_frame(packetizer, iq, sample_counter=index * SAMPLING_COUNT))
+    return frames
+
+
+def run(client, frames):
+    notifications = []
+    for frame in frames:
+        notifications.extend(forward_frame(client, frame))
+    return [line.decode('ascii') for line in notifications]
+
+
+def test_burst_with_pre_trigger_hold(packetizer):
+    client = Client(Squelch(-20.0, pre=0.001))  # one frame of pre-trigger hold
+    frames = stream(packetizer, '...xx..')
+    notifications = run(client, frames)
+    assert client.frames == frames[2:5]
+    assert len(notifications) == 2
+    assert notifications[0].startswith('burst=open;sample={0};timestamp='.format(2 * SAMPLING_COUNT))
+    assert notifications[1] == 'burst=close;sample={0};timestamp=0;samples={1}\n'.format(5 * SAMPLING_COUNT,
+                                                                                        3 * SAMPLING_COUNT)
+    assert client.squelch.bursts == 1
+    assert client.squelch.forwarded == 3 * SAMPLING_COUNT and client.squelch.total == 7 * SAMPLING_COUNT
+    client.squelch.close()
+    for frame in client.frames + frames:
+        frame.release()
+    assert all(frame.refs == 0 for frame in frames)
+
+
+def test_post_trigger_hold(packetizer):
+    client = Client(Squelch(-20.0, post=0.002))
+    frames = stream(packetizer, '.x....')
+    notifications = run(client, frames)
+    assert client.frames == frames[1:4]  # two frames of hold, the next one closes
+    assert notifications[-1].startswith('burst=close;sample={0};'.format(4 * SAMPLING_COUNT))
+    client.squelch.close()
+    for frame in client.frames + frames:
+        frame.release()
+
+
+def test_close_releases_held_frames(packetizer):
+    squelch = Squelch(-20.0, pre=0.003)
+    client = Client(squelch)
+    frames = stream(packetizer, '...')
+    run(client, frames)
+    assert client.frames == []
+    assert [frame.refs for frame in frames] == [2, 2, 2]  # held by the squelch
+    squelch.close()
+    assert [frame.refs for frame in frames] == [1, 1, 1]
+    late = stream(packetizer, '.')[0]
+    assert run(client, [late]) == [] and client.frames == [late]  # closed: forwarded as it comes
+    for frame in frames + [late, late]:
+        frame.release()
+
+
+def test_gap_drops_the_hold(packetizer):
+    squelch = Squelch(-20.0, pre=0.003)
+    client = Client(squelch)
+    frames = stream(packetizer, '....')
+    run(client, frames[:2] + frames[3:])  # frame 2 is missing
+    assert [frame.refs for frame in frames] == [1, 1, 1, 2]
+    squelch.close()
+    for frame in frames:
+        frame.release()
+
+
+def test_replaced_squelch_is_closed(packetizer):
+    client = DataClient('test')
+    client.squelch = Squelch(-20.0, pre=0.003)
+    frames = stream(packetizer, '..')
+    for frame in frames:
+        client.squelch.process(frame)
+    client.squelch = Squelch(-30.0)
+    assert [frame.refs for frame in frames] == [1, 1]
+    client.squelch.process(frames[0])
+    client.close()
+    assert client.squelch is None
+    for frame in frames:
+        frame.release()
+
+
+def test_pre_trigger_hold_is_capped():
+    with pytest.raises(ValueError):
+        Squelch(-20.0, pre=MAX_PRE_TRIGGER + 0.1)
+    with pytest.raises(ValueError):
+        Squelch(-20.0, post=-1)
+    with pytest.raises(ValueError):
+        Squelch(-20.0, fft_size=100)
+
+
+def test_frame_level(packetizer):
+    frame = make_frame(packetizer, tone(SAMPLING_COUNT, 64000, 1024000, amplitude=2048))
+    assert frame_level(frame) == pytest.approx(0.0, abs=0.1)
+    assert frame_level(frame, 256) == pytest.approx(0.0, abs=0.5)
+    frame.release()
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+# -*-coding:utf-8-*-
+# Description: Latency histograms, the Prometheus exposition and the "*stats" command
+
+import urllib.request
+
+from conftest import RecordingBackend, free_port, serving, wait_for
+from plutoclient import PlutoClient
+from plutosdr import DeviceService, NetworkService
+from plutosdr_stats import Histogram, prometheus_text
+
+
+def test_histogram():
+    histogram = Histogram()
+    assert histogram.quantile(0.5) == 0.0 and histogram.summary() == '0:0.0:0:0:0'
+    for microseconds in [3] * 98 + [100, 20000000]:
+        histogram.observe(microseconds / 1e6)
+    assert histogram.count == 100
+    assert histogram.counts[2] == 98  # 2 <= 3us < 4us
+    assert histogram.counts[Histogram.BUCKETS] == 1  # beyond the last bound
+    assert histogram.quantile(0.5) == Histogram.bound(2)
+    assert histogram.quantile(0.99) == Histogram.bound(7)  # 100us is below 128us
+    assert histogram.quantile(1.0) == histogram.max == 20.0
+
+
+def test_prometheus_text():
+    histogram = Histogram()
+    histogram.observe(0.000003)
+    text = prometheus_text({'captured_samples': 4096, 'refill_seconds': histogram,
+                            'clients': {7: {'sent': 3, 'send_seconds': histogram, 'policy': 'drop-oldest'}}})
+    lines = text.splitlines()
+    assert '# TYPE plutosdr_captured_samples gauge' in lines and 'plutosdr_captured_samples 4096' in lines
+    assert '# TYPE plutosdr_refill_seconds histogram' in lines
+    assert 'plutosdr_refill_seconds_bucket{le="2e-06"} 0' in lines
+    assert 'plutosdr_refill_seconds_bucket{le="4e-06"} 1' in lines
+    assert 'plutosdr_refill_seconds_bucket{le="+Inf"} 1' in lines
+    assert 'plutosdr_refill_seconds_count 1' in lines
+    assert 'plutosdr_client_sent{client="7"} 3' in lines
+    assert 'plutosdr_client_send_seconds_count{client="7"} 1' in lines
+    assert not any('policy' in line for line in lines)  # not a number
+    text = prometheus_text({'devices': {'a': {'overflows': 1}, 'b': {'overflows': 2}}})
+    assert 'plutosdr_overflows{device="a"} 1' in text and 'plutosdr_overflows{device="b"} 2' in text
+    assert text.count('# TYPE plutosdr_overflows gauge') == 1
+
+
+def test_stats_command():
+    service = NetworkService(DeviceService(4096, 'sim:', backend=RecordingBackend()), 4)
+    metrics_port = free_port()
+    with serving(service) as port:
+        with PlutoClient('127.0.0.1', port) as client:
+            client.start()
+            assert client.receive(timeout=5)
+            assert wait_for(lambda: int(client.query('stats')['sent']) > 0)
+            fields = client.query('stats')
+            assert int(fields['captured_samples']) > 0
+            count, _, p50, p99, _ = (float(value) for value in fields['refill_us'].split(':'))
+            assert count > 0 and p50 <= p99
+            assert fields['send_us'].split(':')[0] != '0'
+
+            client.command(stats='http:{0}'.format(metrics_port))
+            client.query('stats')  # requests of a connection are handled in order, the endpoint is up
+            text = urllib.request.urlopen('http://127.0.0.1:{0}/metrics'.format(metrics_port), timeout=5).read()
+            assert b'# TYPE plutosdr_refill_seconds histogram' in text
+            assert b'plutosdr_client_sent{client=' in text
+            client.command(stats='http:off')
+            client.query('stats')
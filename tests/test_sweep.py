@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+# -*-coding:utf-8-*-
+# Description: Frequency sweep run by the capture thread: step order, dwell and stamping of the step frames
+
+import pytest
+
+from conftest import RecordingBackend, Sink
+from plutosdr import FLAG_SWEEP, DeviceService
+
+SAMPLING_COUNT = 4096
+STEPS = [100000000, 101000000, 102000000, 103000000, 104000000]
+
+
+class StaleBackend(RecordingBackend):
+    '''
+    Backend whose kernel queues refills captured before a retune, like IIOBackend
+    '''
+
+    def stale_refills(self, kernel_buffers):
+        return kernel_buffers
+
+
+def sweep(backend, dwell, settle, steps=len(STEPS) + 1):
+    '''
+    Run a sweep over STEPS until steps steps were captured, return the FLAG_SWEEP frames
+    '''
+    device = DeviceService(SAMPLING_COUNT, 'sim:', backend=backend)
+    del backend.writes[:]
+    sink = Sink()
+    device.set_data_sinker(sink)
+    try:
+        device.start_sweep(STEPS[0], STEPS[-1], STEPS[1] - STEPS[0], dwell, settle)
+        device.start()
+        assert sink.wait(lambda frames: len(set(frame.parameter_version for frame in frames
+                                                if frame.flags & FLAG_SWEEP)) > steps)
+        device.stop_sweep()
+        return [frame for frame in sink.frames if frame.flags & FLAG_SWEEP]
+    finally:
+        device.stop()
+        device.release()
+        sink.release()
+
+
+def steps_of(frames):
+    '''
+    Consecutive frames grouped by parameter version: [(frequency, frames)]
+    '''
+    steps = []
+    for frame in frames:
+        if not steps or steps[-1][1][-1].parameter_version != frame.parameter_version:
+            steps.append((frame.frequency, []))
+        steps[-1][1].append(frame)
+    return steps
+
+
+def test_stale_refills_are_settled():
+    frames = sweep(StaleBackend(kernel_buffers=4), dwell=SAMPLING_COUNT, settle=2)
+    steps = steps_of(frames)
+    assert [frequency for frequency, _ in steps[:len(STEPS)]] == STEPS
+
+
+@pytest.mark.parametrize('dwell', [SAMPLING_COUNT, 3 * SAMPLING_COUNT - 100])
+def test_steps(dwell):
+    backend = RecordingBackend()
+    frames = sweep(backend, dwell=dwell, settle=1, steps=2 * len(STEPS))
+    steps = steps_of(frames)[:2 * len(STEPS)]
+    assert [frequency for frequency, _ in steps] == STEPS * 2  # in order, then over again
+    tuned = [int(value) for name, value in backend.writes if name == 'frequency']
+    assert tuned[:2 * len(STEPS)] == STEPS * 2
+    per_step = -(-dwell // SAMPLING_COUNT) * SAMPLING_COUNT  # rounded up to whole buffers
+    for frequency, step_frames in steps:
+        assert sum(frame.size // 4 for frame in step_frames) == per_step
+        assert all(frame.frequency == frequency for frame in step_frames)
+        # settling buffers are not sent, they show as a jump of the sample counter
+        counters = [frame.sample_counter for frame in step_frames]
+        assert counters == list(range(counters[0], counters[0] + per_step, SAMPLING_COUNT))
+    for previous, following in zip(steps, steps[1:]):
+        assert following[1][0].sample_counter == previous[1][-1].sample_counter + 2 * SAMPLING_COUNT
+
+
+def test_frames_after_the_sweep_are_not_flagged():
+    backend = RecordingBackend()
+    device = DeviceService(SAMPLING_COUNT, 'sim:', backend=backend)
+    sink = Sink()
+    device.set_data_sinker(sink)
+    try:
+        device.start()
+        assert sink.wait(lambda frames: len(frames) >= 2)
+        assert not any(frame.flags & FLAG_SWEEP for frame in sink.frames)
+        device.start_sweep(STEPS[0], STEPS[1], STEPS[1] - STEPS[0], SAMPLING_COUNT)
+        assert sink.wait(lambda frames: sum(1 for frame in frames if frame.flags & FLAG_SWEEP) >= 4)
+        assert device.sweep_statistics()['steps'] >= 4
+        device.stop_sweep()
+        assert device.sweep_statistics() is None
+        count = len(sink.frames)
+        assert sink.wait(lambda frames: len(frames) >= count + 4)
+        assert not any(frame.flags & FLAG_SWEEP for frame in sink.frames[count + 1:])
+    finally:
+        device.stop()
+        device.release()
+        sink.release()
+
+    with pytest.raises(ValueError):
+        device.start_sweep(STEPS[1], STEPS[0], 1000000, SAMPLING_COUNT)
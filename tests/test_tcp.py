@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+# -*-coding:utf-8-*-
+# Description: TCP data channel: every sample is in a data record or a gap record, channels (DDC) included
+
+import socket
+
+import numpy as np
+import pytest
+
+from conftest import SAMPLING_COUNT, RecordingBackend, make_frame, serving, tone
+from plutoclient import PlutoClient
+from plutosdr import DATA_HEADER_V2, GAP_RECORD, RECORD_LENGTH, ChannelPipeline, DeviceService, NetworkService, \
+    Packetizer, RecordFramer
+from plutosdr_aio import AsyncNetworkService
+
+
+def parse(stream):
+    '''
+    Records of a stream as ('gap', first, samples) or ('data', sample counter, samples, frequency)
+    '''
+    records = []
+    offset = 0
+    while offset + RECORD_LENGTH.size <= len(stream):
+        length, = RECORD_LENGTH.unpack_from(stream, offset)
+        if offset + RECORD_LENGTH.size + length > len(stream):
+            break
+        record = stream[offset + RECORD_LENGTH.size: offset + RECORD_LENGTH.size + length]
+        if record[:1] == b'!':
+            _, first, samples = GAP_RECORD.unpack(record)
+            records.append(('gap', first, samples))
+        else:
+            fields = DATA_HEADER_V2.unpack_from(record)
+            records.append(('data', fields[8], fields[14], fields[10]))
+        offset += RECORD_LENGTH.size + length
+    return records
+
+
+def accounted(records):
+    '''
+    True when every record starts where the previous one ended
+    '''
+    expected = None
+    for record in records:
+        if expected is not None and record[1] != expected:
+            return False
+        expected = record[1] + record[2]
+    return True
+
+
+def test_framer_gap_records(packetizer):
+    framer = RecordFramer()
+    buffers = []
+    frames = [make_frame(packetizer, tone(SAMPLING_COUNT, 0, 1024000), sample_counter=counter)
+              for counter in (0, SAMPLING_COUNT, 4 * SAMPLING_COUNT, 5 * SAMPLING_COUNT)]
+    for frame in frames:
+        framer.append(buffers, frame, frame.datagrams_for(2))  # records are views of the frames
+    records = parse(b''.join(bytes(buffer) for buffer in buffers))
+    for frame in frames:
+        frame.release()
+    assert [record[0] for record in records] == ['data', 'data', 'gap', 'data', 'data']
+    assert records[2] == ('gap', 2 * SAMPLING_COUNT, 2 * SAMPLING_COUNT)
+    assert accounted(records)
+    assert framer.gaps == 1
+
+
+def test_channel_counter_follows_input_gaps():
+    pipeline = ChannelPipeline(SAMPLING_COUNT, 0, 256000)
+    packetizer = Packetizer(SAMPLING_COUNT)
+    framer = RecordFramer()
+    buffers = []
+    counters = []
+    for counter in (0, 1024, 8192, 9216):
+        frame = make_frame(packetizer, tone(SAMPLING_COUNT, 10000, 1024000, start=counter), sample_counter=counter)
+        output = pipeline.process(frame)
+        frame.release()
+        counters.append(output.sample_counter)
+        framer.append(buffers, output, output.datagrams_for(2))
+        buffers[:] = [bytes(buffer) for buffer in buffers]  # before the output frame is reused
+        output.release()
+    assert counters[1] > counters[0] and counters[3] > counters[2]
+    assert counters[2] == 8192 // 4  # restarted from the input counter, past the gap
+    assert framer.gaps == 1
+    assert accounted(parse(b''.join(bytes(buffer) for buffer in buffers)))
+
+
+def receive_stream(control_port, commands, minimum):
+    '''
+    Ask for the TCP data channel with commands, return the records received once minimum samples were
+    accounted for
+    '''
+    listener = socket.create_server(('127.0.0.1', 0))
+    listener.settimeout(5)
+    client = PlutoClient('127.0.0.1', control_port)
+    try:
+        client.command(tcp='127.0.0.1:{0}'.format(listener.getsockname()[1]))
+        data, _ = listener.accept()
+        data.settimeout(5)
+        for command in commands:
+            client.command(**command)
+        client.command(task='on')
+        stream = bytearray()
+        records = []
+        while sum(record[2] for record in records) < minimum:
+            chunk = data.recv(1 << 20)
+            assert chunk
+            stream += chunk
+            records = parse(stream)
+        data.close()
+        return records
+    finally:
+        client.close()
+        listener.close()
+
+
+@pytest.mark.parametrize('service_class', [NetworkService, AsyncNetworkService])
+def test_full_band_stream(service_class):
+    service = service_class(DeviceService(4096, 'sim:', backend=RecordingBackend()), 4)
+    with serving(service) as port:
+        records = receive_stream(port, [], 64 * 4096)
+    assert accounted(records)
+    assert all(record[3] == 101700000 for record in records if record[0] == 'data')
+
+
+def test_channel_stream_accounts_for_sweep_settling():
+    service = NetworkService(DeviceService(4096, 'sim:', backend=RecordingBackend()), 4)
+    with serving(service) as port:
+        records = receive_stream(port, [{'ddc': '0:320000'}, {'sweep': '100000000:101000000:1000000:8192:1'}],
+                                 8 * 320000 // 10)
+    data = [record for record in records if record[0] == 'data']
+    assert accounted(records)
+    assert any(record[0] == 'gap' for record in records)  # settling buffers are gaps of the channel too
+    assert {record[3] for record in data} >= {100000000, 101000000}
+    assert np.diff([record[1] for record in data]).min() > 0